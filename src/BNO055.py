@@ -1,5 +1,8 @@
 from pyb import I2C
 from pyb import Pin
+from time import sleep_ms, ticks_ms, ticks_diff
+from array import array
+import micropython
 
 '''
 BNO-MCU Pin Layout
@@ -17,7 +20,7 @@ BNO_NDOF_MODE = 0x0C
 BNO_OPR_MODE = 0x3D
 BNO_PWR_ADDR = 0x3E
 BNO_CALIB_ADDR = 0x35
-BNO_UNITSEL_ADDR = 0x80
+BNO_UNITSEL_ADDR = 0x3B
 BNO_CALIB_COEF_ADDR = 0x55
 
 # Gryoscope Addresses
@@ -47,6 +50,38 @@ EUL_Y_MSB = 0x1D
 EUL_Z_LSB = 0x1E
 EUL_Z_MSB = 0x1F
 
+# Burst read: every register from the gyroscope X LSB up to the calibration status, read in
+# one transaction straight into an array of little-endian 16 bit words (34 bytes, 17 words)
+BURST_ADDR = GYR_X_LSB
+BURST_WORDS = (BNO_CALIB_ADDR + 1 - BURST_ADDR) // 2
+# Word offsets into the burst
+GYR_X = 0
+GYR_Y = 1
+GYR_Z = 2
+EUL_X = (EUL_X_LSB - BURST_ADDR) // 2
+EUL_Y = EUL_X + 1
+EUL_Z = EUL_X + 2
+CALIB_WORD = (BNO_CALIB_ADDR - BURST_ADDR) // 2  # calibration status is this word's high byte
+# Counts per radian and per radian per second, once UNIT_SEL is set for radians
+RAD_SCALE = 900
+
+# Fields of the 'imu' SharedStruct ('i') filled in sampling mode, and their indices: raw Euler
+# heading and Z gyro counts, calibration status, ticks_ms() of the read, and a count of samples
+IMU_FIELDS = ('heading', 'yaw_rate', 'calib', 'stamp', 'count')
+IMU_HEADING = 0
+IMU_YAW_RATE = 1
+IMU_CALIB = 2
+IMU_STAMP = 3
+IMU_COUNT = 4
+
+# Calibration profile file: magic, format version, profile length, the profile, and a Fletcher-16
+# checksum of everything before it, high byte first
+CALIB_FILE = 'bno055_cal.bin'
+CALIB_MAGIC = b'BNOC'
+CALIB_VERSION = 1
+CALIB_LEN = 22
+CALIB_HEADER = len(CALIB_MAGIC) + 2
+
 
 class BNO055:
     '''
@@ -62,9 +97,15 @@ class BNO055:
         '''
         self.i2c = I2C(2, I2C.CONTROLLER, baudrate=400000)
         self.addr = BNO_ADDR
-        self.eulX = None
-        self.eulY = None
-        self.eulZ = None
+        self.data = array('h', [0] * BURST_WORDS)  # registers from the last burst read
+        # Sampling mode
+        self.sample = None
+        self.out = array('i', [0] * len(IMU_FIELDS))
+        self.pending = False
+        self.count = 0
+        self.drops = 0
+        self.errors = 0
+        self._sample_ref = self._sample  # bound once, as making one in an ISR allocates
         return
 
     def imuConfig(self):
@@ -75,6 +116,7 @@ class BNO055:
         !@return None
         '''
         self.i2c.mem_write(BNO_NDOF_MODE, self.addr, BNO_OPR_MODE)
+        sleep_ms(20)  # switching out of CONFIG mode takes 19 ms
         return
 
     def gyroConfig(self):
@@ -106,11 +148,12 @@ class BNO055:
         '''
         !@brief Configures Fusion Mode
         !@details Writes to the Fusion Mode address setting the readings
-        to nine degrees of freedom and setting the Euler Readings to Radians
+        to nine degrees of freedom and setting the Euler and gyroscope readings to radians. The unit
+        selection can only be written in CONFIG mode, so that mode is entered first.
         !@return None
         '''
-        self.i2c.mem_write(0x00, self.addr, BNO_NDOF_MODE)  
-        self.i2c.mem_write(0x04, self.addr, BNO_UNITSEL_ADDR)  
+        self.configMode()
+        self.i2c.mem_write(0x06, self.addr, BNO_UNITSEL_ADDR)
         return
 
     def readCalibrationStatus(self):
@@ -148,59 +191,229 @@ class BNO055:
         self.i2c.mem_write(data, self.addr, BNO_CALIB_COEF_ADDR)
         return
 
+    def configMode(self):
+        '''
+        !@brief Puts the IMU in CONFIG mode, in which the calibration profile can be read and written
+        !@return None
+        '''
+        self.i2c.mem_write(BNO_CONFIG_MODE, self.addr, BNO_OPR_MODE)
+        sleep_ms(7)  # switching into CONFIG mode takes 7 ms
+        return
+
+    def saveCalibration(self, path=CALIB_FILE):
+        '''
+        !@brief Saves the IMU's calibration profile to a file in flash
+        !@details The profile can only be read in CONFIG mode, so the IMU is put in CONFIG mode
+        for the read and then back in NDOF mode. Call this once the IMU is fully calibrated.
+        !@param path Name of the file to write
+        !@return None
+        '''
+        self.configMode()
+        data = self.readCalibrationCoeff()
+        self.imuConfig()
+        record = bytearray(CALIB_MAGIC)
+        record.append(CALIB_VERSION)
+        record.append(CALIB_LEN)
+        record.extend(data)
+        check = fletcher16(record)
+        record.append(check >> 8)
+        record.append(check & 0xFF)
+        with open(path, 'wb') as file:
+            file.write(record)
+        return
+
+    def restoreCalibration(self, path=CALIB_FILE):
+        '''
+        !@brief Writes a calibration profile saved by saveCalibration() back to the IMU
+        !@details Must be called in CONFIG mode, after fusionConfig() and before imuConfig(), so
+        that the fusion starts from the saved profile and the heading can be used within a second
+        or so of starting rather than after a fresh figure-8.
+        !@param path Name of the file to read
+        !@return bool, True if a valid profile was found and written
+        '''
+        data = loadCalibration(path)
+        if data is None:
+            return False
+        self.writeCalibrationCoeff(data)
+        return True
+
+    def readAll(self):
+        '''
+        !@brief Reads the gyroscope, Euler angles and calibration status in one transaction
+        !@details Reads the 34 bytes from the gyroscope X LSB to the calibration status into the
+        preallocated data array. The chip and the STM32 are both little-endian, so each signed
+        16 bit register lands in its array word with no decoding and nothing is allocated. The get
+        functions then return values from this read.
+        !@return None
+        '''
+        self.i2c.mem_read(self.data, self.addr, BURST_ADDR)
+        return
+
     def readEuler(self):
         '''
         !@brief Reads the Euler Angles of the IMU
-        !@details Reads the 6 bytes of data from the first address of the LSB of the EULER
-        registers. Each 16 bit number is then converted to a signed integer and updates the
-        class Euler variables.
+        !@details Same as readAll(), which gets the Euler angles along with the gyroscope rates
+        and calibration status for the cost of one transaction.
         !@return None
-        ''' 
-        euler_data = self.i2c.mem_read(6, self.addr, EUL_X_LSB)
-        self.eulX = int.from_bytes(euler_data[0:2], 'little', True)
-        self.eulY = int.from_bytes(euler_data[2:4], 'little', True)
-        self.eulZ = int.from_bytes(euler_data[4:6], 'little', True)
+        '''
+        self.readAll()
         return
 
     def getEulX(self):
         '''
-        !@brief Gets the Euler X data
-        !@return int
+        !@brief Gets the Euler X (heading) angle from the last read, in radians
+        !@return float
         '''
-        if(self.eulX >= 32768):
-            return (self.eulX - 65536)/900
-        return self.eulX /900
+        return self.data[EUL_X] / RAD_SCALE
 
     def getEulY(self):
         '''
-        !@brief Gets the Euler Y data
-        !@return int
+        !@brief Gets the Euler Y (roll) angle from the last read, in radians
+        !@return float
         '''
-        if(self.eulY >= 32768):
-            return (self.eulY - 65536)/900
-        return self.eulY /900
+        return self.data[EUL_Y] / RAD_SCALE
 
     def getEulZ(self):
         '''
-        !@brief Gets the Euler Z data
+        !@brief Gets the Euler Z (pitch) angle from the last read, in radians
+        !@return float
+        '''
+        return self.data[EUL_Z] / RAD_SCALE
+
+    def getYawRate(self):
+        '''
+        !@brief Gets the Z gyroscope rate from the last read, in radians per second
+        !@return float
+        '''
+        return self.data[GYR_Z] / RAD_SCALE
+
+    def getCalibStatus(self):
+        '''
+        !@brief Gets the calibration status byte from the last read
+        !@details Bits 7-6 system, 5-4 gyroscope, 3-2 accelerometer, 1-0 magnetometer; 3 is
+        fully calibrated.
         !@return int
         '''
-        if(self.eulZ >= 32768):
-            return (self.eulZ - 65536)/900
-        return self.eulZ /900
+        return (self.data[CALIB_WORD] >> 8) & 0xFF
 
     def readYaw(self):
         '''
         !@brief Reads the Gyroscope Measurment on the Z axis
-        !@details Reads 2 bytes of data from the LSB of the Z register to
-        get the full Z Gyroscope reading. The data is then converted to a signed
-        integer which is subtracted by half of the full scale reading and then 
-        divided by 900 due to the measurement reading resolution 
-        and being in radians.
-        !@return int
+        !@details Does a readAll() and returns the Z rate from it, in radians per second.
+        !@return float
+        '''
+        self.readAll()
+        return self.data[GYR_Z] / RAD_SCALE
+
+    def startSampling(self, timer, sample):
         '''
-        gyrZdata = self.i2c.mem_read(2, self.addr, GYR_Z_LSB)
-        yaw = int.from_bytes(gyrZdata, 'little', True)
-        if(yaw >= 32768):
-            yaw -= 65536
-        return yaw/900
+        !@brief Starts reading the IMU on every tick of a timer into a shared struct
+        !@details The timer interrupt only asks for a read with micropython.schedule(), since I2C
+        can't be used from a hard interrupt and pyb has no I2C call which returns before the
+        transfer is done. The scheduled read runs between bytecodes of whatever task is running,
+        and that task is stalled for the burst read, about 0.8 ms. The read is taken off the
+        tasks which use the heading, which only copy the sample struct, but its time still
+        lands on some task. A tick which comes while the last read is still waiting is counted
+        in drops.
+        !@param timer A pyb.Timer set to the sampling rate
+        !@param sample A SharedStruct('i') with the fields in IMU_FIELDS
+        !@return None
+        '''
+        self.sample = sample
+        self.pending = False
+        timer.callback(self._tick)
+        return
+
+    def stopSampling(self, timer):
+        '''
+        !@brief Stops the sampling started with startSampling()
+        !@return None
+        '''
+        timer.callback(None)
+        return
+
+    def _tick(self, tim):
+        # Timer interrupt: asks for a read, unless the last one is still waiting
+        if self.pending:
+            self.drops += 1
+            return
+        self.pending = True
+        try:
+            micropython.schedule(self._sample_ref, 0)
+        except RuntimeError:  # schedule queue full
+            self.pending = False
+            self.drops += 1
+
+    def _sample(self, arg):
+        # Scheduled after a timer tick: does the burst read and publishes it
+        try:
+            self.readAll()
+        except OSError:
+            self.errors += 1
+            self.pending = False
+            return
+        self.count += 1
+        out = self.out
+        out[IMU_HEADING] = self.data[EUL_X]
+        out[IMU_YAW_RATE] = self.data[GYR_Z]
+        out[IMU_CALIB] = (self.data[CALIB_WORD] >> 8) & 0xFF
+        out[IMU_STAMP] = ticks_ms()
+        out[IMU_COUNT] = self.count
+        self.sample.put_all(out)
+        self.pending = False
+
+
+def sampleAge(sample):
+    '''
+    !@brief How long ago the sample in an 'imu' struct was read
+    !@param sample A SharedStruct with the fields in IMU_FIELDS
+    !@return int, milliseconds
+    '''
+    return ticks_diff(ticks_ms(), sample.get(IMU_STAMP))
+
+
+def fletcher16(data):
+    '''
+    !@brief Fletcher-16 checksum of a block of bytes
+    !@return int
+    '''
+    sum1 = 0
+    sum2 = 0
+    for byte in data:
+        sum1 = (sum1 + byte) % 255
+        sum2 = (sum2 + sum1) % 255
+    return (sum2 << 8) | sum1
+
+
+def loadCalibration(path=CALIB_FILE):
+    '''
+    !@brief Reads and checks a calibration profile saved by BNO055.saveCalibration()
+    !@details A missing file, another format version, the wrong length or a bad checksum all
+    give None, so a damaged file just means calibrating afresh.
+    !@param path Name of the file to read
+    !@return bytes of the 22 byte profile, or None
+    '''
+    try:
+        with open(path, 'rb') as file:
+            record = file.read()
+    except OSError:
+        return None
+    end = CALIB_HEADER + CALIB_LEN
+    if (len(record) != end + 2 or record[:len(CALIB_MAGIC)] != CALIB_MAGIC
+            or record[len(CALIB_MAGIC)] != CALIB_VERSION or record[len(CALIB_MAGIC) + 1] != CALIB_LEN):
+        return None
+    if fletcher16(record[:end]) != (record[end] << 8) | record[end + 1]:
+        return None
+    return record[CALIB_HEADER:end]
+
+
+def headingReady(status):
+    '''
+    !@brief Whether the fused heading can be trusted, from a calibration status byte
+    !@details The heading depends on the gyroscope and the magnetometer, so both must be fully
+    calibrated (3). The status can come from getCalibStatus() or the 'imu' struct, so checking it
+    needs no I2C transfer of its own.
+    !@param status Calibration status byte, as read from register 0x35
+    !@return bool
+    '''
+    return (status & 0x33) == 0x33
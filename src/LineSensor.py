@@ -5,6 +5,18 @@ from time import sleep_us, ticks_us, ticks_diff
 # GND = GND
 # LED_ON = 5V
 from array import array
+import kernels
+
+## Longest time in us to wait for a sensor to discharge; longer times are all dark
+TIMEOUT_US = 5000
+## Calibrated readings run from 0 (white) to this value (black)
+NORM_MAX = 1000
+## Position of each sensor from the center of the array; sensor 1 is +3500, sensor 8 is -3500
+POS_WEIGHT = (3500, 2500, 1500, 500, -500, -1500, -2500, -3500)
+## Calibrated readings below this are treated as white, to ignore noise
+NOISE_FLOOR = 50
+## If no calibrated reading reaches this, the line is lost
+LOST_LEVEL = 200
 
 def black_or_white(value):
     '''!@brief Normalizing the light sensor readings at specific cutoff threshold
@@ -38,6 +50,22 @@ class LineSensor:
         self.sensors = [0, 0, 0, 0, 0, 0, 0, 0]
         self.sens_array = array("f", (0, 0, 0, 0, 0, 0, 0, 0))
         self.small_array = array("f", (0, 0))
+        # Discharge times in us from read_all(), and what's needed to poll the pins at once
+        self.times = array("l", (0, 0, 0, 0, 0, 0, 0, 0))
+        self.pins = []
+        self.poll = []  # what kernels.discharge() polls: self.idr on the board, else self.pins
+        self.idr = array("L", (0, 0, 0, 0, 0, 0, 0, 0))  # input data register address of each pin
+        self.mask = array("H", (0, 0, 0, 0, 0, 0, 0, 0))  # bit of each pin in its register
+        # Calibration and the results of line_position()
+        self.cal_min = array("l", (0, 0, 0, 0, 0, 0, 0, 0))
+        self.cal_max = array("l", (0, 0, 0, 0, 0, 0, 0, 0))
+        self.norm = array("h", (0, 0, 0, 0, 0, 0, 0, 0))
+        self.calibrated = False
+        self.reset_calibration()
+        self.position = 0
+        self.confidence = 0
+        self.line_lost = True
+        self.line = 0
 
     def sensConfig(self, s1, s2, s3, s4, s5, s6, s7, s8):
         '''
@@ -53,6 +81,13 @@ class LineSensor:
         self.s6 = Pin(s6, mode=Pin.OUT_PP)
         self.s7 = Pin(s7, mode=Pin.OUT_PP)
         self.s8 = Pin(s8, mode=Pin.OUT_PP)
+        self.pins = [self.s1, self.s2, self.s3, self.s4, self.s5, self.s6, self.s7, self.s8]
+        if kernels.VIPER:
+            for i in range(8):
+                self.idr[i], self.mask[i] = kernels.port_of(self.pins[i])
+            self.poll = self.idr
+        else:
+            self.poll = self.pins
         return
 
     def readSensor(self, pin):
@@ -94,17 +129,107 @@ class LineSensor:
         pin.high()
         sleep_us(10)
 
+        src, mask = kernels.port_of(pin)
         pin.init(mode=Pin.IN)
-        start_time = ticks_us()
+        return kernels.discharge_one(src, mask, TIMEOUT_US)
 
-        while pin.value() == 1:
-            if ticks_diff(ticks_us(), start_time) >= 5000:
-                break
-            continue
+    def read_all(self, timeout=TIMEOUT_US):
+        '''
+        !@brief Reads all eight sensors at once
+        !@details Charges all eight RC channels together for 10us, switches them all to inputs, then
+        times every channel's discharge in one polling loop, so a whole reading takes at most one
+        timeout instead of eight. On the board the loop is a viper kernel which reads the GPIO
+        input data registers directly; elsewhere it falls back to Pin.value(). Channels still charged at the timeout
+        read as the timeout. No memory is allocated; the times are kept in self.times.
+        !@param timeout Longest time to wait, in us
+        !@return array of eight discharge times in us
+        '''
+        pins = self.pins
+        times = self.times
+        if not pins:
+            return times
+        for i in range(8):
+            pins[i].init(mode=Pin.OUT_PP)
+            pins[i].high()
+        sleep_us(10)
+        for i in range(8):
+            pins[i].init(mode=Pin.IN)
+        kernels.discharge(self.poll, self.mask, times, timeout)
+        return times
 
-        elapsed_time = ticks_diff(ticks_us(), start_time)
-        print(elapsed_time)
-        return elapsed_time
+    def reset_calibration(self):
+        '''
+        !@brief Forgets the calibration so that calibrate() can start over
+        !@return None
+        '''
+        for i in range(8):
+            self.cal_min[i] = TIMEOUT_US
+            self.cal_max[i] = 0
+        self.calibrated = False
+        return
+
+    def calibrate(self, samples=100):
+        '''
+        !@brief Records the lightest and darkest reading of each sensor
+        !@details Takes a number of readings while the sensor is swept back and forth over the line,
+        keeping each sensor's minimum (white) and maximum (black) discharge time. It can be called
+        several times to keep adding readings. Once every sensor has seen some contrast, the sensor
+        counts as calibrated and line_position() can be used.
+        !@param samples Number of readings to take
+        !@return None
+        '''
+        for n in range(samples):
+            times = self.read_all()
+            for i in range(8):
+                if times[i] < self.cal_min[i]:
+                    self.cal_min[i] = times[i]
+                if times[i] > self.cal_max[i]:
+                    self.cal_max[i] = times[i]
+        self.calibrated = True
+        for i in range(8):
+            if self.cal_max[i] - self.cal_min[i] < NOISE_FLOOR:
+                self.calibrated = False
+        return
+
+    def line_position(self):
+        '''
+        !@brief Finds the position of the line under the sensor from calibrated readings
+        !@details Scales each reading between its calibrated minimum and maximum into self.norm, from 0
+        (white) to NORM_MAX (black), then takes the average of the sensor positions weighted by those
+        values. As the line moves between two sensors the position changes smoothly rather than in
+        steps. Uses only integers and preallocated arrays, so no memory is allocated. Also sets
+        self.confidence, the darkest calibrated reading (0 to NORM_MAX); self.line_lost, true when
+        no sensor sees the line, in which case the position is 0; and self.line, true when both end
+        sensors see black, as at a crossing line.
+        !@return int position from +3500 (under sensor 1) to -3500 (under sensor 8)
+        '''
+        times = self.read_all()
+        total = 0
+        weighted = 0
+        peak = 0
+        for i in range(8):
+            span = self.cal_max[i] - self.cal_min[i]
+            value = 0
+            if span > 0:
+                value = (times[i] - self.cal_min[i]) * NORM_MAX // span
+                if value < 0:
+                    value = 0
+                elif value > NORM_MAX:
+                    value = NORM_MAX
+            self.norm[i] = value
+            if value > peak:
+                peak = value
+            if value > NOISE_FLOOR:
+                total += value
+                weighted += value * POS_WEIGHT[i]
+        self.confidence = peak
+        self.line_lost = peak < LOST_LEVEL
+        self.line = 1 if (self.norm[0] > NORM_MAX // 2 and self.norm[7] > NORM_MAX // 2) else 0
+        if self.line_lost or total == 0:
+            self.position = 0
+        else:
+            self.position = weighted // total
+        return self.position
 
     def printSensorReadings(self):
         '''
@@ -147,14 +272,9 @@ class LineSensor:
         a straight line flag is raised for FSM Romi Tasks Purposes.
         !@return tuple
         '''
-        self.sens_array[0] = black_or_white(self.readSensor2(self.s1))
-        self.sens_array[1] = black_or_white(self.readSensor2(self.s2))
-        self.sens_array[2] = black_or_white(self.readSensor2(self.s3))
-        self.sens_array[3] = black_or_white(self.readSensor2(self.s4))
-        self.sens_array[4] = black_or_white(self.readSensor2(self.s5))
-        self.sens_array[5] = black_or_white(self.readSensor2(self.s6))
-        self.sens_array[6] = black_or_white(self.readSensor2(self.s7))
-        self.sens_array[7] = black_or_white(self.readSensor2(self.s8))
+        times = self.read_all()
+        for i in range(8):
+            self.sens_array[i] = black_or_white(times[i])
         centroid = 0
         line = 0
 
@@ -1,226 +1,497 @@
 # Library Imports
 from time import ticks_us, ticks_ms, ticks_diff, ticks_add
 from pyb import Pin
+import pyb
+from array import array
 # Local File Imports
 import encoder as e
+from encoder import Q8
 import RomiMotor as m
 import LineSensor as l
+import odometry as o
+import kinematics as k
+import motion
+from fsm import State, StateMachine
 import cotask
 import task_share
 
-# Shares and queues created:
-dutyL = task_share.Share('f', thread_protect=True, name="dutyL")
-dutyR = task_share.Share('f', thread_protect=True, name="dutyR")
-start = task_share.Share('b', thread_protect=True, name="start")
-set_omegaL = task_share.Share('f', thread_protect=True, name="set_omegaL")
-set_omegaR = task_share.Share('f', thread_protect=True, name="set_omegaR")
-#omegaL = task_share.Queue('f', 100, thread_protect=True, name="omegaL")
-#omegaR = task_share.Queue('f', 100, thread_protect=True, name="omegaR")
+# Fields of the 'drive' SharedStruct which carries the setpoints between tasks. The wheel
+# speed setpoints come first so the sense task can write the pair in one critical section.
+DRIVE_FIELDS = ('omegaL', 'omegaR', 'dutyL', 'dutyR', 'start')
+OMEGA_L = 0
+OMEGA_R = 1
+DUTY_L = 2
+DUTY_R = 3
+START = 4
+
+# Fields of the 'gains' SharedStruct of the wheel speed loops, in Q8 (gain times 256): the
+# feed-forward in % per rad/s, the proportional gain in % per rad/s of error, and the integral
+# gain in % per rad of error, then the proportional and integral gains which DriveController
+# uses on the difference between the wheels. set_gains() bumps the revision so the loops take
+# up new gains.
+GAIN_FIELDS = ('kff', 'kp', 'ki', 'kp_yaw', 'ki_yaw', 'rev')
+KFF_Q8 = 0
+KP_Q8 = 1
+KI_Q8 = 2
+KP_YAW_Q8 = 3
+KI_YAW_Q8 = 4
+REV = 5
+## Starting gains of the wheel speed loops
+KFF = 3.955
+KP = 0.5
+KI = 8.0
+KP_YAW = 1.0
+KI_YAW = 24.0
+## The starting gains as the fields of GAIN_FIELDS
+DEFAULT_GAINS = tuple(round(gain * Q8) for gain in (KFF, KP, KI, KP_YAW, KI_YAW)) + (0,)
+## Duty cycle limit of RomiMotor.set_duty_q8()
+MAX_DUTY_Q8 = k.MAX_DUTY * Q8
+## Limits on what integral_q16() takes in: speed error (Q8 rad/s, beyond what the wheels can
+## reach), time step (us, two and a half control periods) and integral gain (Q8 % per rad)
+ERR_LIMIT_Q8 = 32 * Q8
+DT_LIMIT_US = 50000
+KI_LIMIT_Q8 = 128 * Q8
+
+# Converts LineSensor.line_position() to the scale of centroid3(), in which the line under
+# sensor 1 alone (position 3500) gives 15, so the steering gain works with either.
+CENTROID_PER_POSITION = 15 / 3500
+
+# Legs of the drive around the wall, measured by the odometry: inches backed up, radians of
+# the pivot, inches along the arc and the straight, and radians of the spin in the finish box.
+# Their top speeds are in in/s, and of the turns in rad/s (positive CCW); each leg ramps up to
+# its top speed and back down with a motion.Segment.
+BACKUP_IN = 4.5
+PIVOT_RAD = 1.57
+ARC_IN = 37.5
+STRAIGHT_IN = 9
+FINISH_RAD = 3.14
+BACKUP_SPEED = -3
+PIVOT_RATE = -3.14
+ARC_SPEED = 5
+ARC_RADIUS = 40
+STRAIGHT_SPEED = 3
+FINISH_RATE = -3.14
+## Line following speed once the dashed part of the course is done
+SLOW_SPEED = 3
 
 
 def circle_drive(speed, circleRadius, dir):
     '''!@brief Function that calculates Motor Controller Values for ROMI to drive in a circle of the given radius,
     in the given direction and speed.
-    !@details Circle Drive Function takes speed in in/s, radius in in, dir = 1 for CCW, dir = 0 for CW
-    to calculate the yaw rate to allow ROMI to drive in a circle with a given radius and in the specified speed.
-    Depending on the the direction given ROMI will drive in a Counter-Clockwise Direction or Clockwise.
-    !@return tuple
+    !@details Circle Drive Function takes speed in in/s, radius in in, dir = 1 for CCW, dir = 0 for CW.
+    The values come from kinematics.arc(), which works them out once for each maneuver; tasks should
+    use kinematics directly, which doesn't build a tuple on each call.
+    !@return tuple of dutyL, dutyR, omegaL, omegaR
     '''
-    # Romi radius = track width / 2
-    romiRadius = 2.775
-    # inches
-    wheelRadius = 1.375
-    # Direction YawRate Calculation
-    if dir == 1:
-        yaw_rate = speed / circleRadius
-    else:
-        yaw_rate = -speed / circleRadius
-
-    # Left and Right Motor Speed Calculations
-    speedL = speed - (romiRadius * yaw_rate)
-    speedR = speed + (romiRadius * yaw_rate)
-
-    # Angular Velocity Calculations
-    omegaL = speedL / wheelRadius
-    omegaR = speedR / wheelRadius
-
-    # Left Duty Cycle Calculation
-    dutyL = omegaL / 0.2528
-    if dutyL > 100:
-        dutyL = 100
-
-    # Right Duty Cycle Calculation
-    dutyR = omegaR / 0.2528
-    if dutyR > 100:
-        dutyR = 100
-    return dutyL, dutyR, omegaL, omegaR
+    return _unpack(k.arc(speed, circleRadius, dir == 1))
 
 def straight_drive(speed):
-    wheelRadius = 1.375
-    speedL = speed
-    speedR = speed
-    omegaL = speedL / wheelRadius
-    omegaR = speedR / wheelRadius
-    dutyL = omegaL / 0.2528
-    # Left Duty Cycle Calculation
-    if dutyL > 100:
-        dutyL = 100
-    # Right Duty Cycle Calculation
-    dutyR = omegaR / 0.2528
-    if dutyR > 100:
-        dutyR = 100
-    return dutyL, dutyR, omegaL, omegaR
+    '''!@brief Function that calculates Motor Controller Values for ROMI to drive straight at speed in in/s
+    !@details The values come from kinematics.straight().
+    !@return tuple of dutyL, dutyR, omegaL, omegaR
+    '''
+    return _unpack(k.straight(speed))
 
 def spin(yaw_rate): # positive yaw rate for CCW
-    # Romi radius = track width / 2
-    romiRadius = 2.775
-    # inches
-    wheelRadius = 1.375
-
-    omegaR = yaw_rate * romiRadius / wheelRadius
-    omegaL = - omegaR
-
-    # Left Duty Cycle Calculation
-    dutyL = omegaL / 0.2528
-    if dutyL > 100:
-        dutyL = 100
-    # Right Duty Cycle Calculation
-    dutyR = omegaR / 0.2528
-    if dutyR > 100:
-        dutyR = 100
-    return dutyL, dutyR, omegaL, omegaR
-
-class MotL_control:
+    '''!@brief Function that calculates Motor Controller Values for ROMI to turn in place at yaw_rate in rad/s
+    !@details The values come from kinematics.spin().
+    !@return tuple of dutyL, dutyR, omegaL, omegaR
+    '''
+    return _unpack(k.spin(yaw_rate))
+
+def _unpack(setpoints):
+    return setpoints[k.DUTY_L], setpoints[k.DUTY_R], setpoints[k.OMEGA_L], setpoints[k.OMEGA_R]
+
+def set_speeds(pair, setpoints):
+    '''!@brief Copies the wheel speeds of a maneuver from kinematics into a left and right pair
+    !@return None
+    '''
+    pair[OMEGA_L] = setpoints[k.OMEGA_L]
+    pair[OMEGA_R] = setpoints[k.OMEGA_R]
+
+def set_gains(gains, kff=None, kp=None, ki=None, kp_yaw=None, ki_yaw=None):
+    '''!@brief Writes new gains for the wheel speed loops into the 'gains' struct
+    !@details Gains left as None are kept. The wheel tasks take up the new gains on their next run,
+    so they can be tuned while the Romi is driving.
+    !@return None
     '''
-    !@brief A task class for Right Motor Control
-    !@details Objects of this class can be used to apply to the Scheduler.
+    values = array('i', [0] * len(GAIN_FIELDS))
+    gains.get_all(values)
+    for idx, gain in ((KFF_Q8, kff), (KP_Q8, kp), (KI_Q8, ki), (KP_YAW_Q8, kp_yaw), (KI_YAW_Q8, ki_yaw)):
+        if gain is not None:
+            values[idx] = round(gain * Q8)
+    values[REV] += 1
+    gains.put_all(values)
+
+
+def integral_q16(ki_q8, err_q8, deltat_us):
+    '''!@brief Change in a fixed-point integral over one control step, ki * err * dt
+    !@details Each input is limited first, so every product stays inside a small integer and
+    nothing is allocated however late the step or large the error or gain; at the limits the
+    final product is about 8.2e8, under the 2**30 of a small integer. The step is taken in units
+    of 64 us, and 1000000 / 64 / 256 is rounded to 61, which is 0.05% off.
+    !@param ki_q8 Integral gain in % per rad, times 256
+    !@param err_q8 Speed error in rad/s, times 256
+    !@param deltat_us Time step in us
+    !@return int, % times 2**16
     '''
+    if err_q8 > ERR_LIMIT_Q8:
+        err_q8 = ERR_LIMIT_Q8
+    elif err_q8 < -ERR_LIMIT_Q8:
+        err_q8 = -ERR_LIMIT_Q8
+    if deltat_us > DT_LIMIT_US:
+        deltat_us = DT_LIMIT_US
+    if ki_q8 > KI_LIMIT_Q8:
+        ki_q8 = KI_LIMIT_Q8
+    elif ki_q8 < -KI_LIMIT_Q8:
+        ki_q8 = -KI_LIMIT_Q8
+    return ((ki_q8 * err_q8) >> 8) * (deltat_us >> 6) // 61
+
+
+class SpeedController:
+    '''
+    !@brief The task plumbing shared by the wheel speed controllers
+    !@details Runs the states INIT, START, RUN, STOP and WAIT, numbered 0 to 4, of a fsm.StateMachine
+    for a set of motors and their encoders, and takes up new gains from the 'gains' struct. On each
+    run of RUN it takes the counts latched by sample(), or reads the encoders, and the setpoints, then
+    hands over to the control law. Subclasses provide the law as law(deltat_us, now), which is called
+    with the time since the last update in us and the time of the counts, once the encoders have been
+    updated and the setpoints read into self.sp, and sets the motors' duty cycles. They can override
+    reset() to clear the law's state, such as its integrals, before the motors start.
+    '''
+    INIT = 0
+    START = 1
+    RUN = 2
+    STOP = 3
+    WAIT = 4
 
-    def __init__(self, task_label, motL, encL):
+    def __init__(self, mots, encs, duty_fields, fixed=False, motor_map=None, name="control"):
+        '''
+        !@brief Sets up the state machine and the buffers of a controller
+        !@param mots, encs Tuples of the RomiMotor and Encoder objects, a pair for each wheel
+        !@param duty_fields Indices in DRIVE_FIELDS of each motor's starting duty cycle
+        !@param fixed True to run the control law in Q8 integers; the encoders should be fixed too
+        !@param motor_map A kinematics.MotorMap for the feed-forward, or None to use kff
+        !@param name Name of the task, shown with its state table
+        '''
+        self.mots = mots
+        self.encs = encs
+        self.duty_fields = duty_fields
+        self.fixed = fixed
+        self.motor_map = motor_map
+        self.timer_driven = False  # set once sample() is called from a timer interrupt
+        self.drive = None
+        self.gains = None
+        self.sp = array('f', [0] * len(DRIVE_FIELDS))  # local copy of drive, read in one critical section
+        self.gains_in = array('i', [0] * len(GAIN_FIELDS))
+        self.counts = array('l', [0] * len(encs))  # latched counts, copied in one critical section
+        self.rev = -1  # revision of the gains in use
+        self.now = 0
+        self.load_gains(DEFAULT_GAINS)
+        self.reset()
+        self.fsm = StateMachine((State("INIT", self.init),
+                                 State("START", self.start),
+                                 State("RUN", self.control),
+                                 State("STOP", self.stop),
+                                 State("WAIT", self.wait)), name=name)
+
+    def load_gains(self, gains_q8):
         '''
-        !@brief Left Motor Control Task 
-        !@details Motor_L Control is the control tasks for the Left Motor of the ROMI robot. This
-        takes in the ROMI motor object and the ROMI encoder object for the left wheel and creates
-        a label for the task.
+        !@brief Takes up new gains
+        !@param gains_q8 The fields of GAIN_FIELDS
         '''
-        self.task_label = task_label
-        self.motL = motL
-        self.encL = encL
+        self.kff_q8 = gains_q8[KFF_Q8]
+        self.kp_q8 = gains_q8[KP_Q8]
+        self.ki_q8 = gains_q8[KI_Q8]
+        self.kp_yaw_q8 = gains_q8[KP_YAW_Q8]
+        self.ki_yaw_q8 = gains_q8[KI_YAW_Q8]
+        self.kff = self.kff_q8 / Q8
+        self.kp = self.kp_q8 / Q8
+        self.ki = self.ki_q8 / Q8
+        self.kp_yaw = self.kp_yaw_q8 / Q8
+        self.ki_yaw = self.ki_yaw_q8 / Q8
+        self.rev = gains_q8[REV]
 
     def run(self, shares):
         '''
-        !@brief Runs the Motor L Control Task for Multi Tasking
-        !@details The function sets the Angular Velocity, start, and the Duty cycle of the Left Motor
-        The state is then initialized at state 0 where the encoder is at 0. After initializing data,
-        state is change to the start where the Motor is enable and set to the duty cycle. State is change
-        to state 2, for motor control implementation. The deltaT of the motor is updated until start is set
-        to off where the state is sent to the stop state to stop motors then to the wait state until 
-        re-initialization.
-        !@shares represent the shared intertask variables representing the motor estimated duty cycles, set speeds,
-        and an overall start flag.
+        !@brief Runs the Control Task for Multi Tasking
+        !@details The encoders are zeroed at state 0 until start is set. The start state enables the motors
+        and sets them to their duty cycles, then state 2 implements the motor control, updating the deltaT of
+        the motors, until start is set to off, when the stop state stops the motors and goes to the wait state
+        until re-initialization.
+        !@shares a tuple holding the 'drive' SharedStruct, whose fields (DRIVE_FIELDS) are the
+        motor set speeds, estimated duty cycles, and an overall start flag, and optionally the 'gains'
+        SharedStruct (GAIN_FIELDS). New gains written there with set_gains() are taken up on the next run.
         '''
-        dutyL, start, set_omegaL = shares
-        state = 0
-        kff = 3.955
-        ki = 0.5
-        while True:
-            # Implement FSM inside while loop
-            if state == 0:
-                # Run state zero code, any initializing
-                self.encL.zero()  # zero out encoder
-                if start.get() == 1:
-                    state = 1
-            elif state == 1:  # Start state, sets motor duty cycle and enables.
-                now = ticks_us()
-                self.motL.set_duty(dutyL.get())  # sets duty according to dutyL (share from comms state.)
-                self.motL.enable()
-                state = 2
-            elif state == 2:  # Maintain state, where motor control is implemented.
-                before = now  # for deltat calculation
-                now = ticks_us()
-                deltat = ticks_diff(now, before) / 10 ** 6
-                self.encL.update()
-                # FF + Integral control.
-                dutyL.put(kff * set_omegaL.get() + (ki * (set_omegaL.get() - self.encL.get_speed(deltat))))
-                self.motL.set_duty(dutyL.get())
-                if start.get() == 0:  # if start is off, sets to state 3.
-                    state = 3
-            elif state == 3:  # stop state, disables motor.
-                self.motL.disable()
-                state = 4
-            elif state == 4:  # Wait state
-                if start.get() == 1:  # if start flag is set, move back to state 1. otherwise, stay waiting.
-                    state = 1
-            else:
-                # If the state isnt 0, 1, or 2 we have an invalid state
-                raise ValueError('Invalid state')
-            yield state
+        self.drive = shares[0]
+        self.gains = shares[1] if len(shares) > 1 else None
+        yield from self.fsm.run()
+
+    def reset(self):
+        '''
+        !@brief Clears the state of the control law, such as its integrals, before the motors start
+        '''
+        pass
+
+    def init(self):
+        for enc in self.encs:
+            enc.zero()  # zero out encoders
+        if self.drive.get(START) == 1:
+            return self.START
+
+    def start(self):  # sets motor duty cycles and enables.
+        self.now = self.encs[0].latched_us if self.timer_driven else ticks_us()
+        self.reset()
+        for mot, duty_field in zip(self.mots, self.duty_fields):
+            mot.set_duty(self.drive.get(duty_field))  # sets duty according to the estimate set by sense task
+            mot.enable()
+        return self.RUN
+
+    def control(self):  # Maintain state, where motor control is implemented.
+        if self.gains is not None and self.gains.get(REV) != self.rev:
+            self.load_gains(self.gains.get_all(self.gains_in))
+        before = self.now  # for deltat calculation, kept in integer us
+        if self.timer_driven:  # use the counts and time latched by the timer interrupt
+            encs = self.encs
+            counts = self.counts
+            irq_state = pyb.disable_irq()  # so a tick can't latch between the time and the counts
+            now = encs[0].latched_us
+            for idx in range(len(encs)):
+                counts[idx] = encs[idx].latched
+            pyb.enable_irq(irq_state)
+            for idx in range(len(encs)):
+                encs[idx].update(counts[idx])
+        else:
+            now = ticks_us()
+            for enc in self.encs:
+                enc.update()
+        self.now = now
+        self.drive.get_all(self.sp)  # setpoints and start flag together
+        self.law(ticks_diff(now, before), now)
+        if self.sp[START] == 0:  # if start is off, go to the stop state.
+            return self.STOP
+
+    def stop(self):  # disables motors.
+        for mot in self.mots:
+            mot.disable()
+        return self.WAIT
+
+    def wait(self):  # if start flag is set, move back to start. otherwise, stay waiting.
+        if self.drive.get(START) == 1:
+            return self.START
+
+    def sample(self, tim):
+        '''
+        !@brief Timer interrupt step which latches the encoders
+        !@details Given to cotask.Task.attach_timer() so that the wheels are sampled at exact
+        intervals however late the scheduler gets to the task. The counts are read back to back and
+        given the same time, so every wheel is measured over the same interval. It only stores
+        integers, so it doesn't allocate memory inside the interrupt.
+        '''
+        now = ticks_us()
+        for enc in self.encs:
+            enc.latch(now)
+        self.timer_driven = True
 
 
-class MotR_control:
-    ''' !@brief A task class for Right Motor Control
-        !@details Objects of this class can be used to apply to the Scheduler.
+class WheelController(SpeedController):
     '''
-
-    def __init__(self, task_label, motR, encR):
+    !@brief A task class for the speed control of one wheel
+    !@details Objects of this class can be used to apply to the Scheduler, one for each wheel; omega_field
+    and duty_field pick which wheel's fields of the 'drive' struct are used. The duty cycle is a feed-forward
+    from the set speed, plus a proportional and an integral term on the speed error. The feed-forward is
+    kff times the set speed, or comes from a measured kinematics.MotorMap. The sum is limited to the
+    +/-100 range of RomiMotor.set_duty(), and while it is held at the limit the integral only takes in
+    errors which pull it back, so it doesn't wind up. The task is a fsm.StateMachine with the states
+    INIT, START, RUN, STOP and WAIT, numbered 0 to 4.
+    '''
+    def __init__(self, mot, enc, omega_field, duty_field, fixed=False, motor_map=None, name="control"):
         '''
-        !@brief Right Motor Control Task
-        !@details Motor_R Control is the control tasks for the Right Motor of the ROMI robot. This
-        takes in the ROMI motor object and the ROMI encoder object for the right wheel and creates
-        a label for the task.
+        !@brief Wheel Control Task
+        !@details Wheel Control is the control task for one motor of the ROMI robot. This takes in the
+        ROMI motor object and the ROMI encoder object for the wheel.
+        !@param omega_field, duty_field Indices of the wheel's set speed and duty cycle in DRIVE_FIELDS
+        !@param fixed True to run the control law in Q8 integers; the encoder should be fixed too
+        !@param motor_map A kinematics.MotorMap for the feed-forward, or None to use kff
+        !@param name Name of the task, shown with its state table
         '''
-        self.task_label = task_label
-        self.motR = motR
-        self.encR = encR
-        print("initMotR")
-    def run(self, shares):
+        self.mot = mot
+        self.enc = enc
+        self.omega_field = omega_field
+        self.duty_field = duty_field
+        super().__init__((mot,), (enc,), (duty_field,), fixed, motor_map, name)
+
+    def reset(self):
+        self.integral = 0  # %, or % * 2**16 when fixed
+
+    def law(self, deltat_us, now):
+        # FF + PI control, limited to the motor's range without integral windup.
+        enc = self.enc
+        if self.fixed:  # Q8: the only float is reading the setpoint
+            omega_q8 = int(self.sp[self.omega_field] * Q8)
+            err_q8 = omega_q8 - enc.get_speed_q8(deltat_us)
+            if self.motor_map is not None:
+                duty_q8 = self.motor_map.duty_q8(omega_q8)
+            else:
+                duty_q8 = (self.kff_q8 * omega_q8) >> 8
+            duty_q8 += (self.kp_q8 * err_q8) >> 8
+            integral = self.integral + integral_q16(self.ki_q8, err_q8, deltat_us)
+            duty_q8 += integral >> 8
+            if duty_q8 > MAX_DUTY_Q8:
+                duty_q8 = MAX_DUTY_Q8
+                if err_q8 < 0:
+                    self.integral = integral
+            elif duty_q8 < -MAX_DUTY_Q8:
+                duty_q8 = -MAX_DUTY_Q8
+                if err_q8 > 0:
+                    self.integral = integral
+            else:
+                self.integral = integral
+            self.drive.put(self.duty_field, duty_q8 >> 8)  # whole percent
+            self.mot.set_duty_q8(duty_q8)
+        else:
+            omega = self.sp[self.omega_field]
+            err = omega - enc.get_speed_mt(deltat_us, now)
+            if self.motor_map is not None:
+                duty = self.motor_map.duty(omega)
+            else:
+                duty = self.kff * omega
+            integral = self.integral + self.ki * err * deltat_us / 1000000
+            duty += self.kp * err + integral
+            if duty > k.MAX_DUTY:
+                duty = k.MAX_DUTY
+                if err < 0:
+                    self.integral = integral
+            elif duty < -k.MAX_DUTY:
+                duty = -k.MAX_DUTY
+                if err > 0:
+                    self.integral = integral
+            else:
+                self.integral = integral
+            self.drive.put(self.duty_field, duty)
+            self.mot.set_duty(duty)
+
+
+class DriveController(SpeedController):
+    '''
+    !@brief A task class for the coordinated speed control of both wheels
+    !@details One task in place of a pair of WheelController tasks. Its timer interrupt latches both
+    encoders back to back with one time stamp, so both wheel speeds are measured over the same dt.
+    The control law works on the sum and the difference of the wheels rather than on each wheel: the
+    mean of the two speed errors (linear velocity) and half their difference (yaw rate) each get a
+    PI term, kp and ki for the first and kp_yaw and ki_yaw for the second, on top of the same
+    feed-forward as WheelController. When a wheel's duty cycle would pass +/-100, the linear part is
+    cut back first so the two wheels keep the difference which holds the heading, and each integral
+    only takes in errors which pull it off the limit. The task is a fsm.StateMachine with the states
+    INIT, START, RUN, STOP and WAIT, numbered 0 to 4.
+    '''
+    def __init__(self, mot_L, enc_L, mot_R, enc_R, fixed=False, motor_map=None, name="control"):
         '''
-        !@brief Runs the Motor R Control Task for Multi Tasking
-        !@details The function sets the Angular Velocity, start, and the Duty cycle of the Right Motor
-        The state is then initialized at state 0 where the encoder is at 0. After initializing data,
-        state is change to the start where the Motor is enable and set to the duty cycle. State is change
-        to state 2, for motor control implementation. The deltaT of the motor is updated until start is set
-        to off where the state is sent to the stop state to stop motors then to the wait state until
-        re-initialization.
-        !@shares represent the shared intertask variables representing the motor estimated duty cycles, set speeds,
-        and an overall start flag.
+        !@brief Drive Control Task
+        !@details Takes in the ROMI motor and encoder objects for both wheels.
+        !@param fixed True to run the control law in Q8 integers; the encoders should be fixed too
+        !@param motor_map A kinematics.MotorMap for the feed-forward, or None to use kff
+        !@param name Name of the task, shown with its state table
         '''
-        dutyR, start, set_omegaR = shares
-        state = 0
-        kff = 3.955
-        ki = 0.5
-        while True:
-            # Implement FSM inside while loop
-            if state == 0:
-                # Run state zero code, any initializing
-                self.encR.zero()  # zero out encoder
-                if start.get() == 1:
-                    state = 1
-            elif state == 1:  # Start state, sets motor duty cycle and enables.
-                now = ticks_us()
-                self.motR.set_duty(dutyR.get())  # sets duty according to dutyR (share from comms state.)
-                self.motR.enable()
-                state = 2
-            elif state == 2:  # Maintain state, where motor control is implemented.
-                before = now  # for deltat calculation
-                now = ticks_us()
-                deltat = ticks_diff(now, before) / 10 ** 6
-                self.encR.update()
-                # FF + Integral control.
-                dutyR.put(kff * set_omegaR.get() + (ki * (set_omegaR.get() - self.encR.get_speed(deltat))))
-                self.motR.set_duty(dutyR.get())
-                if start.get() == 0:  # if start is off, sets to state 3.
-                    state = 3
-            elif state == 3:  # stop state, disables motor.
-                self.motR.disable()
-                state = 4
-            elif state == 4:  # Wait state
-                if start.get() == 1:  # if start flag is set, move back to state 1. otherwise, stay waiting.
-                    state = 1
+        self.mot_L = mot_L
+        self.enc_L = enc_L
+        self.mot_R = mot_R
+        self.enc_R = enc_R
+        self.duties = array('f', (0, 0))  # left and right duty cycles, written together
+        self.common = 0  # mean of the duty cycles, from limit()
+        self.diff = 0  # half their difference, from limit()
+        super().__init__((mot_L, mot_R), (enc_L, enc_R), (DUTY_L, DUTY_R), fixed, motor_map, name)
+
+    def reset(self):
+        self.integral = 0  # linear part, %, or % * 2**16 when fixed
+        self.integral_yaw = 0  # yaw part, in the same units
+
+    def law(self, deltat_us, now):
+        enc_L = self.enc_L
+        enc_R = self.enc_R
+        sp = self.sp
+        if self.fixed:  # Q8: the only floats are reading the setpoints
+            omega_L = int(sp[OMEGA_L] * Q8)
+            omega_R = int(sp[OMEGA_R] * Q8)
+            err_L = omega_L - enc_L.get_speed_q8(deltat_us)
+            err_R = omega_R - enc_R.get_speed_q8(deltat_us)
+            if self.motor_map is not None:
+                ff_L = self.motor_map.duty_q8(omega_L)
+                ff_R = self.motor_map.duty_q8(omega_R)
             else:
-                # If the state isnt 0, 1, or 2 we have an invalid state
-                raise ValueError('Invalid state')
-            yield state
+                ff_L = (self.kff_q8 * omega_L) >> 8
+                ff_R = (self.kff_q8 * omega_R) >> 8
+            err = (err_L + err_R) >> 1
+            err_yaw = (err_R - err_L) >> 1
+            integral = self.integral + integral_q16(self.ki_q8, err, deltat_us)
+            integral_yaw = self.integral_yaw + integral_q16(self.ki_yaw_q8, err_yaw, deltat_us)
+            self.limit(((ff_L + ff_R) >> 1) + ((self.kp_q8 * err) >> 8) + (integral >> 8),
+                       ((ff_R - ff_L) >> 1) + ((self.kp_yaw_q8 * err_yaw) >> 8) + (integral_yaw >> 8),
+                       err, err_yaw, integral, integral_yaw, MAX_DUTY_Q8)
+            duty_L = self.common - self.diff
+            duty_R = self.common + self.diff
+            self.duties[0] = duty_L >> 8  # whole percent
+            self.duties[1] = duty_R >> 8
+            self.drive.put_all(self.duties, DUTY_L)
+            self.mot_L.set_duty_q8(duty_L)
+            self.mot_R.set_duty_q8(duty_R)
+        else:
+            omega_L = sp[OMEGA_L]
+            omega_R = sp[OMEGA_R]
+            err_L = omega_L - enc_L.get_speed_mt(deltat_us, now)
+            err_R = omega_R - enc_R.get_speed_mt(deltat_us, now)
+            if self.motor_map is not None:
+                ff_L = self.motor_map.duty(omega_L)
+                ff_R = self.motor_map.duty(omega_R)
+            else:
+                ff_L = self.kff * omega_L
+                ff_R = self.kff * omega_R
+            err = (err_L + err_R) / 2
+            err_yaw = (err_R - err_L) / 2
+            dt = deltat_us / 1000000
+            integral = self.integral + self.ki * err * dt
+            integral_yaw = self.integral_yaw + self.ki_yaw * err_yaw * dt
+            self.limit((ff_L + ff_R) / 2 + self.kp * err + integral,
+                       (ff_R - ff_L) / 2 + self.kp_yaw * err_yaw + integral_yaw,
+                       err, err_yaw, integral, integral_yaw, k.MAX_DUTY)
+            self.duties[0] = self.common - self.diff
+            self.duties[1] = self.common + self.diff
+            self.drive.put_all(self.duties, DUTY_L)
+            self.mot_L.set_duty(self.duties[0])
+            self.mot_R.set_duty(self.duties[1])
+
+    def limit(self, common, diff, err, err_yaw, integral, integral_yaw, limit):
+        '''
+        !@brief Limits the duty cycles to the motors' range, and keeps the integrals which may grow
+        !@details The difference between the wheels is limited to the range first, and the mean then
+        to what is left of it, so the heading is held at the cost of speed. An integral is kept
+        unless its part was cut back and its error would push it further. The results go into
+        self.common and self.diff, so nothing is allocated.
+        !@return None
+        '''
+        if diff > limit:
+            diff = limit
+            if err_yaw < 0:
+                self.integral_yaw = integral_yaw
+        elif diff < -limit:
+            diff = -limit
+            if err_yaw > 0:
+                self.integral_yaw = integral_yaw
+        else:
+            self.integral_yaw = integral_yaw
+        room = limit - diff if diff > 0 else limit + diff
+        if common > room:
+            common = room
+            if err < 0:
+                self.integral = integral
+        elif common < -room:
+            common = -room
+            if err > 0:
+                self.integral = integral
+        else:
+            self.integral = integral
+        self.common = common
+        self.diff = diff
 
 
 class Sensing:
@@ -228,13 +499,14 @@ class Sensing:
         !@details Objects of this class can be used to apply to the Scheduler.
         '''
 
-    def __init__(self, line_sensor):
+    def __init__(self, line_sensor, speed=None):
         '''
         !@brief Initialization of Sensing Task returning an Object
         !@details Sensing is the Sense Task for the ROMI bot. This class will initialize parameters
         for the ROMI bump sensor, take in a user-input speed value, and set the speed values accordingly.
         !@line_sensor - an object of the LineSensor class is passed when initializing a sense object.
         allowing for methods of the LineSensor class to be called within the Sense task.
+        !@speed - line following speed in in/s, or None to ask for it at the REPL.
         '''
         self.line_sensor = line_sensor
         #Bump sensor init:
@@ -245,119 +517,166 @@ class Sensing:
         sens1_c.value(1)
         sens2_c.value(1)
         #Speed set:
-        self.speed = float(input("Enter speed in inches/s: "))
-        self.set_dutyL, self.set_dutyR, self.set_omegaL, self.set_omegaR = straight_drive(self.speed)
+        self.speed = float(input("Enter speed in inches/s: ")) if speed is None else float(speed)
+        # Setpoints for line following, looked up once so the task loop does no kinematics
+        self.cruise = k.straight(self.speed)
+        # Profiled legs of the drive around the wall; the arc slows to the straight's speed and
+        # the straight hands over to line following without stopping
+        self.backup = motion.straight(BACKUP_IN, BACKUP_SPEED)
+        self.pivot = motion.spin(PIVOT_RAD, PIVOT_RATE)
+        self.around = motion.arc(ARC_IN, ARC_SPEED, ARC_RADIUS, end_speed=STRAIGHT_SPEED)
+        self.approach = motion.straight(STRAIGHT_IN, STRAIGHT_SPEED, end_speed=STRAIGHT_SPEED)
+        self.finish = motion.spin(FINISH_RAD, FINISH_RATE)
         self.wall_done = 0  #boolean, true when wall has been passed.
+        self.drive = None
+        self.pose = None
+        self.sp = array('f', [0] * len(DRIVE_FIELDS))  # all fields, written together in state 0
+        self.pair = array('f', (0, 0))  # left and right set speeds, read and written together
+        self.here = array('f', [0] * len(o.POSE_FIELDS))  # pose now
+        self.mark = array('f', [0] * len(o.POSE_FIELDS))  # pose at the start of a leg
+        self.setpoints = array('f', [0] * len(k.SETPOINT_FIELDS))  # from the leg being driven
+        self.centroid = 0
+        self.dash_done = 0
+        self.starttime = 0 #Used to segment speeds: faster speed for dashed lines nav, slower for tight turns.
+        # States 0 to 7; each leg of the wall maneuver and the finish spin starts its profile on entry
+        self.fsm = StateMachine((State("INIT", self.init),
+                                 State("FOLLOW", self.follow),
+                                 State("BACKUP", self.leg_backup, self.start_backup),
+                                 State("PIVOT", self.leg_pivot, self.start_pivot),
+                                 State("AROUND", self.leg_around, self.start_around),
+                                 State("APPROACH", self.leg_approach, self.start_approach),
+                                 State("FINISH", self.leg_finish, self.start_finish),
+                                 State("DONE", self.done)), name="sense")
+
     def run(self, shares): # if code == 1, turn left. if -1, turn right. if 0, drive straight.
         '''
         !@brief Runs the Sense Task for Multi Tasking
-        !@details This function takes in the shared variables used for inter-task communication, and starts by
-        initializing several local variables used for course navigation. Initialized and speed set at state 0, line
-        sense control at state 1, wall navigation (in 4 segments) at states 2-5, and finish reached at state 6.
-        !@shares represent the shared intertask variables representing the motor estimated duty cycles, set speeds,
-        and an overall start flag.
+        !@details This function takes in the shared variables used for inter-task communication, and runs
+        the state machine for course navigation. Initialized and speed set at state 0, line sense control at
+        state 1, wall navigation (in 4 segments) at states 2-5, and finish reached at state 6.
+        !@shares a tuple holding the 'drive' SharedStruct, whose fields (DRIVE_FIELDS) are the
+        motor set speeds, estimated duty cycles, and an overall start flag, and optionally the 'pose'
+        SharedStruct from the odometry task (odometry.POSE_FIELDS). Each leg of the wall maneuver
+        follows a speed profile which slows down as it nears the distance or angle measured by the
+        odometry; without a pose, the distance is worked out from the speeds asked for.
+        '''
+        self.drive = shares[0]
+        self.pose = shares[1] if len(shares) > 1 else None
+        self.drive.put(START, 0)
+        self.starttime = ticks_ms()
+        yield from self.fsm.run()
+
+    def init(self): # INIT and set speed state.
+        sp = self.sp
+        if self.dash_done == 1:
+            self.cruise = k.straight(SLOW_SPEED)
+        sp[OMEGA_L] = self.cruise[k.OMEGA_L]+1.2
+        sp[OMEGA_R] = self.cruise[k.OMEGA_R]
+        sp[DUTY_L] = self.cruise[k.DUTY_L]
+        sp[DUTY_R] = self.cruise[k.DUTY_R]
+        sp[START] = 1
+        self.drive.put_all(sp)
+        print("state0Sense")
+        return 1
+
+    def follow(self):  #Line sensing state, await bump or line crossing.
+        print("state1sense")
+        pair = self.pair
+        nxt = None
+        if self.dash_done == 0:
+            if ticks_diff(ticks_ms(), self.starttime) >= 15000:
+                nxt = 0
+                self.dash_done = 1
+
+        past_centroid = self.centroid # Calculate past centroid to slow turning, limiting overshooting the line.
+        if self.line_sensor.calibrated:  # smooth position, scaled to match centroid3's weights
+            position = self.line_sensor.line_position()
+            centroid = 0 if self.line_sensor.line_lost else position * CENTROID_PER_POSITION
+            line = self.line_sensor.line
+        else:
+            centroid, line = self.line_sensor.centroid3()
+        self.centroid = centroid
+        chng_centroid = abs(centroid) - abs(past_centroid) # used to limit overcorrection.
+
+        # Line sense control: Changes set speed based on weighted centroid values.
+        if chng_centroid >= 0: #If change in centroid is positive, the current centroid is higher (worse) than past_centroid.
+
+            if abs(centroid) <= 0:   #drive straight (all white or all black)
+                pair[OMEGA_R] = self.cruise[k.OMEGA_R]
+                pair[OMEGA_L] = self.cruise[k.OMEGA_L]+1.2 #Adjustment based on different motor dynamics.
+            elif abs(centroid) > 0:
+                self.drive.get_all(pair)
+                pair[OMEGA_R] += .065 * centroid  # edit if turning too fast / slow
+                pair[OMEGA_L] -= .065 * centroid
+        else:           # Else, meaning change in centroid is negative, current centroid is lower (better), slow down turn.
+            set_speeds(pair, self.cruise)
+        self.drive.put_all(pair)
+
+        #if wall already passed, and line crossed: means we're at the finish line.
+        if line and self.wall_done == 1:
+            nxt = 6
+
+        if self.sens1_no.value() or self.sens2_no.value():   #if bump triggered, go to state 2 and set wall_done
+            nxt = 2
+            self.wall_done = 1
+        return nxt
+
+    # Bump triggered. Backup 4.5 inches, turn 90deg CW, drive in part of a circle CCW around the box,
+    # then drive straight at 3in/s for 9 in and move back to line following.
+    def start_backup(self):
+        self.backup.start(self.pose, self.mark)
+
+    def leg_backup(self):
+        if self.drive_leg(self.backup):
+            return 3
+
+    def start_pivot(self):
+        self.pivot.start(self.pose, self.mark)
+
+    def leg_pivot(self):
+        if self.drive_leg(self.pivot):
+            return 4
+
+    def start_around(self):
+        self.around.start(self.pose, self.mark)
+
+    def leg_around(self):
+        if self.drive_leg(self.around):
+            return 5
+
+    def start_approach(self):
+        self.approach.start(self.pose, self.mark)
+
+    def leg_approach(self):
+        if self.drive_leg(self.approach):
+            return 0
+
+    #Line crossed after wall complete, in finish box.
+    # Could be improved by adding delay, so Romi is fully in finish box, rather than turning upon arrival.
+    def start_finish(self):
+        self.finish.start(self.pose, self.mark)
+
+    def leg_finish(self):
+        if self.drive_leg(self.finish): # 180deg turn
+            return 0
+
+    def done(self): #Finished state, set speeds and start off.
+        sp = self.sp
+        sp[OMEGA_L] = 0
+        sp[OMEGA_R] = 0
+        sp[DUTY_L] = 0
+        sp[DUTY_R] = 0
+        sp[START] = 0
+        self.drive.put_all(sp)
+
+    def drive_leg(self, leg):
+        '''
+        !@brief Drives one step of a leg of the wall maneuver
+        !@details Steps the leg's motion.Segment, which was started with its start(), and writes the
+        wheel speeds it asks for into the 'drive' struct.
+        !@return True once the leg is finished
         '''
-        dutyL, dutyR, start, set_omegaL, set_omegaR, = shares
-        state = 0
-        start.put(0)
-        centroid = 0
-        dash_done = 0
-        starttime = ticks_ms() #Used to segment speeds: faster speed for dashed lines nav, slower for tight turns.
-
-        while True:
-            if state == 0: # INIT and set speed state.
-                if dash_done == 1:
-                    self.set_dutyL, self.set_dutyR, self.set_omegaL, self.set_omegaR = straight_drive(3)
-                dutyL.put(self.set_dutyL)
-                dutyR.put(self.set_dutyR)
-                set_omegaL.put(self.set_omegaL+1.2)
-                set_omegaR.put(self.set_omegaR)
-                start.put(1)
-                print("state0Sense")
-                state = 1
-            elif state == 1:  #Line sensing state, await bump or line crossing.
-                print("state1sense")
-                if dash_done == 0:
-                    if ticks_diff(ticks_ms(),starttime) >= 15000:
-                        state = 0
-                        dash_done = 1
-
-                past_centroid = centroid # Calculate past centroid to slow turning, limiting overshooting the line.
-                centroid, line = self.line_sensor.centroid3()
-                chng_centroid = abs(centroid) - abs(past_centroid) # used to limit overcorrection.
-
-                # Line sense control: Changes set speed based on weighted centroid values.
-                if chng_centroid >= 0: #If change in centroid is positive, the current centroid is higher (worse) than past_centroid.
-
-                    if abs(centroid) <= 0:   #drive straight (all white or all black)
-                        set_omegaR.put(self.set_omegaR)
-                        set_omegaL.put(self.set_omegaL+1.2) #Adjustment based on different motor dynamics.
-                    elif abs(centroid) > 0:
-                        currentR = set_omegaR.get()
-                        currentL = set_omegaL.get()
-                        set_omegaR.put(currentR + .065 * centroid)  # edit if turning too fast / slow
-                        set_omegaL.put(currentL - .065 * centroid)
-                else:           # Else, meaning change in centroid is negative, current centroid is lower (better), slow down turn.
-                    set_omegaR.put(self.set_omegaR)
-                    set_omegaL.put(self.set_omegaL)
-
-                #if wall already passed, and line crossed: means we're at the finish line.
-                if line and self.wall_done == 1:
-                    begin = ticks_ms()
-                    state = 6
-
-                if self.sens1_no.value() or self.sens2_no.value():   #if bump triggered, go to state 2 and set wall_done
-                    state = 2
-                    begin = ticks_ms()
-                    self.wall_done = 1
-
-            elif state == 2:  # Bump triggered. Backup 3 inches, turn 90deg CCW, drive in half circle, drive straight, hit line.
-                set_dutyL, set_dutyR, setL, setR = straight_drive(-3) # -3in/s
-
-                set_omegaR.put(setR)
-                set_omegaL.put(setL)
-
-                if ticks_diff(ticks_ms(), begin) >= 1500:
-                    state = 3
-                    begin = ticks_ms()
-            elif state == 3: # Finished backing up, start pivot.
-                set_dutyL, set_dutyR, setL, setR = spin(-3.14) #Spin at pi rad/s for .5s (90deg turn)
-                set_omegaR.put(setR)
-                set_omegaL.put(setL)
-
-                if ticks_diff(ticks_ms(), begin) >= 500:
-                    state = 4
-                    begin = ticks_ms()
-            elif state == 4: # Turn in large circle, CCW around box.
-                set_dutyL, set_dutyR, setL, setR = circle_drive(5, 40, 1)
-                set_omegaR.put(setR)
-                set_omegaL.put(setL)
-
-                if ticks_diff(ticks_ms(), begin) >= 7500: #8000
-                    state = 5
-                    begin = ticks_ms()
-
-            elif state == 5: # Drive straight at 3in/s for 3s, then move back to line following.
-                set_dutyL, set_dutyR, setL, setR = straight_drive(3)  # 3in/s
-                set_omegaR.put(setR)
-                set_omegaL.put(setL)
-                if ticks_diff(ticks_ms(), begin) >= 3000:
-                    state = 0
-
-            elif state == 6: #Line crossed after wall complete, in finish box.
-                # Could be improved by adding delay, so Romi is fully in finish box, rather than turning upon arrival.
-                set_dutyL, set_dutyR, setL, setR = spin(-3.14) ##Spin at pi rad/s for 1s (180deg turn)
-
-                set_omegaR.put(setR)
-                set_omegaL.put(setL)
-
-                if ticks_diff(ticks_ms(), begin) >= 1000:
-                    state = 0
-                    begin = ticks_ms()
-
-            elif state == 7: #Finished state, set speeds and start off.
-                start.put(0)
-                set_omegaR.put(0)
-                set_omegaL.put(0)
-
-            yield state
+        done = leg.step(self.pose, self.here, self.mark, self.setpoints)
+        set_speeds(self.pair, self.setpoints)
+        self.drive.put_all(self.pair)
+        return done
@@ -14,6 +14,7 @@ class RomiMotor:
         #self.PWM_CH1 = pwm_tim.channel(1, mode=Timer.PWM, pin=self.IN1pin)
         #self.PWM_CH2 = pwm_tim.channel(2, mode=Timer.PWM, pin=self.IN2pin)
         self.pwm_ch1 = pwm_tim.channel(1, mode=Timer.PWM, pin=self.pwm_pin)
+        self.pw_full = pwm_tim.period() + 1  # pulse width in timer counts at 100% duty
         return
 
     def set_duty(self, duty):
@@ -37,6 +38,22 @@ class RomiMotor:
             #self.PWM_CH1.pulse_width_percent(0)
         return
 
+    def set_duty_q8(self, duty_q8):
+        '''!@brief Set the PWM duty cycle from a fixed-point value.
+        @details Same as set_duty(), but the duty cycle is an integer, percent times 256,
+        and the pulse width in timer counts is worked out with integers only, so nothing is
+        allocated. Values beyond 100% are clamped.
+        @param duty_q8 A signed integer, duty cycle in percent times 256
+        '''
+        if (duty_q8 < 0):
+            self.dir_pin.high()
+            duty_q8 = -duty_q8
+        else:
+            self.dir_pin.low()
+        width = duty_q8 * self.pw_full // 25600
+        self.pwm_ch1.pulse_width(width if width < self.pw_full else self.pw_full)
+        return
+
     def enable(self):
         '''!@brief Enable one channel of the L6206.
         @details This method sets the enable pin associated with one
@@ -0,0 +1,123 @@
+'''!@file bench_fixed.py
+!@brief Compares the float and fixed-point paths of one wheel speed control tick.
+!@details A tick is one run of the RUN state of WheelController, WheelController.control():
+take up the count latched by the timer interrupt, work out the speed, apply the feed-forward
+and PI law with its anti-windup, and set the motor's duty cycle. A float and a fixed-point
+controller, with the starting gains of ROMI_tasks, are run over the same made-up counts, and
+the time and memory allocated per tick are printed for each, with the largest difference
+between the duty cycles they give. On the board, copy this file over and run
+@c import @c bench_fixed; @c bench_fixed.run(). On a workstation, run @c python
+@c bench_fixed.py from the @c src directory; the host stand-ins are used, and the times are
+the host's, which only show the relative costs.
+'''
+import sys
+import gc
+
+if sys.implementation.name == 'micropython':
+    from utime import ticks_us, ticks_diff
+else:
+    import sim
+    sim.install()
+    import tracemalloc
+    from time import perf_counter_ns
+
+    def ticks_us():
+        return perf_counter_ns() // 1000
+
+    def ticks_diff(end, start):
+        return end - start
+
+from pyb import Pin, Timer
+import encoder as e
+import RomiMotor as m
+import ROMI_tasks as c
+import task_share
+
+## Control period in microseconds
+INTERVAL_US = 20000
+
+
+def make(fixed):
+    '''!@brief Makes a wheel controller for one wheel, started as if by its task and run as if
+    by its timer interrupt, with the motor left disabled.
+    @return tuple of the WheelController and its 'drive' struct
+    '''
+    mot = m.RomiMotor(Timer(4, freq=20000), Pin.cpu.B6, Pin.cpu.B7, Pin.cpu.A10)
+    enc = e.Encoder(3, Pin.cpu.A6, Pin.cpu.A7, 65535, 0, fixed=fixed)
+    control = c.WheelController(mot, enc, c.OMEGA_L, c.DUTY_L, fixed)
+    drive = task_share.SharedStruct('f', c.DRIVE_FIELDS, name="drive")
+    drive.put(c.START, 1)
+    control.drive = drive
+    control.timer_driven = True
+    control.start()
+    mot.disable()
+    return control, drive
+
+
+def duty_of(mot):
+    '''!@brief Reads back the duty cycle a motor was last set to.
+    @return float, percent, negative in reverse
+    '''
+    duty = mot.pwm_ch1.pulse_width_percent()
+    return -duty if mot.dir_pin.value() else duty
+
+
+def ticks(control, step, count):
+    '''!@brief Runs @c count control ticks, with the wheel moving @c step counts per tick.
+    @return None
+    '''
+    enc = control.enc
+    n = 0
+    while n < count:
+        enc.latched = (enc.latched + step) & 0xFFFF
+        enc.latched_us += INTERVAL_US
+        control.control()
+        n += 1
+
+
+def measure(func, *args):
+    '''!@brief Runs a function and measures the time taken and the memory allocated.
+    @return tuple of the function's result, microseconds and bytes allocated
+    '''
+    gc.collect()
+    before = gc.mem_alloc()
+    start = ticks_us()
+    result = func(*args)
+    us = ticks_diff(ticks_us(), start)
+    return result, us, gc.mem_alloc() - before
+
+
+def run(count=2000):
+    '''!@brief Runs the benchmark and prints a table of the results.
+    @param count Number of ticks of each kind to time
+    @return None
+    '''
+    if sys.implementation.name != 'micropython':
+        tracemalloc.start()
+    control, drive = make(False)
+    control_q, drive_q = make(True)
+
+    # How closely the fixed-point duty cycle follows the float one over a range of speeds
+    worst = 0
+    for setpoint in (0.5, 2.0, 4.4, 8.0, 15.0):
+        drive.put(c.OMEGA_L, setpoint)
+        drive_q.put(c.OMEGA_L, setpoint)
+        for step in (-600, -40, 0, 3, 40, 230, 600):
+            ticks(control, step, 2)
+            ticks(control_q, step, 2)
+            worst = max(worst, abs(duty_of(control.mot) - duty_of(control_q.mot)))
+
+    drive.put(c.OMEGA_L, 4.4)
+    drive_q.put(c.OMEGA_L, 4.4)
+    _, float_us, float_bytes = measure(ticks, control, 230, count)
+    _, fixed_us, fixed_bytes = measure(ticks, control_q, 230, count)
+    print('PATH         US/TICK  BYTES/TICK')
+    print('float     {:10.2f}{:12.1f}'.format(float_us / count, float_bytes / count))
+    print('fixed     {:10.2f}{:12.1f}'.format(fixed_us / count, fixed_bytes / count))
+    print('largest duty cycle difference: {:.3f} %'.format(worst))
+    if sys.implementation.name != 'micropython':
+        tracemalloc.stop()
+
+
+if __name__ == '__main__':
+    run()
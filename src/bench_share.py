@@ -0,0 +1,63 @@
+'''!@file bench_share.py
+!@brief Micro-benchmark of the cost of reading and writing shares.
+!@details Times many get() and put() calls on a thread-protected Share, which
+disables interrupts for each call, on an unprotected Share, and on a SeqShare,
+which needs no interrupt masking. On the board, copy this file over and run
+@c import @c bench_share; @c bench_share.run(). On a workstation, run
+@c python @c bench_share.py from the @c src directory; the host stand-ins are
+used and the times are the host's, which only show the relative costs.
+'''
+import sys
+
+if sys.implementation.name == 'micropython':
+    from utime import ticks_us, ticks_diff
+else:
+    import sim
+    sim.install()
+    from time import perf_counter_ns
+
+    def ticks_us():
+        return perf_counter_ns() // 1000
+
+    def ticks_diff(end, start):
+        return end - start
+
+import task_share
+
+
+def time_share(share, count):
+    '''!@brief Times @c count get() calls and @c count put() calls on a share.
+    @return tuple of microseconds per get() and per put()
+    '''
+    start = ticks_us()
+    n = 0
+    while n < count:
+        share.get()
+        n += 1
+    get_us = ticks_diff(ticks_us(), start)
+
+    start = ticks_us()
+    n = 0
+    while n < count:
+        share.put(n)
+        n += 1
+    put_us = ticks_diff(ticks_us(), start)
+    return get_us / count, put_us / count
+
+
+def run(count=10000):
+    '''!@brief Runs the benchmark and prints a table of the results.
+    @param count Number of calls of each kind to time
+    @return None
+    '''
+    shares = (('Share, protected', task_share.Share('l', thread_protect=True)),
+              ('Share, unprotected', task_share.Share('l', thread_protect=False)),
+              ('SeqShare', task_share.SeqShare('l')))
+    print('SHARE                 GET US    PUT US')
+    for name, share in shares:
+        get_us, put_us = time_share(share, count)
+        print('{:<20s}{:8.3f}  {:8.3f}'.format(name, get_us, put_us))
+
+
+if __name__ == '__main__':
+    run()
@@ -30,6 +30,27 @@
 import gc                              # Memory allocation garbage collector
 import utime                           # Micropython version of time library
 import micropython                     # This shuts up incorrect warnings
+try:
+    import heapq                       # Priority queue for the heap scheduler
+except ImportError:
+    import uheapq as heapq             # Older Micropython name for heapq
+
+
+## Heap keys are rebased once the clock gets this far (in microseconds) from
+#  the time used as the base, well before @c ticks_diff() could wrap around.
+_REBASE_US = 0x10000000
+
+## Overrun policy: a task which has missed periods is run back-to-back until
+#  it has caught up, so it is run once for every period which has gone by.
+CATCH_UP = 0
+
+## Overrun policy: the periods which a late task has missed are skipped, and
+#  the task keeps to its original timing grid from then on.
+SKIP = 1
+
+## Overrun policy: when a task is a period or more late, its timing is started
+#  over, so that its next run is one period after the late run. 
+REPHASE = 2
 
 
 ## Implements multitasking with scheduling and some performance logging.
@@ -82,11 +103,20 @@ class Task:
     #         converted to microseconds for internal use by the scheduler.
     #  @param profile Set to @c True to enable run-time profiling 
     #  @param trace Set to @c True to generate a list of transitions between
-    #         states. @b Note: This slows things down and allocates memory.
+    #         states. @b Note: This slows things down and allocates memory;
+    #         a task run by an @c fsm.StateMachine can use its state counts
+    #         instead, which are kept in fixed memory.
     #  @param shares A list or tuple of shares and queues used by this task.
     #         If no list is given, no shares are passed to the task
+    #  @param overrun What to do when the task falls a period or more behind:
+    #         @c CATCH_UP (the default) runs it once for each missed period,
+    #         @c SKIP drops the missed periods and keeps the original timing,
+    #         and @c REPHASE restarts the timing from the late run
+    #  @param mem_profile Set to @c True to measure, with @c gc.mem_alloc(),
+    #         how many bytes of memory each run of the task allocates
     def __init__(self, run_fun, name="NoName", priority=0, period=None,
-                 profile=False, trace=False, shares=()):
+                 profile=False, trace=False, shares=(), overrun=CATCH_UP,
+                 mem_profile=False):
         # The function which is run to implement this task's code. Since it 
         # is a generator, we "run" it here, which doesn't actually run it but
         # gets it going as a generator which is ready to yield values
@@ -109,14 +139,28 @@ class Task:
         #  @c go() method. 
         if period != None:
             self.period = int(period * 1000)
-            self._next_run = utime.ticks_us() + self.period
+            self._next_run = utime.ticks_add(utime.ticks_us(), self.period)
         else:
             self.period = period
             self._next_run = None
 
+        ## The policy used when the task falls a period or more behind, one
+        #  of @c CATCH_UP, @c SKIP or @c REPHASE
+        self.overrun = overrun
+
+        # The hardware timer which triggers this task, if any, and a function
+        # which is called from the timer's interrupt before the task is run
+        self._timer = None
+        self._isr_step = None
+
+        # The time at which the task was last found ready to run, used to
+        # measure the jitter in the time between runs
+        self._last_go = None
+
         # Flag which causes the task to be profiled, in which the execution
         #  time of the @c run() method is measured and basic statistics kept. 
         self._prof = profile
+        self._mem_prof = mem_profile
         self.reset_profile()
 
         # The previous state in which the task last ran. It is used to watch
@@ -133,6 +177,14 @@ class Task:
         #  scheduler
         self.go_flag = False
 
+        # Flag which is set true while the task is waiting in the heap of
+        # the task list's heap scheduler
+        self._queued = False
+
+        # The task lists to which this task has been appended, whose heaps
+        # have to be rebuilt when the task's timing is changed
+        self._lists = []
+
 
     ## This method is called by the scheduler; it attempts to run this task.
     #  If the task is not yet ready to run, this method returns @c False
@@ -142,52 +194,73 @@ class Task:
     #  @return @c True if the task ran or @c False if it did not
     def schedule(self) -> bool:
         if self.ready():
-
-            # Reset the go flag for the next run
-            self.go_flag = False
-
-            # If profiling, save the start time
-            if self._prof:
-                stime = utime.ticks_us()
-
-            # Run the method belonging to the state which should be run next
-            curr_state = next(self._run_gen)
-
-            # If profiling or tracing, save timing data
-            if self._prof or self._trace:
-                etime = utime.ticks_us()
-
-            # If profiling, save timing data
-            if self._prof:
-                self._runs += 1
-                runt = utime.ticks_diff(etime, stime)
-                if self._runs > 2:
-                    self._run_sum += runt
-                    if runt > self._slowest:
-                        self._slowest = runt
-
-            # If transition logic tracing is on, record a transition; if not,
-            # ignore the state. If out of memory, switch tracing off and 
-            # run the memory allocation garbage collector
-            if self._trace:
-                try:
-                    if curr_state != self._prev_state:
-                        self._tr_data.append(
-                            (utime.ticks_diff(etime, self._prev_time),
-                             curr_state))
-                except MemoryError:
-                    self._trace = False
-                    gc.collect()
-
-                self._prev_state = curr_state
-                self._prev_time = etime
-
+            self._run()
             return True
 
         else:
             return False
 
 
+    ## This method runs the task's generator once, up to its next @c yield,
+    #  and keeps the profiling and tracing data. It is used by @c schedule()
+    #  once the task has been found ready, and by schedulers such as 
+    #  @c TaskList.heap_sched() which already know that the task is due.
+    def _run(self):
+        # Reset the go flag for the next run
+        self.go_flag = False
+
+        # If profiling memory, save the amount allocated so far
+        if self._mem_prof:
+            alloc = gc.mem_alloc()
+
+        # If profiling, save the start time
+        if self._prof:
+            stime = utime.ticks_us()
+
+        # Run the method belonging to the state which should be run next
+        curr_state = next(self._run_gen)
+
+        # If profiling memory, find how much this run allocated. If the
+        # garbage collector ran during the run, the count went down and the
+        # run can't be measured, so it's left out
+        if self._mem_prof:
+            alloc = gc.mem_alloc() - alloc
+            if alloc >= 0:
+                self._alloc_runs += 1
+                self._alloc_sum += alloc
+                if alloc > self._alloc_max:
+                    self._alloc_max = alloc
+
+        # If profiling or tracing, save timing data
+        if self._prof or self._trace:
+            etime = utime.ticks_us()
+
+        # If profiling, save timing data
+        if self._prof:
+            self._runs += 1
+            runt = utime.ticks_diff(etime, stime)
+            if self._runs > 2:
+                self._run_sum += runt
+                if runt > self._slowest:
+                    self._slowest = runt
+
+        # If transition logic tracing is on, record a transition; if not,
+        # ignore the state. If out of memory, switch tracing off and 
+        # run the memory allocation garbage collector
+        if self._trace:
+            try:
+                if curr_state != self._prev_state:
+                    self._tr_data.append(
+                        (utime.ticks_diff(etime, self._prev_time),
+                         curr_state))
+            except MemoryError:
+                self._trace = False
+                gc.collect()
+
+            self._prev_state = curr_state
+            self._prev_time = etime
+
+
     ## This method checks if the task is ready to run.
     #  If the task runs on a timer, this method checks what time it is; if not,
     #  this method checks the flag which indicates that the task is ready to
@@ -198,11 +271,36 @@ class Task:
         # If this task uses a timer, check if it's time to run run() again. If
         # so, set go flag and set the timer to go off at the next run time
         if self.period != None:
-            late = utime.ticks_diff(utime.ticks_us(), self._next_run)
+            now = utime.ticks_us()
+            late = utime.ticks_diff(now, self._next_run)
             if late > 0:
                 self.go_flag = True
-                self._next_run = utime.ticks_diff(self.period, 
-                                                  -self._next_run)
+
+                # Normally the next run is one period after this one was due,
+                # which keeps the timing from drifting. A task which has
+                # fallen a whole period behind is handled by its policy
+                if late < self.period or self.overrun == CATCH_UP:
+                    self._next_run = utime.ticks_add(self._next_run,
+                                                     self.period)
+                elif self.overrun == SKIP:
+                    missed = late // self.period
+                    self._skipped += missed
+                    self._next_run = utime.ticks_add(self._next_run,
+                        (missed + 1) * self.period)
+                else:
+                    self._skipped += late // self.period
+                    self._next_run = utime.ticks_add(now, self.period)
+
+                # Keep track of the worst jitter, the most by which the time
+                # between runs has differed from the period
+                if self._last_go != None:
+                    jitter = utime.ticks_diff(now, self._last_go) \
+                        - self.period
+                    if jitter < 0:
+                        jitter = -jitter
+                    if jitter > self._jitter:
+                        self._jitter = jitter
+                self._last_go = now
 
                 # If keeping a latency profile, record the data
                 if self._prof:
@@ -214,6 +312,47 @@ class Task:
         return self.go_flag
 
 
+    ## This method makes a hardware timer trigger runs of this task. 
+    #
+    #  Each time the timer's interrupt goes off, the task is marked as ready
+    #  to run and the scheduler runs it as soon as it can, as if @c go() had
+    #  been called. If a function @c step is given, it's called from the 
+    #  interrupt first, with the timer as its argument; it can take samples
+    #  which have to be taken at exact times, such as encoder counts, and 
+    #  leave them for the task to work on. The step runs in an interrupt, so
+    #  it must be short and must not allocate memory; it may use shares and
+    #  queues with @c in_ISR=True. If the task hasn't run since the last
+    #  interrupt, the run is counted as skipped. The task's period is set to
+    #  @c None, since the timer now does the timing.
+    #
+    #  @b Example:
+    #    @code
+    #       control = cotask.Task(controller.run, name="control", priority=3)
+    #       control.attach_timer(pyb.Timer(6, freq=50), controller.sample)
+    #    @endcode
+    #  @param timer A @c pyb.Timer which has been set to the desired frequency
+    #  @param step A function to be called from the timer's interrupt, or
+    #         @c None if the interrupt should only make the task ready
+    def attach_timer(self, timer, step=None):
+        self.period = None
+        self._next_run = None
+        self._isr_step = step
+        self._timer = timer
+        self._invalidate()
+        timer.callback(self._timer_isr)
+
+
+    ## This method is the callback for the timer set by @c attach_timer().
+    #  It runs in the timer's interrupt, so it doesn't allocate memory.
+    #  @param timer The timer whose interrupt is being handled
+    def _timer_isr(self, timer):
+        if self._isr_step != None:
+            self._isr_step(timer)
+        if self.go_flag:
+            self._skipped += 1
+        self.go_flag = True
+
+
     ## This method sets the period between runs of the task to the given
     #  number of milliseconds, or @c None if the task is triggered by calls
     #  to @c go() rather than time.
@@ -221,8 +360,18 @@ class Task:
     def set_period(self, new_period):
         if new_period is None:
             self.period = None
+            self._next_run = None
         else:
             self.period = int(new_period) * 1000
+            self._next_run = utime.ticks_add(utime.ticks_us(), self.period)
+        self._invalidate()
+
+
+    ## This method makes each task list holding this task rebuild the heap
+    #  used by @c heap_sched(), which holds the task under its old timing.
+    def _invalidate(self):
+        for task_list in self._lists:
+            task_list._heap = None
 
 
     ## This method resets the variables used for execution time profiling.
@@ -233,6 +382,11 @@ class Task:
         self._slowest = 0
         self._late_sum = 0
         self._latest = 0
+        self._skipped = 0
+        self._jitter = 0
+        self._alloc_runs = 0
+        self._alloc_sum = 0
+        self._alloc_max = 0
 
 
     ## This method returns a string containing the task's transition trace.
@@ -258,7 +412,14 @@ class Task:
     ## Method to set a flag so that this task indicates that it's ready to run.
     #  This method may be called from an interrupt service routine or from
     #  another task which has data that this task needs to process soon.
+    #  A timed task made ready this way runs as soon as its priority allows,
+    #  as with @c pri_sched(), and keeps its place in the heap of each task
+    #  list's @c heap_sched(), which counts it so that it isn't missed.
     def go(self):
+        if self.period != None and not self.go_flag:
+            for task_list in self._lists:
+                if task_list._heap is not None:
+                    task_list._n_woken += 1
         self.go_flag = True
 
 
@@ -280,6 +441,17 @@ class Task:
             rst += f"{avg_dur: 10.3f}{(self._slowest / 1000.0): 10.3f}"
             if self.period != None:
                 rst += f"{avg_late: 10.3f}{(self._latest / 1000.0): 10.3f}"
+                rst += f"{self._skipped: 8d}{(self._jitter / 1000.0): 10.3f}"
+            elif self._timer != None:
+                rst += f"         -         -{self._skipped: 8d}         -"
+            elif self._mem_prof:
+                rst += '         -         -       -         -'
+        if self._mem_prof and self._alloc_runs > 0:
+            if not self._prof:
+                rst += '         -         -         -         -       -' \
+                    '         -'
+            rst += f"{(self._alloc_sum // self._alloc_runs): 10d}" \
+                f"{self._alloc_max: 10d}"
         return rst
 
 
@@ -308,6 +480,18 @@ class TaskList:
         #  that priority. 
         self.pri_list = []
 
+        # Heap of [key, sequence number, task] entries for the timed tasks,
+        # ordered by the time each task is next due. It is built the first
+        # time heap_sched() is called and rebuilt after tasks are appended
+        self._heap = None
+
+        # Number of timed tasks in the heap made ready early by go()
+        self._n_woken = 0
+
+        ## The longest time in microseconds which @c heap_sched() will sleep
+        #  if some tasks are triggered by @c go() rather than by a timer
+        self.max_idle = 1000
+
 
     ## Append a task to the task list. The list will be sorted by task 
     #  priorities so that the scheduler can quickly find the highest priority
@@ -333,6 +517,11 @@ class TaskList:
         # Make sure the main list (of lists at each priority) is sorted
         self.pri_list.sort(key=lambda pri: pri[0], reverse=True)
 
+        # The heap scheduler's heap has to be rebuilt to include this task,
+        # and again if the task's timing is changed
+        self._heap = None
+        task._lists.append(self)
+
 
     ## Run tasks in order, ignoring the tasks' priorities.
     #
@@ -375,10 +564,122 @@ class TaskList:
                     return
 
 
+    ## Run tasks when they come due, keeping the timed tasks in a heap.
+    #
+    #  This scheduler keeps the tasks which run on a timer in a min-heap
+    #  ordered by the time at which each is next due. Each call reads the
+    #  clock once and only looks at the tasks at the top of the heap whose
+    #  deadlines have passed, rather than asking every task if it's ready.
+    #  Tasks which have come due are run in the same order as they would be
+    #  by @c pri_sched(): the highest priority first, round-robin among tasks
+    #  of the same priority, and only one task per call. Tasks with no
+    #  period, which are run when something calls their @c go() methods, are
+    #  checked on each call. 
+    #
+    #  If no task is due and @c idle is @c True, the processor sleeps until
+    #  the next task is due instead of spinning; sleeps of a millisecond or
+    #  more use @c utime.sleep_ms(), which waits with @c wfi on the STM32.
+    #  If any tasks are run by @c go(), no sleep is longer than @c max_idle
+    #  microseconds so that those tasks aren't kept waiting for long.
+    #  @param idle Set to @c True to sleep until the next task is due
+    @micropython.native
+    def heap_sched(self, idle=False):
+        if self._heap is None:
+            self._build_heap()
+        now = utime.ticks_us()
+
+        # Keys in the heap are times relative to a base time; move the base
+        # before the clock gets far enough from it for ticks_diff() to wrap
+        if utime.ticks_diff(now, self._base) > _REBASE_US:
+            self._build_heap()
+        heap = self._heap
+
+        # Take each task whose time has come off the heap. Its ready() method
+        # sets its go flag, moves its next run time, and records lateness
+        while heap and utime.ticks_diff(now, heap[0][2]._next_run) > 0:
+            task = heapq.heappop(heap)[2]
+            task._queued = False
+            if task.go_flag:
+                self._n_woken -= 1  # it's counted as due from here on
+            if task.ready():
+                self._n_due += 1
+            else:
+                self._push(task)
+
+        # Run the highest priority task which is ready, in the same order
+        # as pri_sched() would
+        if self._n_due or self._n_untimed or self._n_woken:
+            for pri in self.pri_list:
+                tries = 2
+                length = len(pri)
+                while tries < length:
+                    task = pri[pri[1]]
+                    tries += 1
+                    pri[1] += 1
+                    if pri[1] >= length:
+                        pri[1] = 2
+                    if task.go_flag:
+                        task._run()
+                        if task.period != None:
+                            if task._queued:
+                                # Made ready by go(); it keeps its deadline
+                                self._n_woken -= 1
+                            else:
+                                self._n_due -= 1
+                                self._push(task)
+                        return
+
+        # Nothing was ready, so wait until the next task is due
+        if idle:
+            if heap:
+                wait = utime.ticks_diff(heap[0][2]._next_run,
+                                        utime.ticks_us()) + 1
+            else:
+                wait = self.max_idle
+            if self._n_untimed and wait > self.max_idle:
+                wait = self.max_idle
+            if wait >= 1000:
+                utime.sleep_ms(wait // 1000)
+            elif wait > 0:
+                utime.sleep_us(wait)
+
+
+    ## Put a timed task into the heap used by @c heap_sched(), keyed by the
+    #  time at which it is next due to run.
+    #  @param task The task to be put into the heap
+    def _push(self, task):
+        heapq.heappush(self._heap, 
+                       [utime.ticks_diff(task._next_run, self._base),
+                        self._seq, task])
+        self._seq += 1
+        task._queued = True
+
+
+    ## Build the heap used by @c heap_sched() from the tasks in the list.
+    #  Timed tasks whose go flags are already set are counted as due rather
+    #  than being put into the heap. 
+    def _build_heap(self):
+        self._heap = []
+        self._base = utime.ticks_us()
+        self._seq = 0
+        self._n_due = 0
+        self._n_untimed = 0
+        self._n_woken = 0
+        for pri in self.pri_list:
+            for task in pri[2:]:
+                task._queued = False
+                if task.period == None:
+                    self._n_untimed += 1
+                elif task.go_flag:
+                    self._n_due += 1
+                else:
+                    self._push(task)
+
+
     ## Create some diagnostic text showing the tasks in the task list.
     def __repr__(self):
         ret_str = 'TASK             PRI    PERIOD    RUNS   AVG DUR   MAX ' \
-            'DUR  AVG LATE  MAX LATE\n'
+            'DUR  AVG LATE  MAX LATE   SKIPS   MAX JIT AVG ALLOC MAX ALLOC\n'
         for pri in self.pri_list:
             for task in pri[2:]:
                 ret_str += str(task) + '\n'
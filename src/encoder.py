@@ -1,41 +1,115 @@
-from pyb import Pin, Timer
+from pyb import Pin, Timer, ExtInt
+from time import ticks_us, ticks_diff
+from array import array
+import pyb
 import math
 
+from kernels import wrap_delta
+
+## Radians turned by the wheel per encoder count
+RAD_PER_COUNT = 2 * math.pi / 16384
+## Radians per count times microseconds per second, for speeds from a time in us
+RAD_US_PER_COUNT = RAD_PER_COUNT * 1000000
+## Fixed-point speeds are in Q8: rad/s times 256, held in a small integer
+Q8 = 256
+## Q8 rad/s per count per microsecond, so a speed is delta * Q8_RAD_US_PER_COUNT // interval_us
+Q8_RAD_US_PER_COUNT = round(RAD_US_PER_COUNT * Q8)
+## Counts between rising edges of one encoder channel
+COUNTS_PER_EDGE = 4
+## Above this many counts per update, edge timing is switched off: counting alone is then
+## precise enough, and the edge interrupts would take too much of the CPU
+EDGE_OFF_COUNTS = 400
+## Below this many counts per update, edge timing is switched back on
+EDGE_ON_COUNTS = 200
+## Q8 rad/s per unit of AlphaBeta velocity (1/256 counts per 1024 us), times 2**14; the
+## scale is split so the product stays inside a small integer
+AB_Q8 = round(RAD_US_PER_COUNT * Q8 / 16)
+
 class Encoder:
     '''!@brief Interface with quadrature encoders
     @details Contains variables for encoder timers, position, delta, AR and PS values. Contains
     functions to return positon, delta, reset position to 0 and return speed of the motor based on 
     encoder values. 
     '''
-    def __init__(self, tim_num, pin_a, pin_b, AR, PS):
+    def __init__(self, tim_num, pin_a, pin_b, AR, PS, edges=False, fixed=False, smoothing=None):
+        '''!@brief Sets up a timer in encoder mode
+        @param edges True to time the rising edges of channel A with an interrupt, for
+        get_speed_mt()
+        @param fixed True to keep update() to integers: the position is kept in counts only,
+        dradians and posrad stay 0, and speeds come from get_speed_q8()
+        @param smoothing A MovingWindow or AlphaBeta through which get_speed_q8() and
+        get_speed_mt() give the speed, or None for the unfiltered estimates
+        '''
         self.tim = Timer(tim_num, period = AR, prescaler = PS)
         self.enc_chan1 = self.tim.channel(1, mode = Timer.ENC_AB, pin = pin_a)
         self.enc_chan2 = self.tim.channel(2, mode = Timer.ENC_AB, pin = pin_b)
         self.AR = AR
+        self.fixed = fixed
+        self.smoothing = smoothing
+        self.span = AR + 1  # counts before the timer wraps around
+        self.half = (AR + 1) // 2  # integer, so the wrap check needs no float math
         self.pos = 0
         self.past = 0
         self.delta = 0
         self.dradians = 0
         self.posrad = 0
+        self.latched = 0
+        self.latched_us = 0
+        # Edge timing: count and time at the last edge, written by the interrupt
+        self.edge_count = 0
+        self.edge_us = 0
+        self.edges = 0
+        self.extint = None
+        # Count, time and number of the edge the last estimate was taken from
+        self.mt_count = 0
+        self.mt_us = 0
+        self.mt_edges = 0
+        self.mt_speed = 0
+        self.mt_on = False  # edge timing starts off, and is switched on by get_speed_mt()
+        if edges:
+            self._edge_ref = self._edge  # bound once, as making one in an ISR allocates
+            self.extint = ExtInt(pin_a, ExtInt.IRQ_RISING, Pin.PULL_NONE, self._edge_ref)
+            # Making the ExtInt turned the pin into a plain input; give it back to the timer.
+            # The EXTI line keeps watching the pin's input level in alternate function mode.
+            self.enc_chan1 = self.tim.channel(1, mode = Timer.ENC_AB, pin = pin_a)
+            self.extint.disable()
+        return
+
+    def _edge(self, line):
+        # Interrupt on a rising edge of channel A: only integers are stored, so nothing is allocated
+        self.edge_count = self.tim.counter()
+        self.edge_us = ticks_us()
+        self.edges = (self.edges + 1) & 0xFFFF
+
+    def latch(self, now_us=None):
+        '''!@brief Latches the timer count and the time at which it was read
+        @details Safe to call from an interrupt: it only stores two integers, so no memory is
+        allocated. The latched count can then be handed to update() later on.
+        @param now_us The time to latch, for encoders latched together at one time, or None
+        to read the time now
+        @return None
+        '''
+        self.latched = self.tim.counter()
+        self.latched_us = ticks_us() if now_us is None else now_us
         return
 
-    def update(self):
+    def update(self, count=None):
         '''!@brief Update counter of qudrature encoders
-        @details Updates the counter and adjust delta based on half of the AR Value.
+        @details Updates the counter and adjust delta based on half of the AR Value; the
+        wrap-around math is kernels.wrap_delta(), compiled with viper on the board.
         Updates the positon of the motor through delta and radians.
+        @param count A count latched earlier with latch(), or None to read the timer now
         @return None
         '''
-    
-        self.delta = self.tim.counter() - self.past
-        self.past = self.tim.counter()
-        if self.delta < -(self.AR+1)/2 :
-            self.delta += (self.AR+1)
-        if self.delta > (self.AR+1)/2 :
-            self.delta -= (self.AR+1)
-
-        self.dradians = 2 * math.pi * self.delta / 16384
+        if count is None:
+            count = self.tim.counter()
+        self.delta = wrap_delta(count, self.past, self.half, self.span)
+        self.past = count
+
         self.pos += self.delta
-        self.posrad += self.dradians
+        if not self.fixed:
+            self.dradians = self.delta * RAD_PER_COUNT
+            self.posrad += self.dradians
         return
 
     def get_position(self):
@@ -68,3 +142,152 @@ class Encoder:
         '''
         speed = self.dradians / interval_seconds
         return speed
+
+    def get_speed_us(self, interval_us):
+        '''!@brief Gets the speed of the motor from an interval in microseconds
+        @details Same as get_speed(), but takes the integer interval from ticks_diff() directly and
+        works from the integer count change, so fewer floats are made on each call.
+        @return float
+        '''
+        return self.delta * RAD_US_PER_COUNT / interval_us
+
+    def get_speed_q8(self, interval_us):
+        '''!@brief Gets the speed of the motor in fixed point, as rad/s times 256
+        @details Integers only, so nothing is allocated: at up to 2000 counts per update the
+        product stays inside a small integer. Within 1/256 rad/s of get_speed_us(). With a
+        smoothing filter, the count change goes through it instead. Call once per update().
+        @return int
+        '''
+        if self.smoothing is not None:
+            return self.smoothing.update(self.delta, interval_us)
+        return self.delta * Q8_RAD_US_PER_COUNT // interval_us
+
+    def get_speed_mt(self, interval_us, now_us):
+        '''!@brief Gets the speed of the motor from both the count and the timing of the edges
+        @details The M/T method: the counts between the last edge before the previous estimate
+        and the last edge before this one, over the time between those edges. Both ends are
+        edges, so the count is exact and the time is measured to the microsecond, which gives
+        a precise speed at low speeds where one period holds only a few counts, and no lag from
+        the period at high speeds. With no edge in the period, the speed can be no more than one
+        edge spacing over the time since the last edge, so the estimate falls toward zero. Edge
+        timing is switched off at high speeds (see EDGE_OFF_COUNTS), and is not used unless the
+        encoder was made with edges=True; then the count difference of get_speed_us() is used.
+        With a smoothing filter, its speed from get_speed_q8() is used instead of edge timing.
+        Call update() first, and this once per update().
+        @param interval_us Time since the last update, as for get_speed_us()
+        @param now_us Time of the count given to update()
+        @return float
+        '''
+        if self.smoothing is not None:
+            return self.get_speed_q8(interval_us) / Q8
+        extint = self.extint
+        if extint is None:
+            return self.get_speed_us(interval_us)
+        delta = self.delta
+        if delta > EDGE_OFF_COUNTS or delta < -EDGE_OFF_COUNTS:
+            if self.mt_on:
+                extint.disable()
+                self.mt_on = False
+            return self.get_speed_us(interval_us)
+        if not self.mt_on:
+            if delta > EDGE_ON_COUNTS or delta < -EDGE_ON_COUNTS:
+                return self.get_speed_us(interval_us)
+            # Start timing from the count just taken, then from edges
+            self.mt_edges = self.edges
+            self.mt_us = now_us
+            self.mt_count = self.past
+            self.mt_speed = self.get_speed_us(interval_us)
+            self.mt_on = True
+            extint.enable()
+            return self.mt_speed
+
+        irq_state = pyb.disable_irq()
+        edges = self.edges
+        edge_us = self.edge_us
+        edge_count = self.edge_count
+        pyb.enable_irq(irq_state)
+        if edges != self.mt_edges:
+            counts = edge_count - self.mt_count
+            if counts < -self.half:
+                counts += self.span
+            if counts > self.half:
+                counts -= self.span
+            elapsed = ticks_diff(edge_us, self.mt_us)
+            self.mt_edges = edges
+            self.mt_us = edge_us
+            self.mt_count = edge_count
+            if elapsed > 0:
+                self.mt_speed = counts * RAD_US_PER_COUNT / elapsed
+            return self.mt_speed
+        bound = COUNTS_PER_EDGE * RAD_US_PER_COUNT / max(1, ticks_diff(now_us, self.mt_us))
+        if self.mt_speed > bound:
+            self.mt_speed = bound
+        elif self.mt_speed < -bound:
+            self.mt_speed = -bound
+        return self.mt_speed
+
+
+class MovingWindow:
+    '''!@brief Moving-window speed filter on integer counts and times
+    @details Keeps the last few count changes and update intervals as integers and gives the
+    speed over the whole window: the sum of the counts over the sum of the times. Nothing is
+    rounded until the one division at the end, so it is an exact average however uneven the
+    intervals are. The history is kept in arrays made once, so an update allocates nothing.
+    Given to an Encoder as its smoothing filter.
+    '''
+    def __init__(self, size=4):
+        '''!@brief Creates a filter averaging over @c size updates'''
+        self.counts = array('l', [0] * size)
+        self.times = array('l', [0] * size)
+        self.idx = 0
+        self.sum_counts = 0
+        self.sum_us = 0
+        return
+
+    def update(self, delta, interval_us):
+        '''!@brief Adds an update to the window and gets the speed over the window
+        @details The product stays inside a small integer while the window holds fewer than
+        about 10000 counts, about 50 rad/s for a window of 4 updates at 50 Hz.
+        @param delta Counts moved since the last update, Encoder.get_delta()
+        @param interval_us Time since the last update in microseconds
+        @return int, radians per second times 256
+        '''
+        idx = self.idx
+        self.sum_counts += delta - self.counts[idx]
+        self.sum_us += interval_us - self.times[idx]
+        self.counts[idx] = delta
+        self.times[idx] = interval_us
+        idx += 1
+        self.idx = 0 if idx == len(self.counts) else idx
+        if self.sum_us <= 0:
+            return 0
+        return self.sum_counts * Q8_RAD_US_PER_COUNT // self.sum_us
+
+
+class AlphaBeta:
+    '''!@brief Fixed-point alpha-beta tracker of an encoder's position and speed
+    @details Predicts the count change from the speed, then corrects the position by
+    @c alpha and the speed by @c beta times the difference from what was counted. The state is
+    kept as small integers: the position as its error from the last count, and the speed in
+    1/256 counts per 1024 us, so an update at the control rate needs no floats. Given to an
+    Encoder as its smoothing filter.
+    '''
+    def __init__(self, alpha=0.5, beta=0.1):
+        '''!@brief Creates a tracker with the given gains, each between 0 and 1'''
+        self.alpha = int(alpha * 256)
+        self.beta = int(beta * 256)
+        self.err = 0  # estimated position minus the last count, 1/256 counts
+        self.vel = 0  # 1/256 counts per 1024 us
+        return
+
+    def update(self, delta, interval_us):
+        '''!@brief Tracks an update and gets the filtered speed
+        @param delta Counts moved since the last update, Encoder.get_delta()
+        @param interval_us Time since the last update in microseconds
+        @return int, radians per second times 256
+        '''
+        if interval_us > 0:
+            resid = (delta << 8) - ((self.vel * interval_us) >> 10) - self.err
+            self.err = -(((256 - self.alpha) * resid) >> 8)
+            self.vel += (((resid << 10) // interval_us) * self.beta) >> 8
+        return (self.vel * AB_Q8) >> 14
@@ -0,0 +1,117 @@
+from time import ticks_us, ticks_diff
+from array import array
+
+
+class State:
+    '''!@brief One state of a StateMachine
+    @details A state has a function run each time the task runs in it, which returns the
+    index of the state to go to next, or None to stay, and optional functions run on the way
+    in and on the way out.
+    '''
+    def __init__(self, name, run, enter=None, exit=None):
+        '''!@brief Creates a state
+        @param name Short name shown by StateMachine.show()
+        @param run Function of no arguments run on each pass through the state
+        @param enter Function of no arguments run when the state is entered, or None
+        @param exit Function of no arguments run when the state is left, or None
+        '''
+        self.name = name
+        self.run = run
+        self.enter = enter
+        self.exit = exit
+
+
+class StateMachine:
+    '''!@brief Table-driven finite state machine for cotask tasks
+    @details States are numbered by their place in the table, and the state to run is found by
+    indexing, however many states there are. Each state's entries, the time spent in it and the
+    transitions out of it are counted in arrays allocated when the machine is made, so they can
+    be kept for a whole run without running out of memory, unlike the transition list of a
+    cotask.Task made with trace=True.
+    '''
+    def __init__(self, states, initial=0, name="fsm"):
+        '''!@brief Creates a state machine from a table of states
+        @param states Sequence of State objects; a state's index is its number
+        @param initial Number of the state to start in
+        @param name Name shown by show()
+        '''
+        self.name = name
+        self.names = tuple(s.name for s in states)
+        self.runs = tuple(s.run for s in states)
+        self.enters = tuple(s.enter for s in states)
+        self.exits = tuple(s.exit for s in states)
+        n = len(states)
+        self.initial = initial
+        self.state = initial
+        self.since = 0
+        ## Number of times each state was entered
+        self.entries = array('L', [0] * n)
+        ## Total time spent in each state in us, up to the last time it was left
+        self.dwell_us = array('L', [0] * n)
+        ## Number of transitions from state i to state j, at index i * n + j
+        self.transitions = array('L', [0] * (n * n))
+
+    def start(self):
+        '''!@brief Enters the initial state
+        @return int, the initial state
+        '''
+        self.state = self.initial
+        self.since = ticks_us()
+        self.entries[self.initial] += 1
+        enter = self.enters[self.initial]
+        if enter is not None:
+            enter()
+        return self.state
+
+    def step(self):
+        '''!@brief Runs the current state once, and goes to the state it asks for
+        @return int, the state the machine is in afterwards
+        '''
+        nxt = self.runs[self.state]()
+        if nxt is not None and nxt != self.state:
+            self.goto(nxt)
+        return self.state
+
+    def goto(self, nxt):
+        '''!@brief Leaves the current state for another, running their exit and enter functions
+        @param nxt Number of the state to go to
+        @return None
+        '''
+        cur = self.state
+        exit = self.exits[cur]
+        if exit is not None:
+            exit()
+        now = ticks_us()
+        self.dwell_us[cur] += ticks_diff(now, self.since)
+        self.transitions[cur * len(self.runs) + nxt] += 1
+        self.entries[nxt] += 1
+        self.state = nxt
+        self.since = now
+        enter = self.enters[nxt]
+        if enter is not None:
+            enter()
+
+    def run(self):
+        '''!@brief Generator which runs the machine once each time it is resumed, for cotask
+        @return generator yielding the current state
+        '''
+        self.start()
+        while True:
+            yield self.step()
+
+    def show(self):
+        '''!@brief Makes a table of each state's entries, time spent and transitions out
+        @details The time includes the time so far in the current state.
+        @return str
+        '''
+        n = len(self.runs)
+        rows = [self.name + ':', '  STATE          ENTRIES  DWELL ms  TO (COUNT)']
+        for i in range(n):
+            dwell = self.dwell_us[i]
+            if i == self.state:
+                dwell += ticks_diff(ticks_us(), self.since)
+            to = ' '.join('{:d}({:d})'.format(j, self.transitions[i * n + j])
+                          for j in range(n) if self.transitions[i * n + j])
+            rows.append('  {:d} {:<12s}{:9d}{:10d}  {:s}'.format(
+                i, self.names[i], self.entries[i], dwell // 1000, to).rstrip())
+        return '\n'.join(rows)
@@ -0,0 +1,152 @@
+'''!@file kernels.py
+!@brief Compiled inner loops for the line sensor and encoders, with pure-Python fallbacks.
+!@details On the board these functions are compiled with the viper code emitter and work on
+raw GPIO registers and int arrays. Anywhere else, which includes the host simulator, the
+plain Python versions below them are used instead. Which set is used is picked once, when
+this module is imported, and VIPER tells which it was.
+'''
+import sys
+from time import ticks_us, ticks_diff
+import micropython
+from micropython import const
+try:
+    import stm  # direct register access on the board
+except ImportError:
+    stm = None
+
+## True if the viper kernels are in use, False for the Python fallbacks
+VIPER = sys.implementation.name == 'micropython' and stm is not None
+## ticks_us() wraps around at this mask on the board
+TICKS_MASK = const(0x3FFFFFFF)
+
+
+def port_of(pin):
+    '''!@brief Finds what discharge() needs to poll a pin
+    @param pin A pyb.Pin
+    @return tuple of the address of the pin's input data register and the pin's bit in it,
+            or of the pin itself and 0 when the Python fallbacks are in use
+    '''
+    if not VIPER:
+        return pin, 0
+    ports = (stm.GPIOA, stm.GPIOB, stm.GPIOC, stm.GPIOD, stm.GPIOE, stm.GPIOF, stm.GPIOG, stm.GPIOH)
+    return ports[pin.port()] + stm.GPIO_IDR, 1 << pin.pin()
+
+
+if VIPER:
+    @micropython.viper
+    def discharge(src, mask, times, timeout: int) -> int:
+        '''!@brief Times the discharge of a set of RC channels already switched to inputs
+        @details Polls every channel's input data register in one loop until all have gone
+        low or the timeout has passed. Channels still high at the timeout read as the timeout.
+        @param src array('L') of each channel's input data register address, from port_of()
+        @param mask array('H') of each channel's bit in its register
+        @param times array('l') which gets each channel's discharge time in us
+        @param timeout Longest time to wait, in us
+        @return bitmask of the channels which timed out
+        '''
+        p_src = ptr32(src)
+        p_mask = ptr16(mask)
+        p_times = ptr32(times)
+        n = int(len(times))
+        waiting = (1 << n) - 1
+        start = int(ticks_us())
+        elapsed = 0
+        while waiting != 0 and elapsed < timeout:
+            elapsed = (int(ticks_us()) - start) & TICKS_MASK
+            i = 0
+            while i < n:
+                bit = 1 << i
+                if (waiting & bit) != 0 and (ptr16(p_src[i])[0] & p_mask[i]) == 0:
+                    p_times[i] = elapsed
+                    waiting ^= bit
+                i += 1
+        i = 0
+        while i < n:
+            if (waiting & (1 << i)) != 0:
+                p_times[i] = timeout
+            i += 1
+        return waiting
+
+    @micropython.viper
+    def discharge_one(src: int, mask: int, timeout: int) -> int:
+        '''!@brief Times the discharge of one RC channel already switched to an input
+        @param src Address of the channel's input data register, from port_of()
+        @param mask The channel's bit in its register
+        @param timeout Longest time to wait, in us
+        @return discharge time in us, or the timeout
+        '''
+        reg = ptr16(src)
+        start = int(ticks_us())
+        elapsed = 0
+        while (reg[0] & mask) != 0 and elapsed < timeout:
+            elapsed = (int(ticks_us()) - start) & TICKS_MASK
+        return elapsed
+
+    @micropython.viper
+    def wrap_delta(count: int, past: int, half: int, span: int) -> int:
+        '''!@brief Change in a timer count since the last reading, across a wrap-around
+        @param count The timer count now
+        @param past The timer count at the last reading
+        @param half Half of the timer's span
+        @param span Number of counts before the timer wraps around
+        @return signed change in counts
+        '''
+        delta = count - past
+        if delta < 0 - half:
+            delta += span
+        elif delta > half:
+            delta -= span
+        return delta
+
+else:
+    def discharge(src, mask, times, timeout):
+        '''!@brief Times the discharge of a set of RC channels already switched to inputs
+        @details The Python version of the viper kernel; it polls each pin with Pin.value().
+        @param src Sequence of the channels' pyb.Pin objects
+        @param mask Not used
+        @param times array('l') which gets each channel's discharge time in us
+        @param timeout Longest time to wait, in us
+        @return bitmask of the channels which timed out
+        '''
+        n = len(times)
+        waiting = (1 << n) - 1
+        start = ticks_us()
+        elapsed = 0
+        while waiting and elapsed < timeout:
+            elapsed = ticks_diff(ticks_us(), start)
+            for i in range(n):
+                if waiting & (1 << i) and not src[i].value():
+                    times[i] = elapsed
+                    waiting &= ~(1 << i)
+        for i in range(n):
+            if waiting & (1 << i):
+                times[i] = timeout
+        return waiting
+
+    def discharge_one(src, mask, timeout):
+        '''!@brief Times the discharge of one RC channel already switched to an input
+        @param src The channel's pyb.Pin
+        @param mask Not used
+        @param timeout Longest time to wait, in us
+        @return discharge time in us, or the timeout
+        '''
+        start = ticks_us()
+        elapsed = 0
+        while src.value() and elapsed < timeout:
+            elapsed = ticks_diff(ticks_us(), start)
+        return elapsed
+
+    def wrap_delta(count, past, half, span):
+        '''!@brief Change in a timer count since the last reading, across a wrap-around
+        @param count The timer count now
+        @param past The timer count at the last reading
+        @param half Half of the timer's span
+        @param span Number of counts before the timer wraps around
+        @return signed change in counts
+        '''
+        delta = count - past
+        if delta < -half:
+            delta += span
+        elif delta > half:
+            delta -= span
+        return delta
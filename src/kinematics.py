@@ -0,0 +1,130 @@
+from array import array
+
+from encoder import Q8
+
+## Half of the track width, in inches
+HALF_TRACK = 2.775
+## Wheel radius, in inches
+WHEEL_RADIUS = 1.375
+## Wheel speed in rad/s per percent of duty cycle at steady state, measured on the Romi
+RAD_S_PER_PERCENT = 0.2528
+## Largest duty cycle magnitude, in percent
+MAX_DUTY = 100
+
+## Fields of a setpoint buffer, in the same order as the first fields of the 'drive' struct
+## in ROMI_tasks, so a whole buffer can go into it with put_all()
+SETPOINT_FIELDS = ('omegaL', 'omegaR', 'dutyL', 'dutyR')
+OMEGA_L = 0
+OMEGA_R = 1
+DUTY_L = 2
+DUTY_R = 3
+
+_maneuvers = {}
+
+
+def clamp(duty, limit=MAX_DUTY):
+    '''!@brief Limits a duty cycle to +/- limit
+    @return float
+    '''
+    if duty > limit:
+        return limit
+    if duty < -limit:
+        return -limit
+    return duty
+
+
+def inverse(speed, yaw_rate, out):
+    '''!@brief Finds the wheel speeds and estimated duty cycles for a body speed and yaw rate
+    @details Nothing is allocated; the results go into @c out, laid out as SETPOINT_FIELDS.
+    The duty cycles are the open-loop estimates from RAD_S_PER_PERCENT, clamped both ways.
+    @param speed Forward speed of the middle of the axle, in in/s
+    @param yaw_rate Turning rate in rad/s, positive CCW
+    @param out Array of at least four floats
+    @return the array @c out
+    '''
+    out[OMEGA_L] = (speed - HALF_TRACK * yaw_rate) / WHEEL_RADIUS
+    out[OMEGA_R] = (speed + HALF_TRACK * yaw_rate) / WHEEL_RADIUS
+    out[DUTY_L] = clamp(out[OMEGA_L] / RAD_S_PER_PERCENT)
+    out[DUTY_R] = clamp(out[OMEGA_R] / RAD_S_PER_PERCENT)
+    return out
+
+
+def maneuver(speed, yaw_rate):
+    '''!@brief Gets the setpoints of a fixed maneuver, working them out only the first time
+    @details The same array is handed back every time the maneuver is asked for, so it must
+    not be written to. Tasks should look up their maneuvers once, before their loops.
+    @param speed Forward speed in in/s
+    @param yaw_rate Turning rate in rad/s, positive CCW
+    @return array of floats laid out as SETPOINT_FIELDS
+    '''
+    key = (speed, yaw_rate)
+    setpoints = _maneuvers.get(key)
+    if setpoints is None:
+        setpoints = inverse(speed, yaw_rate, array('f', [0] * len(SETPOINT_FIELDS)))
+        _maneuvers[key] = setpoints
+    return setpoints
+
+
+def straight(speed):
+    '''!@brief Setpoints for driving straight at a speed in in/s, negative to back up
+    @return array of floats laid out as SETPOINT_FIELDS, from maneuver()
+    '''
+    return maneuver(speed, 0)
+
+
+def spin(yaw_rate):
+    '''!@brief Setpoints for turning in place at a yaw rate in rad/s, positive CCW
+    @return array of floats laid out as SETPOINT_FIELDS, from maneuver()
+    '''
+    return maneuver(0, yaw_rate)
+
+
+def arc(speed, radius, ccw=True):
+    '''!@brief Setpoints for driving round a circle
+    @param speed Forward speed in in/s
+    @param radius Radius of the circle in inches
+    @param ccw True to turn counter-clockwise, False for clockwise
+    @return array of floats laid out as SETPOINT_FIELDS, from maneuver()
+    '''
+    yaw_rate = speed / radius
+    return maneuver(speed, yaw_rate if ccw else -yaw_rate)
+
+
+class MotorMap:
+    '''!@brief Measured duty cycle needed to hold each wheel speed
+    @details A table of steady-state duty cycles at increasing wheel speeds, which takes in
+    the motor's deadband and any bend in its curve that the single RAD_S_PER_PERCENT gain
+    doesn't. Between the points the duty cycle is interpolated, and past the last point the
+    last piece is carried on. Reverse speeds mirror forward ones. The table is kept in Q8
+    integers, so duty_q8() does no float math.
+    '''
+    def __init__(self, speeds, duties):
+        '''!@brief Creates a map from measured points
+        @param speeds Wheel speeds in rad/s, increasing, at least two of them
+        @param duties Duty cycle in percent needed to hold each speed
+        '''
+        self.speeds_q8 = array('l', [round(speed * Q8) for speed in speeds])
+        self.duties_q8 = array('l', [round(duty * Q8) for duty in duties])
+        self.last = len(self.speeds_q8) - 2
+
+    def duty_q8(self, omega_q8):
+        '''!@brief Duty cycle for a wheel speed, both in Q8
+        @param omega_q8 Wheel speed in rad/s times 256
+        @return int, duty cycle in percent times 256
+        '''
+        if omega_q8 == 0:
+            return 0
+        speed = -omega_q8 if omega_q8 < 0 else omega_q8
+        speeds = self.speeds_q8
+        duties = self.duties_q8
+        i = 0
+        while i < self.last and speed > speeds[i + 1]:
+            i += 1
+        duty = duties[i] + (duties[i + 1] - duties[i]) * (speed - speeds[i]) // (speeds[i + 1] - speeds[i])
+        return -duty if omega_q8 < 0 else duty
+
+    def duty(self, omega):
+        '''!@brief Duty cycle in percent for a wheel speed in rad/s
+        @return float
+        '''
+        return self.duty_q8(int(omega * Q8)) / Q8
@@ -12,17 +12,30 @@ import BNO055 as i
 import cotask
 import pyb
 import gc
+import micropython
 import ROMI_tasks as c
 import task_share
 import LineSensor as ls
+import odometry as od
 ##LINE SENSOR PINS:
 #SENSOR NUMBER: 1    2    3    4    5    6    7    8
 #PIN NUMBER:    B2   B1  B15  B14   C0   C1   C2   C3
 
-if __name__ == '__main__':
-    # Establishing Serial Bluetooth Connection
-    uart = s.HC06()
-    uart.estREPL()
+def build(speed=None, task_list=None, fixed=False, coordinated=True, smoothing=None):
+    '''!@brief Creates the Romi's drivers, shares and tasks, and adds the tasks to a task list
+    !@details Everything the scheduler needs is set up here, so the same task graph can be run on
+    the board by the code below or on a workstation by the simulator in the sim package.
+    !@param speed Line following speed in in/s, or None to ask for it at the REPL
+    !@param task_list cotask.TaskList to which the tasks are added, by default cotask.task_list
+    !@param fixed True to run the encoders and wheel speed loops in fixed-point integers
+    !@param coordinated True to control both wheels from one DriveController task, False for a
+    WheelController task for each wheel
+    !@param smoothing A class or function which makes each encoder's speed filter, such as
+    e.MovingWindow or e.AlphaBeta, or None for the unfiltered speeds
+    !@return dict of the objects created, by name
+    '''
+    if task_list is None:
+        task_list = cotask.task_list
 
     # Timer Instantiation and AR and PS Values
     AR = 65535
@@ -35,8 +48,12 @@ if __name__ == '__main__':
     mot_R = m.RomiMotor(tim_R, Pin.cpu.C6, Pin.cpu.C7, Pin.cpu.B0)
 
     # Right and Left Motor Encoder Objects
-    enc_L = e.Encoder(3, Pin.cpu.A6, Pin.cpu.A7, AR, PS)
-    enc_R = e.Encoder(2, Pin.cpu.A0, Pin.cpu.A1, AR, PS)
+    # Edges of channel A are timed too, for a clean speed at low speeds
+    # A smoothing filter, if one is given, takes the place of the edge timing
+    enc_L = e.Encoder(3, Pin.cpu.A6, Pin.cpu.A7, AR, PS, edges=True, fixed=fixed,
+                      smoothing=smoothing() if smoothing else None)
+    enc_R = e.Encoder(2, Pin.cpu.A0, Pin.cpu.A1, AR, PS, edges=True, fixed=fixed,
+                      smoothing=smoothing() if smoothing else None)
 
     # Line Sensor Object
     lsVdd = Pin(Pin.cpu.C4, mode=Pin.OUT_PP)
@@ -47,48 +64,104 @@ if __name__ == '__main__':
     linesens.sensConfig(Pin.cpu.B2, Pin.cpu.B1, Pin.cpu.B15, Pin.cpu.B14,
                         Pin.cpu.C0, Pin.cpu.C1, Pin.cpu.C2, Pin.cpu.C3)
 
+    # IMU for the odometry's heading, if one answers on the bus: Euler angles in radians, the
+    # calibration profile saved on an earlier run if there is one, then the NDOF fusion mode. It
+    # is then read at 50 Hz off timer 5 into the 'imu' struct. Each read still stalls whichever
+    # task it lands in for about 0.8 ms, but the odometry no longer has to wait for one
+    imu = i.BNO055()
+    imu_restored = False
+    try:
+        imu.fusionConfig()
+        imu_restored = imu.restoreCalibration()
+        imu.imuConfig()
+    except OSError:
+        imu = None
+
     # Disable Motors
     mot_L.disable()
     mot_R.disable()
 
     # Motor Control Tasks and Comms Tasks
-    control_L = c.MotL_control(1, mot_L, enc_L)
-    control_R = c.MotR_control(1, mot_R, enc_R)
+    if coordinated:
+        controls = (c.DriveController(mot_L, enc_L, mot_R, enc_R, fixed, name="control"),)
+    else:
+        controls = (c.WheelController(mot_L, enc_L, c.OMEGA_L, c.DUTY_L, fixed, name="control_L"),
+                    c.WheelController(mot_R, enc_R, c.OMEGA_R, c.DUTY_R, fixed, name="control_R"))
     #comms = c.Comms()
-    sense = c.Sensing(linesens)
-
-    # Create shares and queues:
-    dutyL = task_share.Share('f', thread_protect=True, name="dutyL")
-    dutyR = task_share.Share('f', thread_protect=True, name="dutyR")
-    set_omegaL = task_share.Share('f', thread_protect=True, name="set_omegaL")
-    set_omegaR = task_share.Share('f', thread_protect=True, name="set_omegaR")
-    start = task_share.Share('b', thread_protect=True, name="start")
+    sense = c.Sensing(linesens, speed)
+    odometry = od.Odometry(enc_L, enc_R)
+
+    # Create shares and queues: the set speeds, duty cycles and start flag are held in one
+    # struct so a task reads or writes several of them in a single critical section
+    drive = task_share.SharedStruct('f', c.DRIVE_FIELDS, thread_protect=True, name="drive")
+    pose = task_share.SharedStruct('f', od.POSE_FIELDS, thread_protect=True, name="pose")
+    imu_sample = task_share.SharedStruct('i', i.IMU_FIELDS, thread_protect=True, name="imu")
+    # Gains of the wheel loops, which can be changed with c.set_gains() while they run
+    gains = task_share.SharedStruct('i', c.GAIN_FIELDS, thread_protect=True, name="gains")
+    c.set_gains(gains, c.KFF, c.KP, c.KI, c.KP_YAW, c.KI_YAW)
     #omegaL = task_share.Queue('f', 100, thread_protect=True, name="omegaL") #Used queues for testing and debugging
     #omegaR = task_share.Queue('f', 100, thread_protect=True, name="omegaR") #but not in final run.
 
-    # Create the tasks. If trace is enabled for any task, memory will be
-    # allocated for state transition tracing, and the application will run out
-    # of memory after a while and quit. Therefore, use tracing only for
-    # debugging and set trace to False when it's not needed
-    control_L = cotask.Task(control_L.run, name="control_L", priority=2, period=20,
-                            profile=True, trace=False, shares=(dutyL, start, set_omegaL))
-    control_R = cotask.Task(control_R.run, name="control_R", priority=2, period=20,
-                            profile=True, trace=False, shares=(dutyR, start, set_omegaR))
-    sense = cotask.Task(sense.run, name="sense", priority=2, period=100,
-                        profile=True, trace=False, shares=(dutyL, dutyR, start, set_omegaL, set_omegaR))
+    # Create the tasks. Tracing is left off: it allocates memory for each state
+    # transition and the application runs out of memory after a while. Each
+    # task's fsm.StateMachine counts its states in fixed memory instead
+    # The motor loops are run by 50 Hz timer interrupts which latch the encoders at exact
+    # 20 ms intervals; they get a higher priority so a slow sensing pass can't hold them up.
+    # The coordinated loop latches both encoders in one interrupt, on timer 6
+    micropython.alloc_emergency_exception_buf(100)
+    control_tasks = []
+    for control, timer in zip(controls, (6, 7)):
+        control_task = cotask.Task(control.run, name=control.fsm.name, priority=3,
+                                   profile=True, trace=False, shares=(drive, gains), mem_profile=True)
+        control_task.attach_timer(Timer(timer, freq=50), control.sample)
+        control_tasks.append(control_task)
+    sense_task = cotask.Task(sense.run, name="sense", priority=2, period=100,
+                             profile=True, trace=False, shares=(drive, pose))
+    # Odometry runs at the control rate, after the motor tasks have updated the encoders
+    odometry_task = cotask.Task(odometry.run, name="odometry", priority=2, period=20,
+                                profile=True, trace=False, shares=(pose, imu_sample))
+    imu_timer = Timer(5, freq=50)
+    if imu is not None:
+        imu.startSampling(imu_timer, imu_sample)
 
     #Used Comms task for printing during testing and debugging, not in final run.
     # comms = cotask.Task(comms.run, name="comms", priority=1, period=10,
     #                    profile=True, trace=False, shares=(dutyL, dutyR, start, set_omegaL, set_omegaR, omegaL, omegaR))
 
-    cotask.task_list.append(control_L)
-    cotask.task_list.append(control_R)
-    cotask.task_list.append(sense)
+    for control_task in control_tasks:
+        task_list.append(control_task)
+    task_list.append(sense_task)
+    task_list.append(odometry_task)
     gc.collect()  # Run the memory garbage collector to ensure memory is as defragmented as possible
 
+    return {'drive': drive, 'pose': pose, 'gains': gains, 'mot_L': mot_L, 'mot_R': mot_R, 'enc_L': enc_L,
+            'enc_R': enc_R, 'linesens': linesens, 'imu': imu, 'imu_restored': imu_restored,
+            'imu_sample': imu_sample, 'imu_timer': imu_timer,
+            'odometry': odometry, 'controls': controls,
+            'sense': sense, 'task_list': task_list}
+
+
+if __name__ == '__main__':
+    # Establishing Serial Bluetooth Connection
+    uart = s.HC06()
+    uart.estREPL()
+
+    romi = build()
+    mot_L = romi['mot_L']
+    mot_R = romi['mot_R']
+    linesens = romi['linesens']
+    if romi['imu'] is not None:
+        print("IMU calibration profile restored" if romi['imu_restored']
+              else "No IMU calibration profile saved; move the Romi in a figure-8 to calibrate")
+
+    # Calibrate the line sensor while it's swept across the line, for a smooth line position
+    input("Press Enter, then sweep the line sensor back and forth across the line")
+    linesens.calibrate(200)
+    print("Line sensor calibrated" if linesens.calibrated else "Line sensor not calibrated")
+
     # Run the scheduler with the chosen scheduling algorithm. Quit if ^C pressed
     begin = input("Start")
-    start.put(0)
+    romi['drive'].put(c.START, 0)
     while True:
         try:
             cotask.task_list.pri_sched()
@@ -100,3 +173,14 @@ if __name__ == '__main__':
     # Print a table of task data and a table of shared information data
     print('\n' + str(cotask.task_list))
     print(task_share.show_all())
+    for task in romi['controls'] + (romi['sense'],):  # time in and transitions between states
+        print(task.fsm.show())
+    if romi['imu'] is not None:
+        imu = romi['imu']
+        print("IMU samples: {:d}, dropped: {:d}, errors: {:d}, last one {:d} ms old".format(
+            imu.count, imu.drops, imu.errors, i.sampleAge(romi['imu_sample'])))
+        # Keep a full calibration for next time, so the heading is usable soon after start
+        if not romi['imu_restored'] and i.headingReady(romi['imu_sample'].get(i.IMU_CALIB)):
+            imu.stopSampling(romi['imu_timer'])
+            imu.saveCalibration()
+            print("IMU calibration profile saved")
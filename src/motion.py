@@ -0,0 +1,147 @@
+from time import ticks_ms, ticks_diff
+import math
+
+import kinematics as k
+import odometry as o
+
+## Default acceleration of straight and arc segments, in in/s^2
+ACCEL = 12
+## Default angular acceleration of spins, in rad/s^2
+SPIN_ACCEL = 8
+## How often Segment.step() is called, in ms; the speed ramps look this far ahead, so that
+## the first step already moves and the last doesn't overshoot
+STEP_MS = 100
+
+
+def trapezoid_ms(length, speed, accel, start_speed=0, end_speed=0):
+    '''!@brief Time taken to cover a length with a trapezoidal speed profile
+    @details If the length is too short to reach the top speed, the profile is a triangle
+    with a lower peak.
+    @param length Distance or angle to cover
+    @param speed Top speed, in the same units per second
+    @param accel Acceleration and deceleration, in the same units per second squared
+    @param start_speed, end_speed Speeds at the two ends, no greater than speed
+    @return int, milliseconds
+    '''
+    up = (speed * speed - start_speed * start_speed) / (2 * accel)
+    down = (speed * speed - end_speed * end_speed) / (2 * accel)
+    if up + down > length:
+        speed = math.sqrt(accel * length + (start_speed * start_speed + end_speed * end_speed) / 2)
+        up = (speed * speed - start_speed * start_speed) / (2 * accel)
+        down = (speed * speed - end_speed * end_speed) / (2 * accel)
+    seconds = ((speed - start_speed) + (speed - end_speed)) / accel + (length - up - down) / speed
+    return int(1000 * seconds)
+
+
+class Segment:
+    '''!@brief One leg of a maneuver driven with a trapezoidal speed profile
+    @details A segment is a straight, an arc or a spin in place. Its speed ramps up with
+    time from the start and ramps down with the length left, which is measured by the
+    odometry, so the wheels are never asked to jump from one speed to another and the leg
+    ends where it should however the ramps went. Without a pose, the length covered is
+    worked out from the speeds asked for. step() ends the leg once the length left is less
+    than half a step's travel at the speed now asked for, or after twice the time its profile
+    should take, in case the odometry stops changing.
+    '''
+    def __init__(self, length, speed, accel, curvature=0, spin=False, end_speed=0):
+        '''!@brief Creates a segment; straight(), arc() and spin() are easier to use
+        @param length Distance in inches, or angle in radians for a spin, always positive
+        @param speed Top speed in in/s, or yaw rate in rad/s for a spin; negative to back
+        up or to turn CW
+        @param accel Acceleration in in/s^2, or rad/s^2 for a spin
+        @param curvature Yaw rate per unit of speed, 1/radius, positive to turn CCW
+        @param spin True to turn in place
+        @param end_speed Speed, no greater than speed, at which to hand over to what comes next
+        '''
+        self.length = length
+        self.speed = abs(speed)
+        self.sign = -1 if speed < 0 else 1
+        self.accel = accel
+        self.curvature = curvature
+        self.spin = spin
+        self.end_speed = abs(end_speed)
+        self.field = o.HEADING if spin else o.DIST
+        self.nominal_ms = trapezoid_ms(length, self.speed, accel, 0, self.end_speed)
+        self.begin = 0
+        self.last = 0
+        self.done = 0
+        self.now_speed = 0
+        return
+
+    def start(self, pose, mark):
+        '''!@brief Begins the segment from the current pose
+        @param pose The pose SharedStruct, or None
+        @param mark Array into which the pose at the start is copied
+        @return None
+        '''
+        if pose is not None:
+            pose.get_all(mark)
+        self.begin = ticks_ms()
+        self.last = self.begin
+        self.done = 0
+        self.now_speed = 0
+        return
+
+    def speed_at(self, elapsed_ms, left):
+        '''!@brief Speed of the profile at a time after the start with some length left to go
+        @details Both ramps are worked out for the time of the next step, when this speed
+        will be replaced.
+        @return float, the magnitude of the speed
+        '''
+        speed = self.accel * (elapsed_ms + STEP_MS) / 1000
+        if speed > self.speed:
+            speed = self.speed
+        left -= self.now_speed * STEP_MS / 1000
+        if left <= 0:
+            return self.end_speed
+        down = math.sqrt(self.end_speed * self.end_speed + 2 * self.accel * left)
+        return down if down < speed else speed
+
+    def step(self, pose, here, mark, out):
+        '''!@brief Moves the segment on and finds the wheel setpoints for now
+        @param pose The pose SharedStruct, or None
+        @param here Array to read the pose into
+        @param mark Array holding the pose at the start, from start()
+        @param out Setpoint buffer laid out as kinematics.SETPOINT_FIELDS
+        @return bool, True once the segment is finished; the setpoints are then those of the
+                end speed
+        '''
+        now = ticks_ms()
+        if pose is None:
+            self.done += self.now_speed * ticks_diff(now, self.last) / 1000
+        else:
+            pose.get_all(here)
+            self.done = abs(here[self.field] - mark[self.field])
+        self.last = now
+        elapsed = ticks_diff(now, self.begin)
+        left = self.length - self.done
+        # Finish now if that's nearer the end than going on for another step would be
+        finished = left <= self.now_speed * STEP_MS / 2000 or elapsed >= 2 * self.nominal_ms
+        self.now_speed = self.end_speed if finished else self.speed_at(elapsed, left)
+        speed = self.sign * self.now_speed
+        if self.spin:
+            k.inverse(0, speed, out)
+        else:
+            k.inverse(speed, speed * self.curvature, out)
+        return finished
+
+
+def straight(length, speed, accel=ACCEL, end_speed=0):
+    '''!@brief A straight segment of length inches at up to speed in/s, negative to back up
+    @return Segment
+    '''
+    return Segment(length, speed, accel, end_speed=end_speed)
+
+
+def arc(length, speed, radius, ccw=True, accel=ACCEL, end_speed=0):
+    '''!@brief A segment of length inches along a circle of radius inches
+    @return Segment
+    '''
+    return Segment(length, speed, accel, curvature=(1 if ccw else -1) / radius, end_speed=end_speed)
+
+
+def spin(angle, rate, accel=SPIN_ACCEL):
+    '''!@brief A turn in place through angle radians at up to rate rad/s, positive CCW
+    @return Segment
+    '''
+    return Segment(angle, rate, accel, spin=True)
@@ -0,0 +1,185 @@
+from time import ticks_ms, ticks_diff
+from array import array
+import math
+
+from encoder import RAD_PER_COUNT
+from kinematics import HALF_TRACK, WHEEL_RADIUS
+import BNO055 as bno
+
+## Inches travelled by a wheel per encoder count
+IN_PER_COUNT = RAD_PER_COUNT * WHEEL_RADIUS
+
+## Fields of the pose struct, and their indices
+POSE_FIELDS = ('x', 'y', 'heading', 'dist')
+X = 0
+Y = 1
+HEADING = 2
+DIST = 3
+
+
+def wrap(angle):
+    '''!@brief Wraps an angle into -pi to pi
+    @return float
+    '''
+    return (angle + math.pi) % (2 * math.pi) - math.pi
+
+
+class Odometry:
+    '''!@brief Dead reckoning of the Romi's pose from both wheel encoders, with IMU heading
+    @details Integrates the change in each wheel's encoder position into x and y in inches and
+    heading in radians, CCW from the heading at start. Heading is not wrapped, so a turn can be
+    measured by subtracting two headings. The distance travelled along the robot's path, signed
+    so backing up counts down, is kept as well. The BNO055's fused yaw is blended into the
+    heading with a complementary filter, which takes out the drift from wheel slip. The yaw
+    comes either from the 'imu' struct filled by BNO055.startSampling(), when the task is given
+    one, or from a read of the BNO055 by this task.
+    '''
+    def __init__(self, enc_L, enc_R, imu=None, alpha=0.98, imu_every=1, max_age_ms=100):
+        '''!@brief Creates an odometry object for a pair of encoders
+        @param enc_L, enc_R Encoder objects of the left and right wheels; their positions are
+        read, not updated, so the motor tasks can keep updating them
+        @param imu A configured BNO055 in a fusion mode, or None for the encoders alone
+        @param alpha Weight kept by the encoder heading each time the IMU yaw is blended in
+        @param imu_every Read the IMU once in this many updates; one burst read is short
+        enough to do on every update
+        @param max_age_ms Samples from the 'imu' struct older than this are not used
+        Samples are also not used until the IMU reports its gyroscope and magnetometer fully
+        calibrated, which with a restored calibration profile is soon after start.
+        '''
+        self.enc_L = enc_L
+        self.enc_R = enc_R
+        self.imu = imu
+        self.alpha = alpha
+        self.imu_every = imu_every
+        self.x = 0
+        self.y = 0
+        self.heading = 0
+        self.dist = 0
+        self.last_L = 0
+        self.last_R = 0
+        self.max_age_ms = max_age_ms
+        self.yaw0 = None
+        self.imu_errors = 0
+        self.imu_stale = 0
+        self.imu_uncal = 0
+        self.imu_in = array('i', [0] * len(bno.IMU_FIELDS))
+        self.pose_out = array('f', [0] * len(POSE_FIELDS))  # filled by publish(), so it allocates nothing
+        self.last_count = 0
+        return
+
+    def zero(self):
+        '''!@brief Sets the pose back to the origin and takes the wheels' current positions as
+        the starting point
+        @return None
+        '''
+        self.x = 0
+        self.y = 0
+        self.heading = 0
+        self.dist = 0
+        self.last_L = self.enc_L.pos
+        self.last_R = self.enc_R.pos
+        self.yaw0 = None
+        return
+
+    def update(self):
+        '''!@brief Moves the pose on by the wheel travel since the last update
+        @details The change in heading is taken from the difference between the wheels, and
+        x and y move along the heading half way through the step.
+        @return None
+        '''
+        pos_L = self.enc_L.pos
+        pos_R = self.enc_R.pos
+        d_L = (pos_L - self.last_L) * IN_PER_COUNT
+        d_R = (pos_R - self.last_R) * IN_PER_COUNT
+        self.last_L = pos_L
+        self.last_R = pos_R
+        ds = (d_L + d_R) / 2
+        dtheta = (d_R - d_L) / (2 * HALF_TRACK)
+        mid = self.heading + dtheta / 2
+        self.x += ds * math.cos(mid)
+        self.y += ds * math.sin(mid)
+        self.heading += dtheta
+        self.dist += ds
+        return
+
+    def correct(self):
+        '''!@brief Reads the IMU and blends its yaw into the heading
+        @details This blocks for the I2C transfer; see correct_from() for the non-blocking way.
+        @return None
+        '''
+        try:
+            self.imu.readAll()
+        except OSError:
+            self.imu_errors += 1
+            return
+        self.blend(-self.imu.getEulX())
+        return
+
+    def correct_from(self, sample):
+        '''!@brief Blends the yaw from an 'imu' struct into the heading, if it's new and fresh
+        @details A sample already used is skipped, and one older than max_age_ms is counted in
+        imu_stale and skipped, so the heading never leans on old data. So is one taken before
+        the IMU was calibrated, counted in imu_uncal.
+        @param sample A SharedStruct with the fields in BNO055.IMU_FIELDS
+        @return None
+        '''
+        sample.get_all(self.imu_in)
+        if self.imu_in[bno.IMU_COUNT] == self.last_count:
+            return
+        self.last_count = self.imu_in[bno.IMU_COUNT]
+        if ticks_diff(ticks_ms(), self.imu_in[bno.IMU_STAMP]) > self.max_age_ms:
+            self.imu_stale += 1
+            return
+        if not bno.headingReady(self.imu_in[bno.IMU_CALIB]):
+            self.imu_uncal += 1
+            return
+        self.blend(-self.imu_in[bno.IMU_HEADING] / bno.RAD_SCALE)
+        return
+
+    def blend(self, yaw):
+        '''!@brief Blends a yaw from the IMU into the heading
+        @details The BNO055 heading grows clockwise, so it comes in negated, and it is taken
+        relative to the first reading. The error from the current heading is wrapped, so the
+        filter turns the short way however many times the robot has gone round.
+        @param yaw IMU yaw in radians, CCW
+        @return None
+        '''
+        if self.yaw0 is None:
+            self.yaw0 = yaw - self.heading
+        self.heading += (1 - self.alpha) * wrap(yaw - self.yaw0 - self.heading)
+        return
+
+    def publish(self, pose):
+        '''!@brief Writes the pose into a SharedStruct with the fields in POSE_FIELDS
+        @return None
+        '''
+        out = self.pose_out
+        out[X] = self.x
+        out[Y] = self.y
+        out[HEADING] = self.heading
+        out[DIST] = self.dist
+        pose.put_all(out)
+        return
+
+    def run(self, shares):
+        '''!@brief Runs the odometry task
+        @details Updates the pose from the encoders on every run, and from the IMU, then
+        publishes it. With an 'imu' struct, each new sample in it is used; otherwise, if there is
+        an IMU, it is read on every imu_every'th run.
+        @shares a tuple holding the 'pose' SharedStruct, and optionally the 'imu' SharedStruct
+        '''
+        pose = shares[0]
+        sample = shares[1] if len(shares) > 1 else None
+        self.zero()
+        count = 0
+        while True:
+            self.update()
+            if sample is not None:
+                self.correct_from(sample)
+            elif self.imu is not None:
+                count += 1
+                if count >= self.imu_every:
+                    count = 0
+                    self.correct()
+            self.publish(pose)
+            yield 0
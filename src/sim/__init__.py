@@ -0,0 +1,65 @@
+'''!@file __init__.py
+!@brief Host-side stand-ins for the Micropython modules used by the Romi code.
+!@details Call @c install() before importing any of the Romi modules on a workstation;
+it puts the stand-ins into @c sys.modules under the names the board uses and adds the
+Micropython ticks functions to the @c time module, so that @c cotask, @c task_share and
+the rest import unchanged. All of the stand-ins share the virtual clock in
+@c sim.clock.
+'''
+import gc
+import sys
+import time
+import tracemalloc
+
+from sim.clock import clock
+from sim import utime, micropython, pyb
+
+
+def install():
+    '''!@brief Makes the stand-ins importable under their Micropython names.
+    @return The virtual clock used by the stand-ins
+    '''
+    sys.modules['utime'] = utime
+    sys.modules['micropython'] = micropython
+    sys.modules['pyb'] = pyb
+    for name in ('ticks_us', 'ticks_ms', 'ticks_cpu', 'ticks_add',
+                 'ticks_diff', 'sleep_us', 'sleep_ms'):
+        setattr(time, name, getattr(utime, name))
+    if not hasattr(gc, 'mem_alloc'):
+        gc.mem_alloc = mem_alloc
+        gc.mem_free = mem_free
+    return clock
+
+
+def reset():
+    '''!@brief Starts a fresh simulation.
+    @details Sets the clock back to zero and forgets every pin, timer, I2C device and share,
+    so that the Romi can be built again from scratch, as in a batch of runs.
+    @return None
+    '''
+    clock.reset()
+    pyb.Pin.pins.clear()
+    pyb.Timer.timers.clear()
+    pyb.I2C.buses.clear()
+    task_share = sys.modules.get('task_share')
+    if task_share is not None:
+        del task_share.share_list[:]
+    return
+
+
+def mem_alloc():
+    '''!@brief Stand-in for @c gc.mem_alloc(): bytes allocated by Python code.
+    @details Only counts anything while @c tracemalloc is tracing; call
+    @c tracemalloc.start() to measure allocations on the host.
+    @return int
+    '''
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return 0
+
+
+def mem_free():
+    '''!@brief Stand-in for @c gc.mem_free(); the host has no fixed heap, so this is large.
+    @return int
+    '''
+    return 1 << 30
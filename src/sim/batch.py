@@ -0,0 +1,111 @@
+'''!@file batch.py
+!@brief Runs many simulated course runs of the Romi to trade speed against completion.
+!@details Each run builds a fresh Romi with main.build() on the host stand-ins, puts it on
+the course with a little random error in its starting pose and motor gains, and runs the
+scheduler until the robot reaches the end of the line, wanders too far from it, or runs out
+of time. The default course has a wall on it, so each run also drives round the wall; the
+robot isn't counted as lost while it does. Runs can be spread over several processes.
+
+Run from the @c src directory with
+@c python -m sim.batch [runs per speed] [speed] [speed] ...
+'''
+import contextlib
+import io
+import math
+import random
+import sys
+import time as host_time
+
+import sim
+
+clock = sim.install()
+import cotask
+import main
+from sim import pyb
+from sim.plant import Plant, Course, BNO055Model, RAD_S_PER_PERCENT, IMU_BUS, IMU_ADDR
+
+## A run fails if the robot gets this far from the line, in inches
+LOST_DISTANCE = 8.0
+## States of the sense task which drive round the wall, away from the line
+DETOUR_STATES = ('BACKUP', 'PIVOT', 'AROUND', 'APPROACH')
+
+
+def course_run(speed, seed=0, seconds=90, course=None, pose_noise=0.3, gain_noise=0.05):
+    '''!@brief Runs the Romi along a course once.
+    @param speed Line following speed in in/s
+    @param seed Seed for the random errors in the starting pose and motor gains
+    @param seconds Longest simulated time to allow
+    @param course The Course to run, by default Course.default()
+    @param pose_noise Standard deviation of the starting offset (in) and heading (rad / 10)
+    @param gain_noise Standard deviation of the fractional error in each motor's gain
+    @return tuple of whether the run finished, the time taken in seconds, and the greatest
+            distance from the line in inches, not counting the drive round the wall
+    '''
+    rng = random.Random(seed)
+    sim.reset()
+    tasks = cotask.TaskList()
+    imu = BNO055Model()
+    pyb.I2C.attach(IMU_BUS, IMU_ADDR, imu)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sense = main.build(speed, tasks)['sense']
+        plant = Plant(course, y=rng.gauss(0, pose_noise), heading=rng.gauss(0, pose_noise / 10),
+                      left_gain=RAD_S_PER_PERCENT * (1 + rng.gauss(0, gain_noise)),
+                      right_gain=RAD_S_PER_PERCENT * (1 + rng.gauss(0, gain_noise)), imu=imu)
+        end_us = int(seconds * 1000000)
+        check_us = 0
+        worst = 0.0
+        while clock.now_us < end_us:
+            tasks.heap_sched(idle=True)
+            if clock.now_us >= check_us:
+                check_us = clock.now_us + 100000
+                plant.sync(clock.now_us)
+                dist, progress = plant.progress()
+                if sense.fsm.names[sense.fsm.state] not in DETOUR_STATES:
+                    worst = max(worst, dist)
+                    if dist > LOST_DISTANCE:
+                        return False, clock.now_us / 1000000, worst
+                if progress >= plant.course.length - 1:
+                    return True, clock.now_us / 1000000, worst
+    return False, seconds, worst
+
+
+def _run_args(args):
+    return args[0], course_run(*args)
+
+
+def batch(speeds, runs=20, processes=1, seconds=90):
+    '''!@brief Runs the course many times at each speed and prints a summary table.
+    @param speeds Line following speeds to try, in in/s
+    @param runs Number of runs at each speed, each with different random errors
+    @param processes Number of processes to spread the runs over
+    @param seconds Longest simulated time to allow for each run
+    @return dict of speed to a list of (finished, time, worst distance) results
+    '''
+    jobs = [(speed, seed, seconds) for speed in speeds for seed in range(runs)]
+    start = host_time.perf_counter()
+    if processes > 1:
+        import multiprocessing
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(_run_args, jobs)
+    else:
+        results = [_run_args(job) for job in jobs]
+    host_s = host_time.perf_counter() - start
+
+    by_speed = {}
+    for speed, result in results:
+        by_speed.setdefault(speed, []).append(result)
+    print('SPEED  RUNS  DONE %  MEAN TIME  WORST OFF')
+    for speed in speeds:
+        done = [r for r in by_speed[speed] if r[0]]
+        mean = sum(r[1] for r in done) / len(done) if done else math.nan
+        worst = max(r[2] for r in by_speed[speed])
+        print('{:5.1f}{:6d}{:8.1f}{:11.2f}{:11.2f}'.format(
+            speed, len(by_speed[speed]), 100 * len(done) / len(by_speed[speed]), mean, worst))
+    print('{:d} runs in {:.1f} s of host time'.format(len(jobs), host_s))
+    return by_speed
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    speeds = [float(arg) for arg in sys.argv[2:]] or [4.0, 6.0, 8.0]
+    batch(speeds, runs)
@@ -0,0 +1,111 @@
+'''!@file bench_sched.py
+!@brief Compares the @c cotask schedulers on the host using the virtual clock.
+!@details Builds a task list shaped like the one in main.py (two 20 ms motor tasks and
+a 100 ms sensing task, each using up some time when it runs) and runs it under
+@c rr_sched, @c pri_sched and @c heap_sched for the same stretch of simulated time.
+Reading the clock costs no simulated time here, so every scheduler sees the same task
+timing; instead, each call which runs no task and doesn't sleep is charged SPIN_US.
+For each scheduler it prints how many times the scheduler was called, how many of the
+calls ran no task, and how many times per call the clock was read (@c ticks_us() and
+the like) and a task's @c ready() was called, which is the work a scheduler does to
+find out what to run. The host time taken is printed too, but it mostly measures the
+Python overhead of the stand-ins.
+
+Run from the @c src directory with @c python -m sim.bench_sched
+'''
+import sys
+import time as host_time
+
+import sim
+
+clock = sim.install()
+clock.read_cost_us = 0
+import cotask
+
+## Simulated time charged for a scheduler call which ran no task and didn't sleep
+SPIN_US = 10
+
+
+def worker(cost_us):
+    '''!@brief Makes a task function which uses up @c cost_us each time it runs.'''
+    def run():
+        state = 0
+        while True:
+            clock.advance(cost_us)
+            state = 1 - state
+            yield state
+    return run
+
+
+def build():
+    '''!@brief Makes a task list like the one used on the Romi.
+    @return cotask.TaskList
+    '''
+    tasks = cotask.TaskList()
+    tasks.append(cotask.Task(worker(300), name="control_L", priority=2,
+                             period=20, profile=True))
+    tasks.append(cotask.Task(worker(300), name="control_R", priority=2,
+                             period=20, profile=True))
+    tasks.append(cotask.Task(worker(4000), name="sense", priority=2,
+                             period=100, profile=True))
+    return tasks
+
+
+def count_ready(tasks):
+    '''!@brief Makes each task in a list count the calls to its ready() method.
+    @return list holding the count, which goes up as the tasks are asked
+    '''
+    count = [0]
+    for pri in tasks.pri_list:
+        for task in pri[2:]:
+            def ready(ready=task.ready):
+                count[0] += 1
+                return ready()
+            task.ready = ready
+    return count
+
+
+def bench(name, sim_seconds):
+    '''!@brief Runs one scheduler for the given simulated time and prints its figures.
+    @param name Which scheduler: @c rr, @c pri, @c heap or @c heap_idle
+    @param sim_seconds Simulated time to run for
+    @return None
+    '''
+    clock.reset()
+    tasks = build()
+    if name == 'rr':
+        sched = tasks.rr_sched
+    elif name == 'pri':
+        sched = tasks.pri_sched
+    elif name == 'heap':
+        sched = tasks.heap_sched
+    else:
+        sched = lambda: tasks.heap_sched(idle=True)
+
+    readies = count_ready(tasks)
+    end_us = sim_seconds * 1000000
+    calls = 0
+    idle = 0
+    start = host_time.perf_counter()
+    while clock.now_us < end_us:
+        runs = sum(task._runs for pri in tasks.pri_list for task in pri[2:])
+        before = clock.now_us
+        sched()
+        calls += 1
+        if sum(task._runs for pri in tasks.pri_list for task in pri[2:]) == runs:
+            idle += 1
+            if clock.now_us == before:
+                clock.advance(SPIN_US)
+    host_s = host_time.perf_counter() - start
+
+    runs = sum(task._runs for pri in tasks.pri_list for task in pri[2:])
+    print(f"{name:<10s}{calls: 10d}{idle: 10d}{runs: 7d}{clock.reads / calls: 11.2f}"
+          f"{readies[0] / calls: 11.2f}{clock.reads: 11d}{readies[0]: 11d}{host_s: 9.3f}")
+
+
+if __name__ == '__main__':
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    print('SCHED          CALLS      IDLE   RUNS   RDS/CALL READY/CALL  CLOCK RDS'
+          '    READIES   HOST S')
+    for name in ('rr', 'pri', 'heap', 'heap_idle'):
+        bench(name, seconds)
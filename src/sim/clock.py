@@ -0,0 +1,165 @@
+'''!@file clock.py
+!@brief Virtual microsecond clock used by the host-side Micropython stand-ins.
+!@details Every stand-in which needs the time reads it from the one clock object
+in this module, so code being simulated sees a single consistent time base. The
+clock only moves when something advances it: sleeping, a simulated plant, or the
+small cost charged for each reading of the time. The cost keeps busy-wait loops
+such as @c while @c not @c ready: @c pass moving forward instead of hanging.
+
+The clock also stands in for the interrupt controller: periodic events, such as a
+timer's callback, are run at their due times as the clock passes them. Models of the
+hardware register sync functions, which the stand-ins call before reading or
+changing anything the model depends on, so each model is brought up to date only
+when it matters. Functions scheduled from an event, as with @c micropython.schedule,
+run once the event has returned.
+'''
+
+## Micropython's ticks counters wrap around at this value
+TICKS_PERIOD = 1 << 30
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+## Depth of Micropython's queue of scheduled functions
+SCHEDULE_DEPTH = 4
+
+
+class VirtualClock:
+    '''!@brief A clock which advances only when told to.
+    @details Keeps an unwrapped time in microseconds and counts how many times the
+    time has been read, which is useful when comparing how hard different pieces
+    of code lean on the clock.
+    '''
+    def __init__(self, read_cost_us=1):
+        '''!@brief Creates a clock starting at time zero.
+        @param read_cost_us Microseconds by which each reading advances the clock
+        '''
+        self.now_us = 0
+        self.read_cost_us = read_cost_us
+        self.reads = 0
+        self._events = []
+        self._syncs = []
+        self._pending = []
+        self._in_isr = False
+        return
+
+    def reset(self):
+        '''!@brief Sets the time and the count of readings back to zero.
+        @details Also forgets all periodic events and sync functions, ready for a new run.
+        @return None
+        '''
+        self.now_us = 0
+        self.reads = 0
+        self._events = []
+        self._syncs = []
+        self._pending = []
+        self._in_isr = False
+        return
+
+    def advance(self, us):
+        '''!@brief Moves the clock forward, running any events which come due on the way.
+        @param us Number of microseconds to move forward; negative values are ignored
+        @return None
+        '''
+        if us > 0:
+            self._move_to(self.now_us + int(us))
+        return
+
+    def read_us(self):
+        '''!@brief Reads the unwrapped time, charging the cost of a reading.
+        @return int
+        '''
+        self.reads += 1
+        self._move_to(self.now_us + self.read_cost_us)
+        return self.now_us
+
+    def every(self, period_us, func):
+        '''!@brief Runs a function periodically, as a timer interrupt would.
+        @param period_us Time between calls in microseconds
+        @param func Function called with no arguments
+        @return A handle which can be given to cancel()
+        '''
+        period_us = int(period_us)
+        event = [self.now_us + period_us, period_us, func]
+        self._events.append(event)
+        return event
+
+    def at(self, time_us, func):
+        '''!@brief Runs a function once at a given time, as a one-shot interrupt would.
+        @param time_us Unwrapped time at which to call it, in microseconds
+        @param func Function called with no arguments
+        @return A handle which can be given to cancel()
+        '''
+        event = [max(int(time_us), self.now_us), 0, func]
+        self._events.append(event)
+        return event
+
+    def cancel(self, event):
+        '''!@brief Stops a periodic event started by every().
+        @return None
+        '''
+        if event in self._events:
+            self._events.remove(event)
+        return
+
+    def schedule(self, func, arg):
+        '''!@brief Runs a function once the current event has returned, or at once outside one.
+        @return None
+        @exception RuntimeError if the queue is full, as on the board
+        '''
+        if not self._in_isr:
+            func(arg)
+            return
+        if len(self._pending) >= SCHEDULE_DEPTH:
+            raise RuntimeError('schedule queue full')
+        self._pending.append((func, arg))
+        return
+
+    def add_sync(self, func):
+        '''!@brief Registers a function to be called with the time whenever sync() is called.
+        @return None
+        '''
+        self._syncs.append(func)
+        return
+
+    def sync(self):
+        '''!@brief Brings every registered model up to the current time.
+        @return None
+        '''
+        for func in self._syncs:
+            func(self.now_us)
+        return
+
+    def _move_to(self, target):
+        '''!@brief Moves the clock to a time, stopping at each event due on the way to run it.
+        @details An event's function may itself read or advance the clock; events aren't
+        nested, just as an interrupt isn't interrupted by one of the same priority.
+        @return None
+        '''
+        if self._events and not self._in_isr:
+            self._in_isr = True
+            while True:
+                first = None
+                for event in self._events:
+                    if event[0] <= target and (first is None or event[0] < first[0]):
+                        first = event
+                if first is None:
+                    break
+                if first[0] > self.now_us:
+                    self.now_us = first[0]
+                if first[1]:
+                    first[0] += first[1]
+                else:
+                    self._events.remove(first)
+                first[2]()
+                if self.now_us > target:
+                    target = self.now_us
+            self._in_isr = False
+            while self._pending and not self._in_isr:
+                func, arg = self._pending.pop(0)
+                func(arg)
+        if target > self.now_us:
+            self.now_us = target
+        return
+
+
+## The clock shared by all of the stand-in modules
+clock = VirtualClock()
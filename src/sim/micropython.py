@@ -0,0 +1,35 @@
+'''!@file micropython.py
+!@brief Host stand-in for the Micropython @c micropython module.
+!@details The code emitters are replaced by decorators which leave functions as they
+are, so code written for the board runs unchanged under CPython.
+'''
+from sim.clock import clock
+
+
+def native(func):
+    '''!@brief Stand-in for the native code emitter; returns the function unchanged.'''
+    return func
+
+
+def viper(func):
+    '''!@brief Stand-in for the viper code emitter; returns the function unchanged.'''
+    return func
+
+
+def const(value):
+    '''!@brief Stand-in for compile-time constants; returns the value.'''
+    return value
+
+
+def alloc_emergency_exception_buf(size):
+    '''!@brief Nothing needs to be reserved on the host.'''
+    return
+
+
+def schedule(func, arg):
+    '''!@brief Runs a function which the board would run soon after an interrupt.
+    @details Called from a timer callback, the function waits until the callback returns;
+    called from anywhere else, it runs at once.
+    '''
+    clock.schedule(func, arg)
+    return True
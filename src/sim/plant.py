@@ -0,0 +1,337 @@
+'''!@file plant.py
+!@brief Differential-drive model of the Romi which closes the loop with the tasks.
+!@details A Plant is attached to the pins and timers created by main.build() on the host
+stand-ins. As the virtual clock moves it drives each wheel's speed from the PWM duty cycle
+and direction pin of its RomiMotor, through a first-order motor model, and writes the wheel
+angle into the encoder timer's count. The robot's pose is integrated from the wheel speeds
+using the same geometry as kinematics.py, a 2.775 in half-track and 1.375 in wheel radius.
+Each line sensor channel discharges quickly or slowly depending on whether the course under
+it is white or black, and the bump switches close when the bumper reaches a wall. A
+BNO055Model can be attached to the I2C bus to report the robot's heading and yaw rate.
+'''
+import math
+import struct
+
+from sim.clock import clock
+from sim import pyb
+
+## Half of the track width, in inches
+HALF_TRACK = 2.775
+## Wheel radius, in inches
+WHEEL_RADIUS = 1.375
+## Encoder counts per wheel revolution
+COUNTS_PER_REV = 16384
+## Wheel speed in rad/s per percent of duty cycle at steady state, as assumed in kinematics
+RAD_S_PER_PERCENT = 0.2528
+
+## Line sensor pins, sensor 1 to 8, as connected in main.py; sensor 1 is on the left
+SENSOR_PINS = ('B2', 'B1', 'B15', 'B14', 'C0', 'C1', 'C2', 'C3')
+## Spacing of the QTR-8RC channels, in inches
+SENSOR_PITCH = 0.375
+## Distance of the line sensor ahead of the wheel axle, in inches
+SENSOR_AHEAD = 2.8
+## Discharge times in microseconds over white and over black
+WHITE_US = 400
+BLACK_US = 6000
+## Bump switch pins, left and right
+BUMP_PINS = ('C12', 'C9')
+## Distance of the bumper ahead of the wheel axle, and its half width, in inches
+BUMPER_AHEAD = 3.6
+BUMPER_HALF_WIDTH = 2.5
+## I2C bus and address of the BNO055
+IMU_BUS = 2
+IMU_ADDR = 0x28
+
+
+class Course:
+    '''!@brief A course: a black line drawn along a path of straight pieces, and walls.
+    @details The line is a polyline of (x, y) points in inches with a given width. Walls are
+    rectangles (xmin, ymin, xmax, ymax). Progress along the course is the distance along the
+    line to the point nearest the robot.
+    '''
+    def __init__(self, points, line_width=0.75, walls=()):
+        '''!@brief Creates a course from the points along its line.'''
+        self.points = [(float(x), float(y)) for x, y in points]
+        self.line_width = line_width
+        self.walls = list(walls)
+        self.starts = [0.0]
+        for (x0, y0), (x1, y1) in zip(self.points, self.points[1:]):
+            self.starts.append(self.starts[-1] + math.hypot(x1 - x0, y1 - y0))
+        self.length = self.starts[-1]
+        return
+
+    @classmethod
+    def default(cls):
+        '''!@brief A course with a left curve, a right curve, a tight left turn, and a wall.
+        @details The wall stands on the line 15 in after the tight turn, so the robot bumps
+        it heading up the y axis with its axle at (85, 100). From under the wall the line
+        bends right to meet the path of the drive round the wall in ROMI_tasks.Sensing (back
+        up, pivot right, arc left, straight) where its arc ends, about 10 in on and 33 in to
+        the right of the bump, and carries on along it.
+        @return Course
+        '''
+        points = [(0, 0), (30, 0)]
+        points += arc_points((30, 20), 20, -90, 0, 10)
+        points += [(50, 40)]
+        points += arc_points((65, 40), 15, 180, 90, 10)
+        points += [(75, 55)]
+        points += arc_points((75, 65), 10, -90, 0, 10)
+        points += [(85, 85)]
+        # Beyond the wall the line runs out from under it to where the arc round the wall
+        # ends, then on along the straight which follows, 41 degrees right of the way in
+        points += [(85, 106), (118.5, 109.5), (118.5 + 0.656 * 50, 109.5 + 0.755 * 50)]
+        walls = [(85 - 6, 100 + BUMPER_AHEAD, 85 + 10, 100 + 11.6)]
+        return cls(points, walls=walls)
+
+    def nearest(self, x, y):
+        '''!@brief Finds the distance from a point to the line and how far along the line it is.
+        @return tuple of distance and progress, in inches
+        '''
+        best = (float('inf'), 0.0)
+        for idx in range(len(self.points) - 1):
+            x0, y0 = self.points[idx]
+            x1, y1 = self.points[idx + 1]
+            dx = x1 - x0
+            dy = y1 - y0
+            seg2 = dx * dx + dy * dy
+            t = 0.0 if seg2 == 0 else max(0.0, min(1.0, ((x - x0) * dx + (y - y0) * dy) / seg2))
+            dist = math.hypot(x - (x0 + t * dx), y - (y0 + t * dy))
+            if dist < best[0]:
+                best = (dist, self.starts[idx] + t * math.sqrt(seg2))
+        return best
+
+    def is_black(self, x, y):
+        '''!@brief Whether the course is black at a point.
+        @return bool
+        '''
+        return self.nearest(x, y)[0] <= self.line_width / 2
+
+    def in_wall(self, x, y):
+        '''!@brief Whether a point is inside any wall.
+        @return bool
+        '''
+        for xmin, ymin, xmax, ymax in self.walls:
+            if xmin <= x <= xmax and ymin <= y <= ymax:
+                return True
+        return False
+
+
+def arc_points(center, radius, start_deg, end_deg, step_deg):
+    '''!@brief Points along an arc, not including its start point.
+    @return list of (x, y)
+    '''
+    points = []
+    steps = max(1, int(abs(end_deg - start_deg) / step_deg))
+    for n in range(1, steps + 1):
+        angle = math.radians(start_deg + (end_deg - start_deg) * n / steps)
+        points.append((center[0] + radius * math.cos(angle), center[1] + radius * math.sin(angle)))
+    return points
+
+
+class Wheel:
+    '''!@brief One wheel: a first-order DC motor driven by a RomiMotor, and its encoder.
+    @details If an ExtInt has been made on the encoder's channel A pin, the rising edges of
+    that channel are run as one-shot events on the virtual clock at the times predicted from
+    the wheel's speed, each setting the count and firing the ExtInt at its own time.
+    '''
+    def __init__(self, pwm_timer, dir_pin, en_pin, enc_timer, gain=RAD_S_PER_PERCENT, tau=0.08,
+                 edge_pin=None):
+        '''!@brief Attaches a wheel model to the timers and pins of one motor and encoder.
+        @param gain Steady-state speed in rad/s per percent of duty cycle
+        @param tau Time constant of the motor in seconds
+        @param edge_pin The encoder's channel A pin, on which an ExtInt may be made
+        '''
+        self.pwm_timer = pwm_timer
+        self.dir_pin = dir_pin
+        self.en_pin = en_pin
+        self.enc_timer = enc_timer
+        self.gain = gain
+        self.tau = tau
+        self.omega = 0.0
+        self.angle = 0.0
+        self.edge_pin = edge_pin
+        self.edge_index = 0
+        return
+
+    def duty(self):
+        '''!@brief The signed duty cycle which the motor driver is applying, in percent.
+        @return float
+        '''
+        channel = self.pwm_timer.channels.get(1)
+        if channel is None or not self.en_pin.level:
+            return 0.0
+        duty = channel.duty() * 100
+        return -duty if self.dir_pin.level else duty
+
+    def step(self, dt):
+        '''!@brief Advances the wheel by @c dt seconds and updates the encoder count.
+        @return None
+        '''
+        self.omega += (self.gain * self.duty() - self.omega) * min(1.0, dt / self.tau)
+        self.angle += self.omega * dt
+        self.enc_timer.set_counter(round(self.angle * COUNTS_PER_REV / (2 * math.pi)))
+        return
+
+    def counts_at(self, t_us, now_us):
+        '''!@brief Encoder counts at a time a little after the last step, at the current speed.
+        @param t_us Time of the last step
+        @param now_us Time wanted
+        @return float
+        '''
+        return (self.angle + self.omega * (now_us - t_us) / 1000000) * COUNTS_PER_REV / (2 * math.pi)
+
+
+class BNO055Model:
+    '''!@brief Register model of a BNO055 IMU reporting the pose of a Plant.
+    @details Registers written are kept. While the operating mode is a fusion mode, the
+    Euler heading (clockwise, as on the chip) and the Z gyro rate read back from the Plant,
+    in the units chosen in UNIT_SEL. Attach it to the bus before main.build() configures the
+    IMU, then hand it to the Plant.
+    '''
+    CHIP_ID = 0x00
+    GYR_Z = 0x18
+    EUL_HEADING = 0x1A
+    CALIB_STAT = 0x35
+    UNIT_SEL = 0x3B
+    OPR_MODE = 0x3D
+
+    def __init__(self):
+        '''!@brief Creates the model with its power-on register values.'''
+        self.regs = bytearray(0x80)
+        self.regs[self.CHIP_ID] = 0xA0
+        self.regs[self.CALIB_STAT] = 0xFF
+        self.plant = None
+        self.reads = 0
+        return
+
+    def write(self, reg, data):
+        self.regs[reg:reg + len(data)] = data
+
+    def read(self, reg, n):
+        self.reads += 1
+        plant = self.plant
+        if plant is not None and self.regs[self.OPR_MODE] & 0x0F >= 0x08:
+            units = self.regs[self.UNIT_SEL]
+            heading = -plant.heading % (2 * math.pi)
+            heading = heading * 900 if units & 0x04 else math.degrees(heading) * 16
+            rate = plant.yaw_rate * 900 if units & 0x02 else math.degrees(plant.yaw_rate) * 16
+            struct.pack_into('<h', self.regs, self.GYR_Z, int(round(rate)))
+            struct.pack_into('<H', self.regs, self.EUL_HEADING, int(round(heading)) % 65536)
+        return bytes(self.regs[reg:reg + n])
+
+
+class Plant:
+    '''!@brief The whole Romi on a course: two wheels, the pose, the line sensor and the bumper.
+    @details Create one after main.build() so the pins and timers it attaches to exist. It
+    registers itself with the virtual clock and is brought up to date, in steps of
+    @c step_us, whenever the code under test touches the hardware.
+    '''
+    def __init__(self, course=None, x=0.0, y=0.0, heading=0.0, left_gain=RAD_S_PER_PERCENT,
+                 right_gain=RAD_S_PER_PERCENT, tau=0.08, step_us=1000, imu=None):
+        '''!@brief Attaches the model to the stand-in hardware.
+        @param course The Course to drive on, by default Course.default()
+        @param x, y, heading Starting pose in inches and radians, CCW from the x axis
+        @param left_gain, right_gain Steady-state wheel speed per percent duty, rad/s
+        @param tau Motor time constant in seconds
+        @param step_us Integration step in microseconds
+        @param imu A BNO055Model to report this robot's heading, or None
+        '''
+        self.course = course if course is not None else Course.default()
+        self.x = x
+        self.y = y
+        self.heading = heading
+        self.step_us = step_us
+        self.t_us = clock.now_us
+        self.distance = 0.0
+        self.yaw_rate = 0.0
+        if imu is not None:
+            imu.plant = self
+        pins = pyb.Pin.pins
+        timers = pyb.Timer.timers
+        self.left = Wheel(timers[4], pins['B7'], pins['A10'], timers[3], left_gain, tau,
+                          pins.get('A6'))
+        self.right = Wheel(timers[8], pins['C7'], pins['B0'], timers[2], right_gain, tau,
+                           pins.get('A0'))
+        for wheel in (self.left, self.right):
+            if wheel.edge_pin is not None and wheel.edge_pin.extint is not None:
+                self._edge_due(wheel)
+        self.sensors = []
+        for idx, name in enumerate(SENSOR_PINS):
+            pin = pyb.Pin(name)
+            pin.offset = (3.5 - idx) * SENSOR_PITCH
+            pin.discharge_start = 0
+            pin.discharge_us = WHITE_US
+            pin.on_change = self._sensor_changed
+            pin.source = self._sensor_level
+            self.sensors.append(pin)
+        for side, name in zip((1, -1), BUMP_PINS):
+            pin = pyb.Pin(name)
+            pin.side = side
+            pin.source = self._bump_level
+        clock.add_sync(self.sync)
+        return
+
+    def sync(self, now_us):
+        '''!@brief Integrates the model up to the given time.
+        @return None
+        '''
+        while self.t_us + self.step_us <= now_us:
+            self.t_us += self.step_us
+            dt = self.step_us / 1000000
+            self.left.step(dt)
+            self.right.step(dt)
+            speed = WHEEL_RADIUS * (self.left.omega + self.right.omega) / 2
+            yaw_rate = WHEEL_RADIUS * (self.right.omega - self.left.omega) / (2 * HALF_TRACK)
+            self.x += speed * math.cos(self.heading + yaw_rate * dt / 2) * dt
+            self.y += speed * math.sin(self.heading + yaw_rate * dt / 2) * dt
+            self.heading += yaw_rate * dt
+            self.yaw_rate = yaw_rate
+            self.distance += abs(speed) * dt
+        return
+
+    def _edge_due(self, wheel):
+        # Runs at the predicted time of a channel A rising edge, one every 4 counts
+        self.sync(clock.now_us)
+        counts = wheel.counts_at(self.t_us, clock.now_us)
+        index = math.floor(counts / 4)
+        if index != wheel.edge_index:
+            wheel.edge_index = index
+            wheel.enc_timer.set_counter(round(counts))
+            wheel.edge_pin.extint.fire()
+        rate = abs(wheel.omega) * COUNTS_PER_REV / (2 * math.pi)  # counts per second
+        wait = self.step_us
+        if rate > 0:
+            to_edge = (index + 1) * 4 - counts if wheel.omega > 0 else counts - index * 4
+            wait = min(wait, max(1, math.ceil(to_edge * 1000000 / rate)))
+        clock.at(clock.now_us + wait, lambda: self._edge_due(wheel))
+
+    def body_point(self, ahead, left):
+        '''!@brief Course coordinates of a point fixed to the robot.
+        @param ahead Distance ahead of the wheel axle, in inches
+        @param left Distance to the left of the center line, in inches
+        @return tuple (x, y)
+        '''
+        c = math.cos(self.heading)
+        s = math.sin(self.heading)
+        return self.x + ahead * c - left * s, self.y + ahead * s + left * c
+
+    def _sensor_changed(self, pin):
+        # Switching a charged channel to an input starts its discharge, which is slow over black
+        if pin.mode == pyb.Pin.IN:
+            self.sync(clock.now_us)
+            pin.discharge_start = clock.now_us
+            x, y = self.body_point(SENSOR_AHEAD, pin.offset)
+            pin.discharge_us = BLACK_US if self.course.is_black(x, y) else WHITE_US
+
+    def _sensor_level(self, pin):
+        return pin.level and clock.now_us - pin.discharge_start < pin.discharge_us
+
+    def _bump_level(self, pin):
+        x, y = self.body_point(BUMPER_AHEAD, pin.side * BUMPER_HALF_WIDTH / 2)
+        return self.course.in_wall(x, y)
+
+    def progress(self):
+        '''!@brief How far the robot is from the line and how far along the course it has got.
+        @return tuple of distance and progress in inches
+        '''
+        return self.course.nearest(self.x, self.y)
@@ -0,0 +1,505 @@
+'''!@file pyb.py
+!@brief Host stand-in for the Micropython @c pyb module.
+!@details Provides the parts of @c pyb which the Romi code uses: pins, timers in PWM and
+encoder modes, I2C, UART, and the interrupt and timing functions. Times come from the
+virtual clock in @c sim.clock, and timer callbacks are run by that clock at their due
+times. Interrupts never really preempt Python code on the host, so disabling them only
+counts the call. What the pins, timers and I2C devices read is set by hardware models
+such as those in @c sim.plant.
+'''
+from sim.clock import clock, TICKS_MAX, TICKS_HALFPERIOD
+
+## Count of calls to disable_irq(), handy when comparing critical-section costs
+irq_disables = 0
+
+
+def disable_irq():
+    '''!@brief Stand-in for disabling interrupts; counts the call.
+    @return The previous interrupt state, always True
+    '''
+    global irq_disables
+    irq_disables += 1
+    return True
+
+
+def enable_irq(state=True):
+    '''!@brief Stand-in for restoring interrupts.
+    @return None
+    '''
+    return
+
+
+def millis():
+    '''!@brief Milliseconds on the virtual clock, wrapped like the board's counter.
+    @return int
+    '''
+    return (clock.read_us() // 1000) & TICKS_MAX
+
+
+def micros():
+    '''!@brief Microseconds on the virtual clock, wrapped like the board's counter.
+    @return int
+    '''
+    return clock.read_us() & TICKS_MAX
+
+
+def elapsed_millis(start):
+    '''!@brief Milliseconds elapsed since a value returned by millis().
+    @return int
+    '''
+    return ((millis() - start + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
+def elapsed_micros(start):
+    '''!@brief Microseconds elapsed since a value returned by micros().
+    @return int
+    '''
+    return ((micros() - start + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
+def delay(ms):
+    '''!@brief Advances the virtual clock by the given number of milliseconds.
+    @return None
+    '''
+    clock.advance(ms * 1000)
+
+
+def udelay(us):
+    '''!@brief Advances the virtual clock by the given number of microseconds.
+    @return None
+    '''
+    clock.advance(us)
+
+
+def wfi():
+    '''!@brief Waits for an interrupt: skips ahead to the next event due on the virtual clock.
+    @details If no event is pending, the clock moves on by one millisecond, the SysTick period.
+    @return None
+    '''
+    due = [event[0] for event in clock._events]
+    wait = min(due) - clock.now_us if due else 1000
+    clock.advance(max(1, min(wait, 1000)))
+
+
+def repl_uart(uart):
+    '''!@brief Stand-in for moving the REPL onto a UART; does nothing on the host.
+    @return None
+    '''
+    return
+
+
+class _CpuPins:
+    '''!@brief Stand-in for @c Pin.cpu and @c Pin.board: any attribute is the pin's name.'''
+    def __getattr__(self, name):
+        return name
+
+
+class Pin:
+    '''!@brief Stand-in for @c pyb.Pin.
+    @details Pins are kept by name, so constructing a Pin for a pin which already has one
+    returns the same object with its mode updated, as on the board. An output pin reads
+    back what was written to it. An input pin reads whatever its @c source function
+    returns, called with the pin, or its @c level if no source has been set; hardware
+    models set these to drive inputs such as bump switches and line sensor channels.
+    '''
+    cpu = _CpuPins()
+    board = _CpuPins()
+
+    IN = 0
+    OUT_PP = 1
+    OUT_OD = 17
+    ALT = 2
+    ALT_OD = 18
+    ANALOG = 3
+    OUT = OUT_PP
+    PULL_NONE = 0
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    ## All the pins created so far, by name
+    pins = {}
+
+    def __new__(cls, name, *args, **kwargs):
+        name = name.name if isinstance(name, Pin) else str(name)
+        pin = cls.pins.get(name)
+        if pin is None:
+            pin = super().__new__(cls)
+            pin.name = name
+            pin.mode = Pin.IN
+            pin.pull = Pin.PULL_NONE
+            pin.level = 0
+            pin.source = None
+            pin.on_change = None
+            pin.handler = None
+            pin.extint = None
+            cls.pins[name] = pin
+        return pin
+
+    def __init__(self, name, mode=None, pull=None, alt=None, value=None):
+        self.init(mode, pull, alt, value)
+
+    def init(self, mode=None, pull=None, alt=None, value=None):
+        '''!@brief Sets the pin's mode and pull and, for outputs, its level.
+        @details Tells the pin's model, if any, through @c on_change.
+        '''
+        if mode is not None:
+            self.mode = mode
+        if pull is not None:
+            self.pull = pull
+        if value is not None:
+            self.level = 1 if value else 0
+        if self.on_change is not None:
+            self.on_change(self)
+
+    def value(self, level=None):
+        '''!@brief Reads the pin, or sets its level if an argument is given.
+        @return int level, when reading
+        '''
+        if level is not None:
+            self.level = 1 if level else 0
+            if self.on_change is not None:
+                self.on_change(self)
+            return None
+        if self.mode == Pin.IN and self.source is not None:
+            clock.sync()
+            return 1 if self.source(self) else 0
+        return self.level
+
+    def high(self):
+        '''!@brief Sets the pin high.'''
+        self.value(1)
+
+    def low(self):
+        '''!@brief Sets the pin low.'''
+        self.value(0)
+
+    on = high
+    off = low
+
+    def port(self):
+        '''!@brief Index of the pin's GPIO port, 0 for A, 1 for B and so on.
+        @return int
+        '''
+        return ord(self.name[0]) - ord('A')
+
+    def pin(self):
+        '''!@brief Number of the pin within its port.
+        @return int
+        '''
+        return int(self.name[1:])
+
+    def irq(self, handler=None, trigger=IRQ_RISING | IRQ_FALLING, hard=False):
+        '''!@brief Saves a handler which a model may call on an edge.
+        @return None
+        '''
+        self.handler = handler
+        self.trigger = trigger
+
+    def __call__(self, level=None):
+        return self.value(level)
+
+    def __repr__(self):
+        return 'Pin(Pin.cpu.{:s})'.format(self.name)
+
+
+class ExtInt:
+    '''!@brief Stand-in for @c pyb.ExtInt.
+    @details Like the board, making one sets the pin to an input. The ExtInt is saved on the
+    pin as @c extint, and a model calls fire() when the edge happens, which runs the
+    callback with the line number, as the interrupt would, if the ExtInt is enabled.
+    '''
+    IRQ_RISING = 0x10110000
+    IRQ_FALLING = 0x10210000
+    IRQ_RISING_FALLING = 0x10310000
+
+    def __init__(self, pin, mode, pull, callback):
+        self.pin = Pin(pin)
+        self.pin.init(Pin.IN, pull)
+        self.mode = mode
+        self.callback = callback
+        self.enabled = True
+        self.fired = 0
+        self.pin.extint = self
+
+    def line(self):
+        '''!@brief The EXTI line, which is the pin's number within its port.
+        @return int
+        '''
+        return self.pin.pin()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def swint(self):
+        '''!@brief Runs the callback, as a software interrupt.'''
+        self.callback(self.line())
+
+    def fire(self):
+        '''!@brief Used by models when the edge happens: runs the callback if enabled.
+        @return None
+        '''
+        if self.enabled:
+            self.fired += 1
+            self.callback(self.line())
+
+
+class TimerChannel:
+    '''!@brief Stand-in for a channel of a @c pyb.Timer, in PWM, encoder or capture modes.'''
+    def __init__(self, timer, number, mode, pin):
+        self.timer = timer
+        self.number = number
+        self.mode = mode
+        self.pin = pin
+        self.width = 0
+        self.callback_func = None
+
+    def pulse_width_percent(self, percent=None):
+        '''!@brief Sets or reads the PWM duty cycle in percent, clamped to 0 to 100.
+        @details Models are brought up to date first, so that they see the old duty cycle up
+        to now and the new one from now on.
+        '''
+        if percent is None:
+            return self.width * 100 / (self.timer.period() + 1)
+        clock.sync()
+        percent = 0 if percent < 0 else (100 if percent > 100 else percent)
+        self.width = int(percent * (self.timer.period() + 1) / 100)
+
+    def pulse_width(self, width=None):
+        '''!@brief Sets or reads the PWM pulse width in timer counts.'''
+        if width is None:
+            return self.width
+        clock.sync()
+        self.width = int(width)
+
+    def duty(self):
+        '''!@brief The duty cycle from 0 to 1, for use by models.
+        @return float
+        '''
+        return self.width / (self.timer.period() + 1)
+
+    def capture(self, value=None):
+        '''!@brief Reads the captured count; the model stores it in @c width.'''
+        return self.width
+
+    def callback(self, func):
+        '''!@brief Saves a function which a model may call on a capture.'''
+        self.callback_func = func
+
+
+class Timer:
+    '''!@brief Stand-in for @c pyb.Timer.
+    @details Timers created with a frequency run their callbacks on the virtual clock. In
+    encoder mode, the count is set by a model through set_counter(); reading it first
+    brings the models up to date.
+    '''
+    PWM = 0
+    PWM_INVERTED = 1
+    OC_TIMING = 2
+    IC = 8
+    ENC_A = 9
+    ENC_B = 10
+    ENC_AB = 11
+    UP = 0
+    DOWN = 16
+    CENTER = 32
+
+    ## Clock feeding the timers, as on the STM32L476 at 80 MHz
+    SOURCE_FREQ = 80000000
+
+    ## All the timers created so far, by number
+    timers = {}
+
+    def __init__(self, num, freq=None, period=0xFFFF, prescaler=0, mode=UP):
+        self.num = num
+        self.channels = {}
+        self._count = 0
+        self._callback = None
+        self._event = None
+        self.init(freq=freq, period=period, prescaler=prescaler)
+        Timer.timers[num] = self
+
+    def init(self, freq=None, period=0xFFFF, prescaler=0, mode=UP):
+        '''!@brief Sets the timer's frequency, or its period and prescaler.'''
+        if freq is not None:
+            self._prescaler = 0
+            self._period = max(1, int(Timer.SOURCE_FREQ / freq)) - 1
+        else:
+            self._prescaler = prescaler
+            self._period = period
+        self._freq = freq
+        self._restart_event()
+
+    def _restart_event(self):
+        if self._event is not None:
+            clock.cancel(self._event)
+            self._event = None
+        if self._callback is not None and self._freq:
+            self._event = clock.every(1000000 / self._freq,
+                                      lambda: self._callback(self))
+
+    def channel(self, number, mode=None, pin=None, **kwargs):
+        '''!@brief Creates or returns one of the timer's channels.
+        @return TimerChannel
+        '''
+        if mode is not None:
+            self.channels[number] = TimerChannel(self, number, mode, pin)
+        return self.channels[number]
+
+    def callback(self, func):
+        '''!@brief Sets a function to be called at the timer's frequency, or None to stop.'''
+        self._callback = func
+        self._restart_event()
+
+    def counter(self, value=None):
+        '''!@brief Reads or sets the count.
+        @return int
+        '''
+        if value is not None:
+            self._count = value % (self._period + 1)
+            return None
+        clock.sync()
+        return self._count
+
+    def set_counter(self, value):
+        '''!@brief Used by models to set the count, wrapped at the period like the hardware.'''
+        self._count = int(value) % (self._period + 1)
+
+    def period(self, value=None):
+        '''!@brief Reads or sets the auto-reload value.'''
+        if value is None:
+            return self._period
+        self._period = value
+
+    def prescaler(self, value=None):
+        '''!@brief Reads or sets the prescaler.'''
+        if value is None:
+            return self._prescaler
+        self._prescaler = value
+
+    def freq(self, value=None):
+        '''!@brief Reads or sets the frequency.'''
+        if value is None:
+            return self._freq if self._freq else \
+                Timer.SOURCE_FREQ / (self._prescaler + 1) / (self._period + 1)
+        self.init(freq=value)
+
+    def source_freq(self):
+        return Timer.SOURCE_FREQ
+
+    def deinit(self):
+        '''!@brief Stops the timer's callback.'''
+        self.callback(None)
+
+
+class I2C:
+    '''!@brief Stand-in for @c pyb.I2C as a controller.
+    @details Devices are models attached by address with attach(); each needs @c read(reg, n)
+    returning bytes and @c write(reg, data). Every transfer moves the virtual clock on by the
+    time it would take on the bus, so code which blocks on the bus shows up in timings.
+    '''
+    CONTROLLER = 0
+    MASTER = 0
+    PERIPHERAL = 1
+    SLAVE = 1
+
+    ## Device models attached to each bus, by bus number then address
+    buses = {}
+
+    def __init__(self, bus, mode=CONTROLLER, baudrate=400000, addr=0x12):
+        self.bus = bus
+        self.baudrate = baudrate
+        self.devices = I2C.buses.setdefault(bus, {})
+        self.transfers = 0
+
+    @staticmethod
+    def attach(bus, addr, device):
+        '''!@brief Attaches a device model to a bus at an address.'''
+        I2C.buses.setdefault(bus, {})[addr] = device
+
+    def _device(self, addr):
+        device = self.devices.get(addr)
+        if device is None:
+            raise OSError(19)  # ENODEV, as when no device acknowledges
+        return device
+
+    def _bus_time(self, nbytes):
+        # Start, address, register, repeated start and address, data; 9 bits per byte
+        self.transfers += 1
+        clock.advance((nbytes + 3) * 9 * 1000000 // self.baudrate)
+
+    def mem_read(self, data, addr, memaddr, timeout=5000, addr_size=8):
+        '''!@brief Reads registers; @c data is a byte count or a buffer to fill.
+        @return bytes, or None when a buffer was given
+        '''
+        device = self._device(addr)
+        nbytes = data if isinstance(data, int) else memoryview(data).nbytes
+        self._bus_time(nbytes)
+        clock.sync()
+        values = device.read(memaddr, nbytes)
+        if isinstance(data, int):
+            return bytes(values)
+        memoryview(data).cast('B')[:] = values  # any buffer, as on the board
+        return None
+
+    def mem_write(self, data, addr, memaddr, timeout=5000, addr_size=8):
+        '''!@brief Writes registers; @c data is an int for one byte, or a buffer.
+        @return None
+        '''
+        device = self._device(addr)
+        values = bytes([data & 0xFF]) if isinstance(data, int) else bytes(data)
+        self._bus_time(len(values))
+        clock.sync()
+        device.write(memaddr, values)
+
+    def scan(self):
+        '''!@brief Lists the addresses with devices attached.
+        @return list
+        '''
+        return sorted(self.devices)
+
+    def is_ready(self, addr):
+        return addr in self.devices
+
+
+class UART:
+    '''!@brief Stand-in for @c pyb.UART.
+    @details Written data collects in @c sent; data to be read can be queued with feed().
+    '''
+    def __init__(self, bus, baudrate=9600, **kwargs):
+        self.bus = bus
+        self.baudrate = baudrate
+        self.sent = bytearray()
+        self._rx = bytearray()
+
+    def init(self, baudrate=9600, **kwargs):
+        self.baudrate = baudrate
+
+    def feed(self, data):
+        '''!@brief Queues bytes to be read, as if they had been received.'''
+        self._rx += data
+
+    def any(self):
+        return len(self._rx)
+
+    def read(self, nbytes=None):
+        if not self._rx:
+            return None
+        nbytes = len(self._rx) if nbytes is None else nbytes
+        data = bytes(self._rx[:nbytes])
+        del self._rx[:nbytes]
+        return data
+
+    def readline(self):
+        idx = self._rx.find(b'\n')
+        return self.read(len(self._rx) if idx < 0 else idx + 1)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.sent += data
+        return len(data)
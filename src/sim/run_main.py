@@ -0,0 +1,69 @@
+'''!@file run_main.py
+!@brief Runs the task graph from main.py on a workstation, faster than real time.
+!@details Builds the Romi with main.build() on the host stand-ins and runs the scheduler
+for a given stretch of simulated time, then prints the cotask profile table, the shares,
+each task's state table, and how much faster than real time the run went. With no plant
+model attached the wheels don't move and the line sensor sees white; see sim.plant for a
+closed-loop model.
+
+Run from the @c src directory with @c python -m sim.run_main [seconds] [speed]
+'''
+import contextlib
+import io
+import sys
+import time as host_time
+import tracemalloc
+
+import sim
+
+clock = sim.install()
+import cotask
+import task_share
+import main
+
+
+def run(seconds=10, speed=6, sched='heap', quiet=True):
+    '''!@brief Builds a fresh Romi and runs its tasks for some simulated time.
+    @details Tasks made with @c mem_profile=True measure their allocations through the
+    @c gc.mem_alloc() stand-in, which needs @c tracemalloc, so it is started for the run when
+    there are any; the host then runs several times slower.
+    @param seconds Simulated time to run for
+    @param speed Line following speed in in/s
+    @param sched Scheduler to use: @c heap (the default, which sleeps when idle), @c pri or @c rr
+    @param quiet True to throw away what the tasks print
+    @return tuple of the objects made by main.build() and the host time taken in seconds
+    '''
+    sim.reset()
+    tasks = cotask.TaskList()
+    out = io.StringIO() if quiet else sys.stdout
+    with contextlib.redirect_stdout(out):
+        romi = main.build(speed, tasks)
+        if sched == 'rr':
+            step = tasks.rr_sched
+        elif sched == 'heap':
+            step = lambda: tasks.heap_sched(idle=True)
+        else:
+            step = tasks.pri_sched
+        trace = any(task._mem_prof for pri in tasks.pri_list for task in pri[2:])
+        if trace:
+            tracemalloc.start()
+        end_us = clock.now_us + int(seconds * 1000000)
+        start = host_time.perf_counter()
+        while clock.now_us < end_us:
+            step()
+        host_s = host_time.perf_counter() - start
+        if trace:
+            tracemalloc.stop()
+    return romi, host_s
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else 6
+    romi, host_s = run(seconds, speed)
+    print(romi['task_list'])
+    print(task_share.show_all())
+    for task in romi['controls'] + (romi['sense'],):
+        print(task.fsm.show())
+    print('{:.1f} s simulated in {:.2f} s, {:.1f} times real time'.format(
+        seconds, host_s, seconds / host_s))
@@ -0,0 +1,278 @@
+'''!@file sweep.py
+!@brief Sweeps controller gains over many configurations at once with NumPy.
+!@details Rather than running one simulated Romi per configuration, as sim.batch does,
+this module runs the control laws from ROMI_tasks as array math. Each element of the
+arrays is one configuration.
+- step_response() runs the wheel speed loop in WheelController (feed-forward gain @c kff,
+  proportional gain @c kp, integral gain @c ki with anti-windup at the duty cycle limit,
+  50 Hz, encoder counts differenced over each period).
+  It reports the settling time, the overshoot and the steady-state error.
+- lap() runs the line following in Sensing.run (centroid weights, steering gain, left
+  wheel bias, 10 Hz) on a Course from sim.plant, on top of the same wheel loops. It
+  reports the lap time and the greatest distance from the line.
+
+The motors are the first-order model of sim.plant, stepped exactly over each 20 ms control
+period. Use grid() to build the arrays for every combination of a set of parameter values.
+
+NumPy is only needed on the host and only by this module. From the @c src directory,
+@c python -m sim.sweep runs an example sweep.
+'''
+import math
+import sys
+import time as host_time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from sim.plant import (Course, HALF_TRACK, WHEEL_RADIUS, COUNTS_PER_REV, RAD_S_PER_PERCENT,
+                       SENSOR_PITCH, SENSOR_AHEAD)
+
+## Period of the motor control tasks, in seconds
+CONTROL_DT = 0.02
+## Number of control periods in each period of the sensing task
+SENSE_EVERY = 5
+## Weights given to the eight line sensors by LineSensor.centroid3()
+CENTROID_WEIGHTS = (15, 8, 4, 1, -1, -4, -8, -15)
+## A lap fails if the robot gets this far from the line, in inches
+LOST_DISTANCE = 8.0
+
+
+def _need_numpy():
+    if np is None:
+        raise ImportError('sim.sweep needs NumPy: pip install numpy')
+
+
+def grid(**axes):
+    '''!@brief Every combination of the given parameter values, as flat arrays.
+    @details For example grid(kff=[3, 4, 5], ki=[0.25, 0.5]) gives six configurations.
+    @return dict of parameter name to a 1-D array, all of the same length
+    '''
+    _need_numpy()
+    names = list(axes)
+    mesh = np.meshgrid(*(np.asarray(axes[name], dtype=float) for name in names), indexing='ij')
+    return {name: values.ravel() for name, values in zip(names, mesh)}
+
+
+class _Wheels:
+    '''!@brief Many wheels and their speed loops, stepped one control period at a time.'''
+    def __init__(self, kff, kp, ki, gain, tau):
+        self.kff = kff
+        self.kp = kp
+        self.ki = ki
+        self.integral = np.zeros_like(gain)
+        self.gain = gain
+        self.decay = np.exp(-CONTROL_DT / tau)
+        self.tau = tau
+        self.omega = np.zeros_like(gain)
+        self.angle = np.zeros_like(gain)
+        self.counts = np.zeros_like(gain)
+        self.speed = np.zeros_like(gain)
+
+    def step(self, duty):
+        # Exact response of a first-order motor to a duty cycle held for one period
+        target = self.gain * np.clip(duty, -100, 100)
+        self.angle += target * CONTROL_DT + (self.omega - target) * self.tau * (1 - self.decay)
+        self.omega = target + (self.omega - target) * self.decay
+        counts = np.floor(self.angle * (COUNTS_PER_REV / (2 * math.pi)))
+        self.speed = (counts - self.counts) * (2 * math.pi / COUNTS_PER_REV) / CONTROL_DT
+        self.counts = counts
+
+    def control(self, omega_set):
+        # The law in WheelController: duty = kff*w + kp*e + the integral of ki*e, limited to
+        # +/-100, with the integral only taking in errors which pull the duty off the limit
+        err = omega_set - self.speed
+        integral = self.integral + self.ki * err * CONTROL_DT
+        duty = self.kff * omega_set + self.kp * err + integral
+        keep = ((duty <= 100) | (err < 0)) & ((duty >= -100) | (err > 0))
+        self.integral = np.where(keep, integral, self.integral)
+        return np.clip(duty, -100, 100)
+
+
+def step_response(kff, kp, ki=0.0, gain=RAD_S_PER_PERCENT, tau=0.08,
+                  omega_set=6 / WHEEL_RADIUS, seconds=1.0, band=0.02):
+    '''!@brief Runs the wheel speed loop from rest to a set speed for many configurations.
+    @details The first period uses the duty cycle which straight_drive() estimates, as
+    state 1 of the motor tasks does; after that the loop is closed.
+    @param kff, kp, ki Controller gains, arrays or scalars
+    @param gain Motor speed per percent duty in rad/s, array or scalar
+    @param tau Motor time constant in seconds, array or scalar
+    @param omega_set Set speed in rad/s
+    @param seconds Length of the run
+    @param band Settling band as a fraction of the final speed
+    @return dict of arrays: @c settling_s, @c overshoot_pct and @c error_pct, which is the
+            steady-state error as a percentage of the set speed
+    '''
+    _need_numpy()
+    kff, kp, ki, gain, tau = np.broadcast_arrays(*(np.asarray(a, dtype=float)
+                                                   for a in (kff, kp, ki, gain, tau)))
+    wheels = _Wheels(kff, kp, ki, gain, tau)
+    steps = int(round(seconds / CONTROL_DT))
+    history = np.empty((steps,) + kff.shape)
+    duty = np.full(kff.shape, omega_set / RAD_S_PER_PERCENT)
+    for k in range(steps):
+        wheels.step(duty)
+        duty = wheels.control(omega_set)
+        history[k] = wheels.omega
+
+    final = history[-max(1, steps // 10):].mean(axis=0)
+    outside = np.abs(history - final) > band * np.abs(final)
+    # Index of the last sample outside the band, counted from the end
+    last_out = steps - np.argmax(outside[::-1], axis=0)
+    settling = np.where(outside.any(axis=0), last_out, 0) * CONTROL_DT
+    overshoot = np.maximum(0, history.max(axis=0) / final - 1) * 100
+    error = (final / omega_set - 1) * 100
+    return {'settling_s': settling, 'overshoot_pct': overshoot, 'error_pct': error}
+
+
+class _Line:
+    '''!@brief A Course's line as arrays, for distances to many points at once.'''
+    def __init__(self, course):
+        points = np.asarray(course.points)
+        self.start = points[:-1]
+        self.delta = points[1:] - points[:-1]
+        self.len2 = np.maximum((self.delta ** 2).sum(axis=1), 1e-12)
+        self.offset = np.asarray(course.starts[:-1])
+        self.length = course.length
+        self.half_width = course.line_width / 2
+
+    def nearest(self, x, y):
+        # Distance to the line and progress along it, for points of any shape
+        px = x[..., None] - self.start[:, 0]
+        py = y[..., None] - self.start[:, 1]
+        t = np.clip((px * self.delta[:, 0] + py * self.delta[:, 1]) / self.len2, 0, 1)
+        dist = np.hypot(px - t * self.delta[:, 0], py - t * self.delta[:, 1])
+        idx = dist.argmin(axis=-1)[..., None]
+        progress = (np.take_along_axis(t, idx, -1) * np.sqrt(self.len2[idx]) + self.offset[idx])
+        return np.take_along_axis(dist, idx, -1)[..., 0], progress[..., 0]
+
+
+def lap(steer=0.065, bias=1.2, speed=6.0, kff=3.955, kp=0.5, ki=8.0, gain_l=RAD_S_PER_PERCENT,
+        gain_r=RAD_S_PER_PERCENT, tau=0.08, course=None, dash_s=15.0, slow_speed=3.0,
+        seconds=60.0):
+    '''!@brief Runs the line following in Sensing.run around a course for many configurations.
+    @details Every 100 ms the centroid of the sensors over the line turns the set speeds
+    as in state 1 of Sensing.run: by @c steer times the centroid while it is getting worse,
+    back to the straight speeds while it is getting better. After @c dash_s seconds the
+    speed drops to @c slow_speed as it does there.
+    @param steer Steering gain, rad/s per unit of centroid
+    @param bias Speed added to the left wheel's set speed, rad/s
+    @param speed Line following speed, in/s
+    @param kff, kp, ki Wheel speed loop gains
+    @param gain_l, gain_r Motor speed per percent duty, rad/s
+    @param tau Motor time constant in seconds
+    @param course The Course to run, by default Course.default()
+    @param seconds Longest lap time allowed
+    @return dict of arrays: @c lap_s (NaN for laps not finished), @c finished and @c worst_off
+    '''
+    _need_numpy()
+    params = np.broadcast_arrays(*(np.asarray(a, dtype=float) for a in
+                                   (steer, bias, speed, kff, kp, ki, gain_l, gain_r, tau)))
+    steer, bias, speed, kff, kp, ki, gain_l, gain_r, tau = params
+    shape = steer.shape
+    line = _Line(course if course is not None else Course.default())
+    left = _Wheels(kff, kp, ki, gain_l, tau)
+    right = _Wheels(kff, kp, ki, gain_r, tau)
+    offsets = (3.5 - np.arange(8)) * SENSOR_PITCH
+    weights = np.asarray(CENTROID_WEIGHTS, dtype=float)
+
+    x = np.zeros(shape)
+    y = np.zeros(shape)
+    heading = np.zeros(shape)
+    base = speed / WHEEL_RADIUS
+    set_l = base + bias
+    set_r = base.copy()
+    duty_l = base / RAD_S_PER_PERCENT
+    duty_r = duty_l.copy()
+    centroid = np.zeros(shape)
+    running = np.ones(shape, dtype=bool)
+    lap_s = np.full(shape, np.nan)
+    worst = np.zeros(shape)
+
+    steps = int(round(seconds / CONTROL_DT))
+    dash_step = int(round(dash_s / CONTROL_DT))
+    for k in range(steps):
+        if k == dash_step:
+            base = np.full(shape, slow_speed / WHEEL_RADIUS)
+            set_l = base + bias
+            set_r = base.copy()
+        if k % SENSE_EVERY == 0:
+            c = np.cos(heading)[..., None]
+            s = np.sin(heading)[..., None]
+            sx = x[..., None] + SENSOR_AHEAD * c - offsets * s
+            sy = y[..., None] + SENSOR_AHEAD * s + offsets * c
+            black = line.nearest(sx, sy)[0] <= line.half_width
+            past = centroid
+            centroid = black @ weights
+            worse = np.abs(centroid) >= np.abs(past)
+            turning = worse & (centroid != 0)
+            set_l = np.where(turning, set_l - steer * centroid,
+                             np.where(worse, base + bias, base))
+            set_r = np.where(turning, set_r + steer * centroid, base)
+
+        left.step(duty_l)
+        right.step(duty_r)
+        duty_l = left.control(set_l)
+        duty_r = right.control(set_r)
+        v = WHEEL_RADIUS * (left.omega + right.omega) / 2
+        yaw_rate = WHEEL_RADIUS * (right.omega - left.omega) / (2 * HALF_TRACK)
+        mid = heading + yaw_rate * CONTROL_DT / 2
+        x = np.where(running, x + v * np.cos(mid) * CONTROL_DT, x)
+        y = np.where(running, y + v * np.sin(mid) * CONTROL_DT, y)
+        heading = np.where(running, heading + yaw_rate * CONTROL_DT, heading)
+
+        if k % SENSE_EVERY == 0:
+            dist, progress = line.nearest(x, y)
+            worst = np.where(running, np.maximum(worst, dist), worst)
+            done = running & (progress >= line.length - 1)
+            lap_s[done] = (k + 1) * CONTROL_DT
+            running &= ~done & (dist <= LOST_DISTANCE)
+            if not running.any():
+                break
+    return {'lap_s': lap_s, 'finished': ~np.isnan(lap_s), 'worst_off': worst}
+
+
+def report(params, results, key, top=10, where=None):
+    '''!@brief Prints the best configurations of a sweep, sorted by one of its results.
+    @param params dict of parameter arrays, as from grid()
+    @param results dict of result arrays, as from step_response() or lap()
+    @param key The result to sort by, smallest first; NaNs go last
+    @param top How many configurations to print
+    @param where Optional boolean array; only configurations where it is true are printed
+    @return Array of the indices of the configurations, best first
+    '''
+    _need_numpy()
+    order = np.argsort(np.where(np.isnan(results[key]), np.inf, results[key]), kind='stable')
+    if where is not None:
+        order = order[np.asarray(where)[order]]
+    names = list(params) + list(results)
+    print(''.join('{:>14s}'.format(name.upper()) for name in names))
+    for idx in order[:top]:
+        print(''.join('{:14.4g}'.format(float(col[idx]))
+                      for col in list(params.values()) + list(results.values())))
+    return order
+
+
+if __name__ == '__main__':
+    _need_numpy()
+    start = host_time.perf_counter()
+    gains = grid(kff=[3.5, 3.955, 4.5], kp=np.linspace(0.0, 2.0, 21),
+                 ki=np.linspace(0.0, 8.0, 17), gain=RAD_S_PER_PERCENT * np.array([0.9, 1.0, 1.1]),
+                 tau=[0.05, 0.08, 0.12])
+    steps = step_response(**gains)
+    print('Wheel speed loop, {:d} configurations, within 2% of the set speed:'.format(
+        steps['settling_s'].size))
+    report(gains, steps, 'settling_s', where=np.abs(steps['error_pct']) < 2)
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    rng = np.random.default_rng(0)
+    steering = grid(steer=np.linspace(0.02, 0.15, 14), bias=np.linspace(0.0, 2.0, 9),
+                    speed=[4.0, 6.0, 8.0], trial=np.arange(n))
+    size = steering['steer'].size
+    laps = lap(steering['steer'], steering['bias'], steering['speed'],
+               gain_l=RAD_S_PER_PERCENT * (1 + rng.normal(0, 0.05, size)),
+               gain_r=RAD_S_PER_PERCENT * (1 + rng.normal(0, 0.05, size)))
+    print('\nLine following, {:d} laps:'.format(size))
+    report(steering, laps, 'lap_s')
+    print('\nDone in {:.1f} s of host time'.format(host_time.perf_counter() - start))
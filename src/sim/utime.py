@@ -0,0 +1,70 @@
+'''!@file utime.py
+!@brief Host stand-in for the Micropython @c utime module.
+!@details Time comes from the virtual clock in @c sim.clock, and the ticks functions
+wrap around at the same period as they do on the board so that code which mixes up
+plain arithmetic and @c ticks_diff() shows its bugs here too.
+'''
+from sim.clock import clock, TICKS_MAX, TICKS_HALFPERIOD, TICKS_PERIOD
+
+
+def ticks_us():
+    '''!@brief Reads the virtual clock in microseconds, wrapped like the board's counter.
+    @return int
+    '''
+    return clock.read_us() & TICKS_MAX
+
+
+def ticks_ms():
+    '''!@brief Reads the virtual clock in milliseconds, wrapped like the board's counter.
+    @return int
+    '''
+    return (clock.read_us() // 1000) & TICKS_MAX
+
+
+def ticks_cpu():
+    '''!@brief Reads the virtual clock at the highest resolution available, microseconds.
+    @return int
+    '''
+    return ticks_us()
+
+
+def ticks_add(ticks, delta):
+    '''!@brief Adds a signed offset to a ticks value, wrapping around.
+    @return int
+    '''
+    return (ticks + delta) & TICKS_MAX
+
+
+def ticks_diff(end, start):
+    '''!@brief Signed difference between two ticks values, allowing for wrap-around.
+    @return int
+    '''
+    return ((end - start + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
+def sleep_us(us):
+    '''!@brief Advances the virtual clock by the given number of microseconds.
+    @return None
+    '''
+    clock.advance(us)
+
+
+def sleep_ms(ms):
+    '''!@brief Advances the virtual clock by the given number of milliseconds.
+    @return None
+    '''
+    clock.advance(ms * 1000)
+
+
+def sleep(s):
+    '''!@brief Advances the virtual clock by the given number of seconds.
+    @return None
+    '''
+    clock.advance(s * 1000000)
+
+
+def time():
+    '''!@brief Seconds since the simulation started.
+    @return int
+    '''
+    return clock.now_us // 1000000
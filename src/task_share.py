@@ -87,6 +87,17 @@ class BaseShare:
 #  # In another task, read data from the queue
 #  something = my_queue.get ()
 #  @endcode
+#
+#  The queue's storage is an @c array.array ring buffer which is allocated
+#  once when the queue is created, so putting and getting data never 
+#  allocates memory. Blocks of data can be moved with @c put_many() and
+#  @c get_into(), which take one critical section for the whole block:
+#
+#  @code
+#  samples = array.array ('f', range (20))       # Allocated once, in setup
+#  ...
+#  n = my_queue.get_into (samples)               # Read up to 20 items
+#  @endcode
 class Queue (BaseShare):
 
     ## A counter used to give serial numbers to queues for diagnostic use.
@@ -169,11 +180,13 @@ class Queue (BaseShare):
         # If we're in an ISR and the queue is full and we're not allowed to
         # overwrite data, we have to give up and exit
         if self.full ():
-            if in_ISR:
+            if in_ISR and not self._overwrite:
+                self._dropped += 1
                 return
 
             # Wait (if needed) until there's room in the buffer for the data
             if not self._overwrite:
+                self._blocked += 1
                 while self.full ():
                     pass
 
@@ -182,15 +195,7 @@ class Queue (BaseShare):
             _irq_state = pyb.disable_irq ()
 
         # Write the data and advance the counts and pointers
-        self._buffer[self._wr_idx] = item
-        self._wr_idx += 1
-        if self._wr_idx >= self._size:
-            self._wr_idx = 0
-        self._num_items += 1
-        if self._num_items >= self._size:        # Can't be fuller than full
-            self._num_items = self._size
-        if self._num_items > self._max_full:     # Record maximum fillage
-            self._max_full = self._num_items
+        self._write (item)
 
         # Re-enable interrupts
         if self._thread_protect and not in_ISR:
@@ -217,8 +222,10 @@ class Queue (BaseShare):
     @micropython.native
     def get (self, in_ISR = False):
         # Wait until there's something in the queue to be returned
-        while self.empty ():
-            pass
+        if self.empty ():
+            self._blocked += 1
+            while self.empty ():
+                pass
 
         # Prevent data corruption by blocking interrupts during data transfer
         if self._thread_protect and not in_ISR:
@@ -242,6 +249,214 @@ class Queue (BaseShare):
         return (to_return)
 
 
+    ## Put an item into the queue if there's room, without waiting.
+    #
+    #  If the queue is full and the @c overwrite constructor parameter was
+    #  not @c True, the item is dropped, which is counted, and @c False is
+    #  returned at once. 
+    #  @param item The item to be placed into the queue
+    #  @param in_ISR Set this to @c True if calling from within an ISR
+    #  @return @c True if the item was put into the queue, @c False if not
+    @micropython.native
+    def try_put (self, item, in_ISR = False):
+        if self._thread_protect and not in_ISR:
+            irq_state = pyb.disable_irq ()
+
+        if self._overwrite or self._num_items < self._size:
+            self._write (item)
+            done = True
+        else:
+            self._dropped += 1
+            done = False
+
+        if self._thread_protect and not in_ISR:
+            pyb.enable_irq (irq_state)
+
+        return done
+
+
+    ## Read an item from the queue if there is one, without waiting.
+    #
+    #  @param default The value to return if the queue is empty
+    #  @param in_ISR Set this to @c True if calling from within an ISR
+    #  @return The oldest item in the queue, or @c default if it's empty
+    @micropython.native
+    def try_get (self, default = None, in_ISR = False):
+        if self.empty ():
+            return default
+        return self.get (in_ISR)
+
+
+    ## Put an item into the queue from a task, letting other tasks run while
+    #  waiting for room.
+    #
+    #  This is a generator to be used with @c yield @c from inside a task's
+    #  generator. While the queue is full, it yields @c state to the 
+    #  scheduler, just as the task itself would, so other tasks (including
+    #  the one which empties the queue) keep running. A plain @c put() on a 
+    #  full queue would instead spin forever, since the task which reads the
+    #  queue never gets a chance to run.
+    #  @code
+    #     def some_task ():
+    #         state = 0
+    #         while True:
+    #             ok = yield from my_queue.put_wait (make_data (), 100, state)
+    #             yield state
+    #  @endcode
+    #  @param item The item to be placed into the queue
+    #  @param timeout The longest time in milliseconds to wait for room, or
+    #         @c None to wait as long as it takes
+    #  @param state The value to yield to the scheduler while waiting
+    #  @return @c True if the item was put into the queue, @c False if the
+    #          time ran out first, in which case the item is counted as
+    #          dropped
+    def put_wait (self, item, timeout = None, state = None):
+        if self.full () and not self._overwrite:
+            self._blocked += 1
+            start = pyb.millis ()
+            while self.full ():
+                if timeout != None and pyb.elapsed_millis (start) >= timeout:
+                    self._dropped += 1
+                    return False
+                yield state
+        self.put (item)
+        return True
+
+
+    ## Read an item from the queue from a task, letting other tasks run while
+    #  waiting for data.
+    #
+    #  This is a generator to be used with @c yield @c from inside a task's
+    #  generator, in the same way as @c put_wait(). While the queue is empty,
+    #  it yields @c state to the scheduler.
+    #  @code
+    #     def some_task ():
+    #         state = 0
+    #         while True:
+    #             item = yield from my_queue.get_wait (state = state)
+    #             do_something_with (item)
+    #             yield state
+    #  @endcode
+    #  @param timeout The longest time in milliseconds to wait for data, or
+    #         @c None to wait as long as it takes
+    #  @param state The value to yield to the scheduler while waiting
+    #  @return The oldest item in the queue, or @c None if the time ran out
+    def get_wait (self, timeout = None, state = None):
+        if self.empty ():
+            self._blocked += 1
+            start = pyb.millis ()
+            while self.empty ():
+                if timeout != None and pyb.elapsed_millis (start) >= timeout:
+                    return None
+                yield state
+        return self.get ()
+
+
+    ## Put the items from an array, list or tuple into the queue.
+    # 
+    #  All the items are written in one critical section, so interrupts are
+    #  only disabled once for the whole block. This method doesn't wait for
+    #  room in the queue; if the queue fills up, the remaining items are not
+    #  written unless the @c overwrite constructor parameter was @c True, in
+    #  which case the oldest data is overwritten.
+    #  @param items An indexable sequence of items to be put into the queue
+    #  @param in_ISR Set this to @c True if calling from within an ISR
+    #  @return The number of items which were put into the queue
+    @micropython.native
+    def put_many (self, items, in_ISR = False):
+        if self._thread_protect and not in_ISR:
+            irq_state = pyb.disable_irq ()
+
+        count = len (items)
+        if not self._overwrite and count > self._size - self._num_items:
+            count = self._size - self._num_items
+        idx = 0
+        while idx < count:
+            self._write (items[idx])
+            idx += 1
+
+        if self._thread_protect and not in_ISR:
+            pyb.enable_irq (irq_state)
+
+        return count
+
+
+    ## Read as many items as are available, up to the size of the given
+    #  buffer, into the buffer.
+    #
+    #  This method doesn't wait for data; it returns at once, having copied
+    #  however many items were in the queue. Used with a buffer which was
+    #  allocated once, it moves blocks of data without allocating memory.
+    #  @param buf A preallocated array or list into which items are copied,
+    #         starting at index 0
+    #  @param in_ISR Set this to @c True if calling from within an ISR
+    #  @return The number of items which were copied into @c buf
+    @micropython.native
+    def get_into (self, buf, in_ISR = False):
+        if self._thread_protect and not in_ISR:
+            irq_state = pyb.disable_irq ()
+
+        count = self._num_items
+        if count > len (buf):
+            count = len (buf)
+        idx = 0
+        while idx < count:
+            buf[idx] = self._buffer[self._rd_idx]
+            self._rd_idx += 1
+            if self._rd_idx >= self._size:
+                self._rd_idx = 0
+            idx += 1
+        self._num_items -= count
+
+        if self._thread_protect and not in_ISR:
+            pyb.enable_irq (irq_state)
+
+        return count
+
+
+    ## Look at the oldest item in the queue without removing it.
+    #
+    #  @param in_ISR Set this to @c True if calling from within an ISR
+    #  @return The item which @c get() would return next, or @c None if the
+    #          queue is empty
+    @micropython.native
+    def peek (self, in_ISR = False):
+        if self._thread_protect and not in_ISR:
+            irq_state = pyb.disable_irq ()
+
+        if self._num_items > 0:
+            to_return = self._buffer[self._rd_idx]
+        else:
+            to_return = None
+
+        if self._thread_protect and not in_ISR:
+            pyb.enable_irq (irq_state)
+
+        return (to_return)
+
+
+    ## Write one item into the ring buffer and advance the pointers.
+    #
+    #  This method must be called with interrupts disabled if the queue is
+    #  thread protected. If the queue is full, the oldest item is dropped to
+    #  make room, so callers which must not overwrite data check first.
+    #  @param item The item to be written into the buffer
+    @micropython.native
+    def _write (self, item):
+        self._buffer[self._wr_idx] = item
+        self._wr_idx += 1
+        if self._wr_idx >= self._size:
+            self._wr_idx = 0
+        if self._num_items >= self._size:         # Full, so drop the oldest
+            self._rd_idx += 1
+            if self._rd_idx >= self._size:
+                self._rd_idx = 0
+        else:
+            self._num_items += 1
+        if self._num_items > self._max_full:     # Record maximum fillage
+            self._max_full = self._num_items
+
+
     ## Check if there are any items in the queue.
     # 
     #  Returns @c True if there are any items in the queue and @c False
@@ -283,20 +498,28 @@ class Queue (BaseShare):
 
 
     ## Remove all contents from the queue.
+    #
+    #  This also resets the counts of dropped items and of calls which had
+    #  to wait.
     def clear (self):
         self._rd_idx = 0
         self._wr_idx = 0
         self._num_items = 0
         self._max_full = 0
+        self._dropped = 0
+        self._blocked = 0
 
 
     ## This method puts diagnostic information about the queue into a string.
     # 
-    #  It shows the queue's name and type as well as the maximum number of
-    #  items and queue size. 
+    #  It shows the queue's name and type, the maximum number of items and
+    #  queue size, and how many items were dropped and how many calls had to
+    #  wait for room or for data.
     def __repr__ (self):
-        return ('{:<12s} Queue<{:s}> Max Full {:d}/{:d}'.format (self._name,
-                type_code_strings[self._type_code], self._max_full, self._size))
+        return ('{:<12s} Queue<{:s}> Max Full {:d}/{:d} Dropped {:d} '
+                'Blocked {:d}'.format (self._name,
+                type_code_strings[self._type_code], self._max_full, self._size,
+                self._dropped, self._blocked))
 
 
 # ============================================================================
@@ -407,4 +630,270 @@ class Share (BaseShare):
     #  Shares are pretty simple, so we just put the name and type. 
     def __repr__ (self):
         return ("{:<12s} Share<{:s}>".format (self._name,
-                type_code_strings[self._type_code]))
\ No newline at end of file
+                type_code_strings[self._type_code]))
+
+
+# ============================================================================
+
+## A share written by one task or ISR and read by any number of others,
+#  which never has to disable interrupts.
+#
+#  A @c Share with thread protection disables and re-enables interrupts on
+#  every @c get() and @c put(). This class instead keeps two copies of the
+#  data and a sequence counter. The writer bumps the counter to an odd value
+#  and writes copy 0, then bumps it to an even value and writes copy 1; a
+#  reader picks the copy which the counter says isn't being written, and
+#  tries again if the counter changed while it was reading. A reader in an
+#  ISR which interrupts the writer therefore always gets a whole value
+#  without waiting, and a reader interrupted by the writer simply reads
+#  again. Values can't be torn even for 64-bit types such as @c 'd' and 
+#  @c 'q', which take more than one instruction to copy.
+#
+#  There must be only one writer, whether a task or an ISR; two writers can
+#  interrupt each other and corrupt the counter. The methods take the same
+#  arguments as those of @c Share, so a @c SeqShare can be used anywhere a 
+#  @c Share is:
+#  @code
+#  import task_share
+#
+#  # This share holds the left wheel's speed setpoint, written only by the
+#  # sensing task and read by the control task
+#  set_omegaL = task_share.SeqShare ('f', name="set_omegaL")
+#  @endcode
+class SeqShare (BaseShare):
+
+    ## Create a single-writer shared data item.
+    #
+    #  @param type_code The type of data items which the share can hold, as
+    #         for @c Share
+    #  @param name A short name for the share, default @c ShareN where @c N
+    #         is a serial number for the share
+    def __init__ (self, type_code, name = None):
+        # Interrupts are never disabled, so thread_protect doesn't apply
+        super ().__init__ (type_code, False, name)
+
+        self._buffer = array.array (type_code, [0, 0])
+        self._seq = 0
+
+        self._name = str (name) if name != None \
+            else 'Share' + str (Share.ser_num)
+        Share.ser_num += 1
+
+
+    ## Write an item of data into the share.
+    # 
+    #  Only one task or ISR may call this method for a given share.
+    #  @param data The data to be put into this share
+    #  @param in_ISR Accepted so calls look like those to a @c Share; not used
+    @micropython.native
+    def put (self, data, in_ISR = False):
+        # The counter is masked so that it stays a small integer, which
+        # doesn't need memory to be allocated; the mask keeps its parity
+        self._seq = (self._seq + 1) & 0x3FFFFFFF
+        self._buffer[0] = data
+        self._seq = (self._seq + 1) & 0x3FFFFFFF
+        self._buffer[1] = data
+
+
+    ## Read an item of data from the share.
+    # 
+    #  @param in_ISR Accepted so calls look like those to a @c Share; not used
+    @micropython.native
+    def get (self, in_ISR = False):
+        while True:
+            seq = self._seq
+            to_return = self._buffer[seq & 1]
+            if seq == self._seq:
+                return (to_return)
+
+
+    ## Puts diagnostic information about the share into a string.
+    def __repr__ (self):
+        return ("{:<12s} SeqShare<{:s}>".format (self._name,
+                type_code_strings[self._type_code]))
+
+
+# ============================================================================
+
+## A group of named values of one type which are shared between tasks as a
+#  unit.
+#
+#  Separate shares each take their own critical section, and a task reading
+#  two of them can see one which has been updated and one which hasn't. A
+#  shared struct keeps all its fields in one @c array.array, so that a set 
+#  of related values, such as the left and right wheel setpoints, is written
+#  and read together in one critical section and is never seen half updated.
+#  Single fields can still be read and written by their indices, which can
+#  be looked up once from their names with @c index(), and @c field() makes
+#  an object with @c get() and @c put() methods which stands in for a 
+#  @c Share holding one field.
+#
+#  An example of the creation and use of a shared struct is as follows:
+#  @code
+#  import array, task_share
+#
+#  setpoints = task_share.SharedStruct ('f', ('omegaL', 'omegaR'))
+#  both = array.array ('f', (0, 0))                 # Allocated once
+#
+#  # In one task, write both setpoints at once
+#  both[0] = left_speed
+#  both[1] = right_speed
+#  setpoints.put_all (both)
+#
+#  # In another task, read them both at once, or only one of them
+#  setpoints.get_all (both)
+#  omega_L = setpoints.get (setpoints.index ('omegaL'))
+#  @endcode
+class SharedStruct (BaseShare):
+
+    ## A counter used to give serial numbers to structs for diagnostic use.
+    ser_num = 0
+
+    ## Create a shared struct with the given fields.
+    #
+    #  @param type_code The type of data held in every field, as for a 
+    #         @c Share
+    #  @param fields A list or tuple of names for the fields, in order
+    #  @param thread_protect @c True if mutual exclusion protection is used
+    #  @param name A short name for the struct, default @c StructN where @c N
+    #         is a serial number for the struct
+    def __init__ (self, type_code, fields, thread_protect = True, name = None):
+        super ().__init__ (type_code, thread_protect, name)
+
+        self._fields = tuple (fields)
+        self._buffer = array.array (type_code, [0] * len (self._fields))
+
+        self._name = str (name) if name != None \
+            else 'Struct' + str (SharedStruct.ser_num)
+        SharedStruct.ser_num += 1
+
+
+    ## Find the index of the field with the given name.
+    #
+    #  Looking fields up by name is slow, so tasks should do it once when
+    #  they start and keep the indices.
+    #  @param field_name The name of the field
+    #  @return The index of the field, for use with @c get() and @c put()
+    def index (self, field_name):
+        return self._fields.index (field_name)
+
+
+    ## Write a block of fields in one critical section.
+    #
+    #  @param values An indexable sequence of values, such as a preallocated
+    #         @c array.array, to be written into consecutive fields
+    #  @param first The index of the first field to be written, default 0
+    #  @param in_ISR Set this to True if calling from within an ISR
+    @micropython.native
+    def put_all (self, values, first = 0, in_ISR = False):
+        if self._thread_protect and not in_ISR:
+            irq_state = pyb.disable_irq ()
+
+        idx = 0
+        count = len (values)
+        while idx < count:
+            self._buffer[first + idx] = values[idx]
+            idx += 1
+
+        if self._thread_protect and not in_ISR:
+            pyb.enable_irq (irq_state)
+
+
+    ## Read a block of fields in one critical section.
+    #
+    #  As many fields are copied as will fit into @c out. 
+    #  @param out A preallocated array or list into which values are copied
+    #  @param first The index of the first field to be read, default 0
+    #  @param in_ISR Set this to True if calling from within an ISR
+    #  @return The array or list @c out
+    @micropython.native
+    def get_all (self, out, first = 0, in_ISR = False):
+        if self._thread_protect and not in_ISR:
+            irq_state = pyb.disable_irq ()
+
+        idx = 0
+        count = len (out)
+        while idx < count:
+            out[idx] = self._buffer[first + idx]
+            idx += 1
+
+        if self._thread_protect and not in_ISR:
+            pyb.enable_irq (irq_state)
+
+        return out
+
+
+    ## Write one field of the struct.
+    #
+    #  @param idx The index of the field, as found by @c index()
+    #  @param data The data to be put into the field
+    #  @param in_ISR Set this to True if calling from within an ISR
+    @micropython.native
+    def put (self, idx, data, in_ISR = False):
+        if self._thread_protect and not in_ISR:
+            irq_state = pyb.disable_irq ()
+
+        self._buffer[idx] = data
+
+        if self._thread_protect and not in_ISR:
+            pyb.enable_irq (irq_state)
+
+
+    ## Read one field of the struct.
+    #
+    #  @param idx The index of the field, as found by @c index()
+    #  @param in_ISR Set this to True if calling from within an ISR
+    @micropython.native
+    def get (self, idx, in_ISR = False):
+        if self._thread_protect and not in_ISR:
+            irq_state = pyb.disable_irq ()
+
+        to_return = self._buffer[idx]
+
+        if self._thread_protect and not in_ISR:
+            pyb.enable_irq (irq_state)
+
+        return (to_return)
+
+
+    ## Make an object which reads and writes one field like a @c Share.
+    #
+    #  @param field_name The name of the field
+    #  @return An object with @c get() and @c put() methods for the field
+    def field (self, field_name):
+        return StructField (self, self.index (field_name))
+
+
+    ## Puts diagnostic information about the struct into a string.
+    def __repr__ (self):
+        return ("{:<12s} Struct<{:s}> {:s}".format (self._name,
+                type_code_strings[self._type_code], ', '.join (self._fields)))
+
+
+## One field of a @c SharedStruct, used where a @c Share is expected.
+#
+#  Objects of this class are made by @c SharedStruct.field(); they have the
+#  same @c get() and @c put() methods as a @c Share.
+class StructField:
+
+    ## Create a view of one field of a shared struct.
+    #  @param struct The shared struct which holds the field
+    #  @param idx The index of the field in the struct
+    def __init__ (self, struct, idx):
+        self._struct = struct
+        self._idx = idx
+
+
+    ## Write the field.
+    #  @param data The data to be put into the field
+    #  @param in_ISR Set this to True if calling from within an ISR
+    @micropython.native
+    def put (self, data, in_ISR = False):
+        self._struct.put (self._idx, data, in_ISR)
+
+
+    ## Read the field.
+    #  @param in_ISR Set this to True if calling from within an ISR
+    @micropython.native
+    def get (self, in_ISR = False):
+        return self._struct.get (self._idx, in_ISR)